@@ -0,0 +1,4 @@
+"""
+Benchmarks of filabel. They run against a fake GitHub inside the process, so the results are repeatable offline.
+Run them with ``python -m benchmarks``, see ``python -m benchmarks --help``.
+"""
@@ -0,0 +1,473 @@
+"""
+Runner of the filabel benchmarks. Prints the results as JSON and compares them with the results of an older run.
+"""
+
+import click
+import hashlib
+import hmac
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from click.testing import CliRunner
+from benchmarks.fakegithub import FakeGitHub, installed
+from benchmarks.workloads import make_paths, make_patterns, make_label_config, make_repo
+from filabel.github import create_session, compile_label_patterns, get_all_labels, get_label_patterns, \
+    iter_items, LabelMemo, PREFETCH
+
+
+"""
+Sizes of the workloads, the quick ones are meant for a fast check
+"""
+SIZES = {
+    'full': {'files': 10000, 'patterns': 1000, 'pulls': 500, 'pull_files': 20, 'webhooks': 100, 'startups': 10},
+    'quick': {'files': 1000, 'patterns': 100, 'pulls': 50, 'pull_files': 20, 'webhooks': 20, 'startups': 3},
+}
+
+"""
+Project root directory, the fresh interpreters of the startup benchmarks import filabel from it
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+"""
+Registered benchmarks in the order they run, see benchmark()
+"""
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function gets the workload sizes and the latency of the fake GitHub
+    and returns the parameters of the benchmark, the timed function 'run' and optionally 'setup'
+    whose result is passed to 'run'. The run can return additional results (e.g. number of requests).
+        :param name: name of the benchmark
+        :type name: string
+        :returns: decorator
+        :rtype: function
+    """
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def write_configs(directory, rules):
+    """
+    Write the configuration files used by the CLI and the web app
+        :param directory: directory of the files
+        :param rules: parsed labeling rules
+        :type directory: string
+        :type rules: dictionary
+        :returns: paths of the credentials and the labels configuration files
+        :rtype: tuple
+    """
+    cred = os.path.join(directory, 'credentials.cfg')
+    with open(cred, 'w') as f:
+        f.write('[github]\ntoken=benchmark\nsecret=benchmark\n')
+    label = os.path.join(directory, 'labels.cfg')
+    with open(label, 'w') as f:
+        f.write(make_label_config(rules))
+    return cred, label
+
+
+@benchmark('labels.get_all_labels')
+def bench_get_all_labels(size, latency):
+    """
+    Match the paths of one big pull request against many labeling rules
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    paths = make_paths(size['files'])
+    matcher = compile_label_patterns(make_patterns(size['patterns']))
+    return {
+        'params': {'files': size['files'], 'patterns': size['patterns']},
+        'run': lambda st: {'labels': len(get_all_labels(paths, matcher))},
+    }
+
+
+@benchmark('labels.get_all_labels_memo')
+def bench_get_all_labels_memo(size, latency):
+    """
+    Match the same paths again with the memo of the previous pull request
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    paths = make_paths(size['files'])
+    matcher = compile_label_patterns(make_patterns(size['patterns']))
+
+    def setup():
+        # Warm memo, as for the next PR changing the same paths
+        memo = LabelMemo(size['files'])
+        get_all_labels(paths, matcher, memo, 'bench')
+        return memo
+
+    return {
+        'params': {'files': size['files'], 'patterns': size['patterns']},
+        'setup': setup,
+        'run': lambda memo: {'labels': len(get_all_labels(paths, matcher, memo, 'bench'))},
+    }
+
+
+@benchmark('config.get_label_patterns')
+def bench_get_label_patterns(size, latency):
+    """
+    Parse a big label configuration file
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    text = make_label_config(make_patterns(size['patterns']))
+    return {
+        'params': {'patterns': size['patterns']},
+        'run': lambda st: {'labels': len(get_label_patterns(io.StringIO(text)))},
+    }
+
+
+def bench_pagination(size, latency, prefetch):
+    """
+    Go through the paged files of one big pull request
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :param prefetch: maximal number of pages fetched at the same time, see filabel.github.iter_pages()
+        :type size: dictionary
+        :type latency: float
+        :type prefetch: int
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    fake = FakeGitHub({'bench/repo': make_repo(1, size['files'], [])}, latency)
+    session = create_session(None, t='benchmark')
+
+    def run(st):
+        start = fake.requests
+        with installed(fake):
+            count = sum(1 for f in iter_items(session, 'https://api.github.com/repos/bench/repo/pulls/1/files',
+                prefetch=prefetch))
+        return {'items': count, 'requests': fake.requests - start}
+
+    return {'params': {'files': size['files'], 'prefetch': prefetch, 'latency': latency}, 'run': run}
+
+
+@benchmark('pagination.iter_items')
+def bench_iter_items(size, latency):
+    """
+    Go through the paged files fetching one page after another
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    return bench_pagination(size, latency, 0)
+
+
+@benchmark('pagination.iter_items_prefetch')
+def bench_iter_items_prefetch(size, latency):
+    """
+    Go through the paged files prefetching the remaining pages
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    return bench_pagination(size, latency, PREFETCH)
+
+
+def run_cli(fake, cred, label, args):
+    """
+    Run the CLI against the fake GitHub
+        :param fake: the fake GitHub
+        :param cred: path of the credentials configuration file
+        :param label: path of the labels configuration file
+        :param args: additional arguments of the CLI
+        :type fake: FakeGitHub
+        :type cred: string
+        :type label: string
+        :type args: list
+        :returns: output of the CLI
+        :rtype: string
+    """
+    from filabel.cli import main
+    with installed(fake):
+        result = CliRunner().invoke(main, ['-a', cred, '-l', label, '-j', '4'] + args + ['bench/repo'])
+    if result.exit_code != 0:
+        raise RuntimeError(result.output)
+    return result.output
+
+
+def bench_cli(size, latency, backend):
+    """
+    Label a repository with many pull requests by the CLI
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :param backend: 'rest' or 'graphql' API used to get the pull requests, graphql is checked against rest first
+        :type size: dictionary
+        :type latency: float
+        :type backend: string
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    rules = make_patterns(size['patterns'])
+    directory = tempfile.mkdtemp(prefix='filabel-bench-')
+    cred, label = write_configs(directory, rules)
+
+    def setup():
+        # Every run labels the same fresh repository
+        return FakeGitHub({'bench/repo': make_repo(size['pulls'], size['pull_files'], list(rules))}, latency)
+
+    if backend == 'graphql':
+        # Both backends must give the same output and labels for the same repository
+        rest, graphql = setup(), setup()
+        if run_cli(rest, cred, label, []) != run_cli(graphql, cred, label, ['-g', 'graphql']) or \
+                rest.repos != graphql.repos:
+            raise RuntimeError('GraphQL backend labeled the pull requests differently than REST')
+
+    def run(fake):
+        run_cli(fake, cred, label, ['-g', backend])
+        return {'requests': fake.requests}
+
+    return {'params': {'pulls': size['pulls'], 'pull_files': size['pull_files'], 'patterns': size['patterns'],
+        'latency': latency}, 'setup': setup, 'run': run}
+
+
+@benchmark('cli.end_to_end')
+def bench_cli_rest(size, latency):
+    """
+    Label a repository by the CLI using the REST API
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    return bench_cli(size, latency, 'rest')
+
+
+@benchmark('cli.end_to_end_graphql')
+def bench_cli_graphql(size, latency):
+    """
+    Label a repository by the CLI using the GraphQL API
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    return bench_cli(size, latency, 'graphql')
+
+
+@benchmark('web.webhook')
+def bench_webhook(size, latency):
+    """
+    Label pull requests by sending webhooks to the web app, labeling inline without workers
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    rules = make_patterns(size['patterns'])
+    directory = tempfile.mkdtemp(prefix='filabel-bench-')
+    cred, label = write_configs(directory, rules)
+    os.environ['FILABEL_CONFIG'] = f'{cred}:{label}'
+    os.environ['FILABEL_WORKERS'] = '0'
+    from filabel.web import app
+    client = app.test_client()
+
+    def setup():
+        fake = FakeGitHub({'bench/repo': make_repo(size['webhooks'], size['pull_files'], list(rules))}, latency)
+        bodies = []
+        for num, pull in fake.repos['bench/repo'].items():
+            pj = {'number': num, 'labels': [{'name': l} for l in pull['labels']], 'head': {'sha': pull['sha']},
+                'base': {'repo': {'full_name': 'bench/repo'}}}
+            bodies.append(json.dumps({'action': 'opened', 'pull_request': pj}).encode())
+        return fake, bodies
+
+    def run(st):
+        fake, bodies = st
+        with installed(fake):
+            for body in bodies:
+                signature = 'sha1=' + hmac.new(b'benchmark', body, hashlib.sha1).hexdigest()
+                resp = client.post('/', data=body, headers={'X-GitHub-Event': 'pull_request',
+                    'X-Hub-Signature': signature, 'Content-Type': 'application/json'})
+                if resp.status_code != 200:
+                    raise RuntimeError(f'Webhook answered {resp.status_code}')
+        return {'requests': fake.requests}
+
+    return {'params': {'webhooks': size['webhooks'], 'pull_files': size['pull_files'], 'patterns': size['patterns'],
+        'latency': latency}, 'setup': setup, 'run': run}
+
+
+def bench_startup(size, code):
+    """
+    Run code in fresh interpreters, reporting the number of imported modules and whether flask is one of them
+        :param size: sizes of the workloads
+        :param code: Python code run by every interpreter
+        :type size: dictionary
+        :type code: string
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    script = code + '\nimport sys\nprint(len(sys.modules), int("flask" in sys.modules))'
+
+    def run(st):
+        for i in range(size['startups']):
+            result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr)
+        modules, flask = result.stdout.split('\n')[-2].split()
+        return {'modules': int(modules), 'flask': flask == '1'}
+
+    return {'params': {'startups': size['startups']}, 'run': run}
+
+
+@benchmark('startup.cli')
+def bench_startup_cli(size, latency):
+    """
+    Start a fresh interpreter printing the help of the CLI
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    # What every CLI invocation pays before talking to GitHub
+    return bench_startup(size, 'from filabel.cli import main\ntry:\n    main(["--help"])\nexcept SystemExit:\n    pass')
+
+
+@benchmark('startup.web')
+def bench_startup_web(size, latency):
+    """
+    Start a fresh interpreter importing the web app
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :type size: dictionary
+        :type latency: float
+        :returns: parameters of the benchmark, the timed function 'run' and optionally 'setup', see benchmark()
+        :rtype: dictionary
+    """
+    return bench_startup(size, 'from filabel import app')
+
+
+def run_benchmark(func, size, latency, repeat):
+    """
+    Run one benchmark several times
+        :param func: registered benchmark function
+        :param size: sizes of the workloads
+        :param latency: seconds every request to the fake GitHub takes
+        :param repeat: number of timed runs
+        :type func: function
+        :type size: dictionary
+        :type latency: float
+        :type repeat: int
+        :returns: parameters, times in seconds, their minimum, median and mean and the results of the last run
+        :rtype: dictionary
+    """
+    bench = func(size, latency)
+    times = []
+    extra = {}
+    for i in range(repeat):
+        st = bench['setup']() if 'setup' in bench else None
+        start = time.perf_counter()
+        extra = bench['run'](st) or {}
+        times.append(time.perf_counter() - start)
+    return {
+        'params': bench['params'],
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'results': extra,
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compare the median times with an older run
+        :param results: results of this run
+        :param baseline: results of the older run
+        :param threshold: maximal allowed ratio of the median times
+        :type results: dictionary
+        :type baseline: dictionary
+        :type threshold: float
+        :returns: names of the slower benchmarks with their ratio of the median times
+        :rtype: list
+    """
+    ret = []
+    for name, res in results['benchmarks'].items():
+        old = baseline.get('benchmarks', {}).get(name)
+        if old == None or old['params'] != res['params'] or old['median'] <= 0:
+            continue
+        ratio = res['median'] / old['median']
+        if ratio > threshold:
+            ret.append((name, ratio))
+    return ret
+
+
+@click.command()
+@click.option('-q', '--quick', is_flag=True, help='Use small workloads for a fast check.')
+@click.option('-k', '--select', metavar='TEXT', help='Only run the benchmarks whose name contains TEXT.')
+@click.option('-r', '--repeat', metavar='N', type=click.IntRange(min=1), default=3,
+    help='Number of timed runs of every benchmark.  [default: 3]')
+@click.option('--latency', metavar='MS', type=click.FloatRange(min=0), default=0,
+    help='Milliseconds every request to the fake GitHub takes.  [default: 0]')
+@click.option('-o', '--output', metavar='FILENAME', type=click.File('w'),
+    help='Write the JSON results to the file instead of stdout.')
+@click.option('-b', '--baseline', metavar='FILENAME', type=click.File('r'),
+    help='Results of an older run, fail if a benchmark got slower.')
+@click.option('-t', '--threshold', metavar='RATIO', type=click.FloatRange(min=1), default=1.25,
+    help='Maximal allowed ratio of the median times to the baseline.  [default: 1.25]')
+def main(quick, select, repeat, latency, output, baseline, threshold):
+    """
+    Run the benchmarks and print the results as JSON
+    """
+    size = SIZES['quick' if quick else 'full']
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'size': 'quick' if quick else 'full',
+        'repeat': repeat,
+        'benchmarks': {},
+    }
+    for name, func in BENCHMARKS:
+        if select != None and select not in name:
+            continue
+        print(f'Running {name}', file=sys.stderr)
+        results['benchmarks'][name] = run_benchmark(func, size, latency / 1000, repeat)
+    json.dump(results, output or sys.stdout, indent=2)
+    (output or sys.stdout).write('\n')
+    if baseline != None:
+        regressions = find_regressions(results, json.load(baseline), threshold)
+        for name, ratio in regressions:
+            print(f'{name} is {ratio:.2f}x slower than the baseline', file=sys.stderr)
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
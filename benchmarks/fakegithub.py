@@ -0,0 +1,80 @@
+"""
+Fake GitHub answering the requests inside the process with filabel.simulator.
+It is installed in place of the network transport of requests, so the filabel sessions
+(including their cache and rate limit layers) talk to it without any change.
+"""
+
+import contextlib
+import json
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from filabel.simulator import Simulator
+
+
+class FakeGitHub(BaseAdapter):
+    """
+    Transport adapter passing the requests to the simulator of the GitHub API
+    """
+
+    def __init__(self, repos, latency=0):
+        """
+        Create the fake
+            :param repos: pull requests by number by repository name, see benchmarks.workloads.make_repo()
+            :param latency: seconds every request takes
+            :type repos: dictionary
+            :type latency: float
+        """
+        super().__init__()
+        self.simulator = Simulator(repos, latency)
+        self.repos = repos
+
+    @property
+    def requests(self):
+        """
+        Number of the requests answered so far
+        """
+        return self.simulator.stats()['requests']
+
+    def send(self, request, **kwargs):
+        """
+        Answer the request, see requests.adapters.BaseAdapter.send()
+            :param request: the prepared request
+            :param kwargs: options of the transport (timeout, verify, ...), ignored
+            :type request: requests.PreparedRequest
+            :type kwargs: dictionary
+            :returns: answer of the simulator
+            :rtype: requests.Response
+        """
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        status, headers, ret = self.simulator.handle(request.method, request.url, body)
+        resp = Response()
+        resp.status_code = status
+        resp._content = json.dumps(ret).encode()
+        resp.headers = CaseInsensitiveDict(headers)
+        resp.headers['Content-Type'] = 'application/json'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        """
+        Nothing to close
+        """
+        pass
+
+
+@contextlib.contextmanager
+def installed(fake):
+    """
+    Send all the requests of the requests library to the fake while in the context
+        :param fake: the fake GitHub
+        :type fake: FakeGitHub
+    """
+    send = requests.adapters.HTTPAdapter.send
+    requests.adapters.HTTPAdapter.send = lambda adapter, request, **kwargs: fake.send(request, **kwargs)
+    try:
+        yield fake
+    finally:
+        requests.adapters.HTTPAdapter.send = send
@@ -0,0 +1,100 @@
+"""
+Synthetic workloads of the benchmarks: file paths of big pull requests, big label configurations and repositories with many pull requests.
+All of them are generated from a seed, so every run gets the same data.
+"""
+
+import random
+
+
+"""
+Directories and extensions the generated paths are made of
+"""
+DIRS = ['src', 'lib', 'docs', 'tests', 'static', 'templates', 'logic', 'api', 'web', 'tools']
+EXTENSIONS = ['py', 'rst', 'md', 'js', 'html', 'css', 'cfg', 'json', 'txt', 'lock']
+
+
+def make_paths(count, seed=0):
+    """
+    Generate file paths of one pull request
+        :param count: number of paths
+        :param seed: seed of the generator
+        :type count: int
+        :type seed: int
+        :returns: list of unique paths
+        :rtype: list
+    """
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(count):
+        depth = rnd.randint(1, 4)
+        dirs = [f'{rnd.choice(DIRS)}{rnd.randint(0, 30)}' for d in range(depth)]
+        paths.append('/'.join(dirs) + f'/file{i}.{rnd.choice(EXTENSIONS)}')
+    return paths
+
+
+def make_patterns(count, seed=0):
+    """
+    Generate labeling rules, every label has a few patterns
+        :param count: number of patterns
+        :param seed: seed of the generator
+        :type count: int
+        :type seed: int
+        :returns: parsed labeling rules ({'label': ['pattern', ...]})
+        :rtype: dictionary
+    """
+    rnd = random.Random(seed)
+    rules = {}
+    for i in range(count):
+        kind = rnd.randint(0, 2)
+        if kind == 0:
+            pattern = f'{rnd.choice(DIRS)}{rnd.randint(0, 30)}/*'
+        elif kind == 1:
+            pattern = f'*/{rnd.choice(DIRS)}{rnd.randint(0, 30)}/*.{rnd.choice(EXTENSIONS)}'
+        else:
+            pattern = f'*file{rnd.randint(0, 100000)}.*'
+        rules.setdefault(f'label{i // 4}', []).append(pattern)
+    return rules
+
+
+def make_label_config(rules):
+    """
+    Write the labeling rules in the format of the label configuration file
+        :param rules: parsed labeling rules
+        :type rules: dictionary
+        :returns: content of the configuration file
+        :rtype: string
+    """
+    lines = ['[labels]']
+    for label, patterns in rules.items():
+        lines.append(f'{label}=')
+        lines += [f'    {p}' for p in patterns]
+    return '\n'.join(lines) + '\n'
+
+
+def make_repo(pulls, files, labels, seed=0):
+    """
+    Generate pull requests of one repository
+        :param pulls: number of pull requests
+        :param files: number of files of one pull request
+        :param labels: labels the pull requests can already have
+        :param seed: seed of the generator
+        :type pulls: int
+        :type files: int
+        :type labels: list
+        :type seed: int
+        :returns: pull requests by number, see filabel.simulator.generate_repos()
+        :rtype: dictionary
+    """
+    rnd = random.Random(seed)
+    # Pull requests share many paths, like in a monorepo
+    shared = make_paths(files * 4, seed)
+    repo = {}
+    for num in range(1, pulls + 1):
+        repo[num] = {
+            'files': rnd.sample(shared, files),
+            'labels': rnd.sample(labels, min(len(labels), rnd.randint(0, 3))),
+            'sha': f'{num:040x}',
+            'state': 'open',
+            'updated_at': '2019-01-01T00:00:00Z',
+        }
+    return repo
@@ -1,5 +1,62 @@
-from .cli import main
-from .web import show_main_page, react_to_post, app
+"""
+The public names and submodules are imported only when they are used,
+so the CLI does not pay for importing Flask and the web application.
+"""
+
+import importlib
+import sys
+
+
+"""
+Public names of the package and the submodules they come from
+"""
+EXPORTS = {
+    'main': 'cli',
+    'show_main_page': 'web',
+    'react_to_post': 'web',
+    'app': 'web',
+}
+
+"""
+Submodules available as attributes of the package without importing them first
+"""
+SUBMODULES = ['aiogithub', 'cache', 'cli', 'discovery', 'github', 'graphql', 'jobs', 'metrics', 'ratelimit',
+    'report', 'simulator', 'state', 'web']
 
 
 __all__ = ['main', 'show_main_page', 'react_to_post', 'app']
+
+
+def __getattr__(name):
+    """
+    Import the public name or the submodule when it is first used
+        :param name: name of the attribute
+        :type name: string
+        :returns: the public name or the submodule
+        :rtype: object
+        :raises AttributeError: if there is no such name
+    """
+    if name in EXPORTS:
+        value = getattr(importlib.import_module(f'.{EXPORTS[name]}', __name__), name)
+    elif name in SUBMODULES:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """
+    List the attributes of the package including the ones not imported yet
+        :returns: names of the attributes
+        :rtype: list
+    """
+    return sorted(set(globals()) | set(EXPORTS) | set(SUBMODULES))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is only used by Python 3.7+, import everything at once
+    for name in list(EXPORTS) + SUBMODULES:
+        __getattr__(name)
+    del name
@@ -0,0 +1,427 @@
+"""
+Asynchronous counterpart of the filabel.github module built on asyncio and aiohttp.
+All the requests share one connection pool, so many pull requests can be processed on one thread.
+"""
+
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import time
+import weakref
+import requests
+from filabel.github import get_auth, get_pr_filenames, get_label_names, plan_is_noop, plan_is_small, check_plan_applied, \
+    PageError, PER_PAGE, PREFETCH, get_next_page, get_page_urls, get_delta_paths, get_api_url
+
+
+"""
+Rate limit schedulers of the open sessions
+"""
+limiters = weakref.WeakKeyDictionary()
+
+"""
+Metrics of the requests of the open sessions
+"""
+session_metrics = weakref.WeakKeyDictionary()
+
+"""
+Base URLs of the GitHub API of the open sessions, see get_session_url()
+"""
+api_urls = weakref.WeakKeyDictionary()
+
+"""
+HTTP caches of the open sessions used for conditional requests
+"""
+caches = weakref.WeakKeyDictionary()
+
+
+def get_session_url(session):
+    """
+    Get the base URL of the GitHub API used by the session
+        :param session: open asynchronous session
+        :type session: aiohttp.ClientSession()
+        :returns: base URL without the trailing slash
+        :rtype: string
+    """
+    url = api_urls.get(session)
+    if url == None:
+        return get_api_url()
+    return url.rstrip('/')
+
+
+def create_async_session(config_auth, t=None, limit=100, limit_per_host=10, limiter=None, api_url=None,
+        metrics=None, cache=None):
+    """
+    Create asynchronous session using the access token, must be called with a running event loop
+        :param config_auth: configuration file containing credentials
+        :param t: GitHub token, read from config_auth if not given
+        :param limit: maximal number of open connections
+        :param limit_per_host: maximal number of open connections to one host
+        :param limiter: rate limit scheduler of the requests, None to not schedule them
+        :param api_url: base URL of the GitHub API, filabel.github.get_api_url() if None
+        :param metrics: metrics of the requests, None to not record them
+        :param cache: HTTP cache for conditional requests, None to not cache
+        :type config_auth: file
+        :type t: string
+        :type limit: int
+        :type limit_per_host: int
+        :type limiter: filabel.ratelimit.RateLimiter
+        :type api_url: string
+        :type metrics: filabel.metrics.Metrics
+        :type cache: filabel.cache.HTTPCache
+        :returns: open GitHub session, False if something went wrong
+        :rtype: aiohttp.ClientSession(), bool
+    """
+    import aiohttp
+    token = t or get_auth(config_auth)
+    if token == False:
+        return False
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+    headers = {'User-Agent': 'soucevi1', 'Authorization': f'token {token}'}
+    session = aiohttp.ClientSession(connector=connector, headers=headers)
+    if limiter != None:
+        limiters[session] = limiter
+    if api_url != None:
+        api_urls[session] = api_url
+    if metrics != None:
+        session_metrics[session] = metrics
+    if cache != None:
+        caches[session] = cache
+    return session
+
+
+async def request(session, method, url, params=None, data=None):
+    """
+    Send one request to GitHub, scheduled by the rate limiter of the session and recorded to its metrics.
+    If the session has a cache, GET requests are sent as conditional requests and 304 responses are answered from it.
+        :param session: open asynchronous session
+        :param method: HTTP method
+        :param url: URL of the request
+        :param params: query parameters
+        :param data: body of the request
+        :type session: aiohttp.ClientSession()
+        :type method: string
+        :type url: string
+        :type params: dictionary
+        :type data: string
+        :returns: status code, headers and parsed JSON body (None if it is not JSON)
+        :rtype: int, dictionary, JSON
+    """
+    limiter = limiters.get(session)
+    metrics = session_metrics.get(session)
+    cache = caches.get(session) if method == 'GET' else None
+    key = None
+    entry = None
+    request_headers = {}
+    if cache != None:
+        # The same key as the one of the sync engine, so both engines share the cache
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        key = cache.url_key(full_url, session.headers.get('Authorization', ''))
+        entry = cache.get(key)
+        if entry != None:
+            if 'ETag' in entry['headers']:
+                request_headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                request_headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+    attempt = 0
+    while True:
+        if limiter != None:
+            wait = limiter.reserve_request(url)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        start = time.perf_counter()
+        try:
+            async with session.request(method, url, params=params, data=data, headers=request_headers) as resp:
+                content = await resp.read()
+                size = len(content)
+                text = await resp.text()
+                status = resp.status
+                headers = resp.headers
+        except Exception:
+            if metrics != None:
+                metrics.record_request(method, url, 'error', time.perf_counter() - start)
+            raise
+        if metrics != None:
+            metrics.record_request(method, url, status, time.perf_counter() - start, size)
+        if limiter == None or limiter.update(url, status, headers, text, attempt) == None:
+            break
+        attempt += 1
+    if cache != None:
+        if entry != None and status == 304:
+            from multidict import CIMultiDict
+            cache.hit(key)
+            status = 200
+            headers = CIMultiDict(headers)
+            headers.update(entry['headers'])
+            text = entry['body'].decode()
+        elif status == 200 and ('ETag' in headers or 'Last-Modified' in headers):
+            cache.put(key, full_url, headers, content)
+        else:
+            cache.miss()
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = None
+    return status, headers, body
+
+
+async def get_page(session, url):
+    """
+    Get one page of a GitHub listing
+        :param session: open asynchronous session
+        :param url: URL of the page
+        :type session: aiohttp.ClientSession()
+        :type url: string
+        :returns: JSON of the page
+        :rtype: list
+        :raises PageError: if the page could not be fetched
+    """
+    status, headers, page = await request(session, 'GET', url)
+    if status != 200:
+        raise PageError(status, url)
+    return page
+
+
+async def iter_prefetched(session, urls, prefetch):
+    """
+    Fetch the pages at the same time and go through them in order,
+    at most prefetch pages are being fetched or waiting to be processed
+        :param session: open asynchronous session
+        :param urls: URLs of the pages
+        :param prefetch: maximal number of pages fetched at the same time
+        :type session: aiohttp.ClientSession()
+        :type urls: list
+        :type prefetch: int
+        :returns: asynchronous generator of the JSON pages
+        :rtype: async generator
+        :raises PageError: if a page could not be fetched
+    """
+    urls = iter(urls)
+    tasks = collections.deque(asyncio.ensure_future(get_page(session, u)) for u in itertools.islice(urls, prefetch))
+    try:
+        while len(tasks) != 0:
+            page = await tasks.popleft()
+            for u in itertools.islice(urls, 1):
+                tasks.append(asyncio.ensure_future(get_page(session, u)))
+            yield page
+    finally:
+        # Listing stopped early or failed, the remaining pages are not needed
+        for t in tasks:
+            if t.done() and not t.cancelled():
+                t.exception()
+            else:
+                t.cancel()
+
+
+async def iter_pages(session, url, params=None, prefetch=0):
+    """
+    Go through all the pages of a GitHub listing following the Link header
+        :param session: open asynchronous session
+        :param url: URL of the first page
+        :param params: query parameters of the first page, per_page is set to the maximum
+        :param prefetch: maximal number of the remaining pages fetched at the same time when the last page is known,
+                         0 to fetch a page only when the previous one was processed
+        :type session: aiohttp.ClientSession()
+        :type url: string
+        :type params: dictionary
+        :type prefetch: int
+        :returns: asynchronous generator of the JSON pages
+        :rtype: async generator
+        :raises PageError: if a page could not be fetched
+    """
+    params = dict(params or {}, per_page=PER_PAGE)
+    while url != None:
+        status, headers, page = await request(session, 'GET', url, params)
+        if status != 200:
+            raise PageError(status, url)
+        yield page
+        urls = get_page_urls(headers) if prefetch > 0 else None
+        if urls != None:
+            async for page in iter_prefetched(session, urls, prefetch):
+                yield page
+            return
+        url = get_next_page(headers)
+        params = None
+
+
+async def get_all_pages(session, url, params=None, prefetch=0):
+    """
+    Get all the items of a GitHub listing
+        :param session: open asynchronous session
+        :param url: URL of the first page
+        :param params: query parameters of the first page
+        :param prefetch: maximal number of pages fetched at the same time, see iter_pages()
+        :type session: aiohttp.ClientSession()
+        :type url: string
+        :type params: dictionary
+        :type prefetch: int
+        :returns: list of items from all the pages
+        :rtype: list
+        :raises PageError: if a page could not be fetched
+    """
+    ret = []
+    async for page in iter_pages(session, url, params, prefetch):
+        ret += page
+    return ret
+
+
+async def get_repo_prs_async(r, state, base, session, sort=None, stop=None):
+    """
+    Go through all pull requests of a given repository as the pages arrive
+        :param r: repository name 'author/repo-name'
+        :param state: state of the PR
+        :param base: base branch
+        :param session: open asynchronous session
+        :param sort: 'updated' to list the recently updated PRs first, None for the newest PRs first
+        :param stop: function telling that the listing can stop at the given PR, None to list all
+        :type r: string
+        :type state: string
+        :type base: string
+        :type session: aiohttp.ClientSession()
+        :type sort: string
+        :type stop: function
+        :returns: asynchronous generator of JSON of the pull requests
+        :rtype: async generator
+        :raises PageError: if a page could not be fetched
+    """
+    payload = {'state': state}
+    if base != None:
+        payload['base'] = base
+    if sort != None:
+        payload['sort'] = sort
+        payload['direction'] = 'desc'
+    # Prefetched pages would be wasted when the listing stops early
+    prefetch = PREFETCH if stop == None else 0
+    async for page in iter_pages(session, f'{get_session_url(session)}/repos/{r}/pulls', payload, prefetch):
+        for pull in page:
+            if stop != None and stop(pull):
+                return
+            yield pull
+
+
+async def get_pr_files_async(r, session, pull_num):
+    """
+    Get list containing all the files that are modified in the current pull request
+        :param r: string 'author/repo-name'
+        :param session: open asynchronous session
+        :param pull_num: number of the pull request
+        :type r: string
+        :type session: aiohttp.ClientSession()
+        :type pull_num: int
+        :returns: list of files contained in the pull requests, False if something goes wrong
+        :rtype: list, bool
+    """
+    try:
+        files = await get_all_pages(session, f'{get_session_url(session)}/repos/{r}/pulls/{pull_num}/files',
+            prefetch=PREFETCH)
+    except PageError as e:
+        print(e, file=sys.stderr)
+        return False
+    return get_pr_filenames(files)
+
+
+async def get_pr_delta_async(r, session, base, head):
+    """
+    Get the paths changed in the PR since the given commit
+        :param r: string 'author/repo-name'
+        :param session: open asynchronous session
+        :param base: SHA of the older head of the PR
+        :param head: SHA of the current head of the PR
+        :type r: string
+        :type session: aiohttp.ClientSession()
+        :type base: string
+        :type head: string
+        :returns: list of changed paths, None if they cannot be used instead of listing all the files
+        :rtype: list
+    """
+    status, headers, body = await request(session, 'GET', f'{get_session_url(session)}/repos/{r}/compare/{base}...{head}')
+    if status != 200 or body == None:
+        return None
+    return get_delta_paths(body)
+
+
+async def add_labels_async(repo, pull_num, labels, session, strict=False):
+    """
+    Add all the labels to the PR
+        :param repo: repository
+        :param pull_num: number of pull request
+        :param labels: labels to add
+        :param session: open asynchronous session
+        :param strict: check the labels with another GET request instead of the PUT response
+        :type repo: string
+        :type pull_num: int
+        :type labels: list
+        :type session: aiohttp.ClientSession()
+        :type strict: bool
+        :returns: True if labels added successfully, False otherwise
+        :rtype: bool
+    """
+    status, headers, body = await request(session, 'PUT',
+        f'{get_session_url(session)}/repos/{repo}/issues/{pull_num}/labels', data=json.dumps(labels))
+    if status != 200:
+        return False
+    llist = get_label_names(body)
+    if strict:
+        return await test_labels_added_async(repo, pull_num, labels, session)
+    return set(llist) == set(labels)
+
+
+async def apply_label_plan_async(repo, pull_num, plan, session, strict=False):
+    """
+    Change the labels of the PR according to the plan, nothing is sent if there is no change
+        :param repo: repository
+        :param pull_num: number of pull request
+        :param plan: plan from filabel.github.plan_label_changes()
+        :param session: open asynchronous session
+        :param strict: check the labels with another GET request instead of the responses
+        :type repo: string
+        :type pull_num: int
+        :type plan: dictionary
+        :type session: aiohttp.ClientSession()
+        :type strict: bool
+        :returns: True if labels were changed successfully, False otherwise
+        :rtype: bool
+    """
+    if plan_is_noop(plan):
+        return True
+    if not plan_is_small(plan):
+        return await add_labels_async(repo, pull_num, list(plan['final']), session, strict)
+    url = f'{get_session_url(session)}/repos/{repo}/issues/{pull_num}/labels'
+    llist = None
+    if len(plan['add']) != 0:
+        status, headers, body = await request(session, 'POST', url, data=json.dumps({'labels': sorted(plan['add'])}))
+        if status != 200:
+            return False
+        llist = get_label_names(body)
+    for l in sorted(plan['remove']):
+        status, headers, body = await request(session, 'DELETE', f'{url}/{requests.utils.quote(l, safe="")}')
+        if status != 200:
+            return False
+        llist = get_label_names(body)
+    if strict:
+        return await test_labels_added_async(repo, pull_num, list(plan['final']), session)
+    return check_plan_applied(plan, llist)
+
+
+async def test_labels_added_async(repo, pull_num, labels, session):
+    """
+    Test whether the labels were added correctly (permissions etc.)
+        :param repo: repository
+        :param pull_num: number of pull request
+        :param labels: labels that were added
+        :param session: open asynchronous session
+        :type repo: string
+        :type pull_num: int
+        :type labels: list
+        :type session: aiohttp.ClientSession()
+        :returns: True if labels are correct, False oherwise
+        :rtype: bool
+    """
+    try:
+        llist = get_label_names(await get_all_pages(session,
+            f'{get_session_url(session)}/repos/{repo}/issues/{pull_num}/labels'))
+    except PageError:
+        return False
+    return set(llist) == set(labels)
+
@@ -0,0 +1,202 @@
+"""
+Persistent HTTP cache of GitHub responses used for conditional requests.
+GitHub answers a conditional request with 304 Not Modified, which does not count to the rate limit.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+"""
+Default maximal size of the cached bodies in bytes
+"""
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
+"""
+Response headers stored together with the body
+"""
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+"""
+Seconds to wait for the cache file locked by another process (e.g. a --workers process)
+"""
+LOCK_TIMEOUT = 30
+
+"""
+Number of the least recently used responses deleted at once when the cache is too big
+"""
+EVICT_BATCH = 100
+
+
+def default_cache_dir():
+    """
+    Get the directory of the cache, FILABEL_CACHE_DIR or filabel directory in the user cache directory
+        :returns: path to the directory
+        :rtype: string
+    """
+    d = os.getenv('FILABEL_CACHE_DIR')
+    if d != None:
+        return d
+    base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'filabel')
+
+
+class HTTPCache:
+    """
+    Cache of GET responses with ETag or Last-Modified stored in sqlite,
+    least recently used responses are evicted when the cache grows over its maximal size.
+    The file can be shared by several processes, a locked file is waited for.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        Open the cache, the directory is created if needed
+            :param directory: directory of the cache file, default_cache_dir() if None
+            :param max_size: maximal size of the cached bodies in bytes
+            :type directory: string
+            :type max_size: int
+        """
+        directory = directory or default_cache_dir()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'http.sqlite')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        # Readers do not block the writer and the other way round
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, '
+            'headers TEXT, body BLOB, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.commit()
+        # Size of the cached bodies, other processes may change it, so it is counted again before evicting
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def key(self, request):
+        """
+        Get the cache key of the request, responses for different tokens are kept apart
+            :param request: prepared request
+            :type request: requests.PreparedRequest
+            :returns: cache key
+            :rtype: string
+        """
+        return self.url_key(request.url, request.headers.get('Authorization', ''))
+
+    def url_key(self, url, auth):
+        """
+        Get the cache key of a GET request to the URL
+            :param url: complete URL of the request including the query
+            :param auth: Authorization header of the request
+            :type url: string
+            :type auth: string
+            :returns: cache key
+            :rtype: string
+        """
+        auth = hashlib.sha256(auth.encode()).hexdigest()[:16]
+        return f'{auth} {url}'
+
+    def get(self, key):
+        """
+        Get the cached response
+            :param key: cache key from key()
+            :type key: string
+            :returns: stored headers and body, None if not cached
+            :rtype: dictionary
+        """
+        with self.lock:
+            row = self.db.execute('SELECT headers, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            return None
+        return {'headers': json.loads(row[0]), 'body': row[1]}
+
+    def hit(self, key):
+        """
+        Record that the cached response was used
+            :param key: cache key from key()
+            :type key: string
+        """
+        with self.lock:
+            self.hits += 1
+            try:
+                self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.db.rollback()
+                print(f'Cache could not be updated: {e}', file=sys.stderr)
+
+    def put(self, key, url, headers, body):
+        """
+        Store the response and evict the least recently used ones if the cache got too big
+            :param key: cache key from key()
+            :param url: URL of the request
+            :param headers: response headers
+            :param body: response body
+            :type key: string
+            :type url: string
+            :type headers: dictionary
+            :type body: bytes
+        """
+        stored = {h: headers[h] for h in STORED_HEADERS if h in headers}
+        with self.lock:
+            self.misses += 1
+            if len(body) > self.max_size:
+                return
+            try:
+                row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, url, json.dumps(stored), body, len(body), time.time()))
+                self.size += len(body) - (row[0] if row != None else 0)
+                if self.size > self.max_size:
+                    self.evict()
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.db.rollback()
+                print(f'Response could not be cached: {e}', file=sys.stderr)
+
+    def miss(self):
+        """
+        Record a response that could not be cached
+        """
+        with self.lock:
+            self.misses += 1
+
+    def evict(self):
+        """
+        Delete the least recently used responses until the cache fits its size, must be called with the lock held
+        """
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while self.size > self.max_size:
+            self.db.execute('DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY used LIMIT ?)', (EVICT_BATCH,))
+            self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def stats(self):
+        """
+        Get usage statistics of the cache
+            :returns: hits (304 answered from cache), misses, hit ratio, number of entries and size in bytes
+            :rtype: dictionary
+        """
+        with self.lock:
+            entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total != 0 else 0.0,
+                'entries': entries,
+                'size': size,
+                'max_size': self.max_size,
+            }
+
+    def close(self):
+        """
+        Close the cache file
+        """
+        with self.lock:
+            self.db.close()
@@ -8,7 +8,16 @@ import json
 import sys
 import pprint
 import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from filabel.github import *
+from filabel.ratelimit import RateLimiter
+from filabel.graphql import get_repo_prs_graphql
+from filabel.state import StateFile
+from filabel.metrics import Metrics
+from filabel.report import RunReport, Profiler, merge_reports, merge_profiles
+from filabel.discovery import is_pattern, discover_repos, DiscoveryCache, DISCOVERY_TTL
 
 
 """
@@ -29,7 +38,7 @@ class color:
 
 def validate_repo_names(repos):
     """
-    Checks whether repository name is '{username}/{repo}'
+    Checks whether repository name is '{username}/{repo}', the repo can be a pattern (e.g. '{username}/*')
         :param repos: list of repository names
         :type repos: list
         :returns: True if all are OK, repo name of the one that is not
@@ -43,135 +52,405 @@ def validate_repo_names(repos):
             return r
         if (s[0].find('/') != -1) or (s[1].find('/') != -1):
             return r
+        if is_pattern(s[0]):
+            return r
     return True
 
 
 
-def get_repo_prs(r, state, base, session):
+def get_repo_prs(r, state, base, session, sort=None, stop=None):
     """
-    Get all pull requests of a given repository
+    Go through all pull requests of a given repository as the pages arrive
         :param r: repository name 'author/repo-name'
         :param state: state of the PR
         :param base: base branch
         :param session: open and authenticated session
+        :param sort: 'updated' to list the recently updated PRs first, None for the newest PRs first
+        :param stop: function telling that the listing can stop at the given PR, None to list all
         :type r: string
         :type state: string
         :type base: string
         :type session: requests.Session()
-        :returns: list of JSON of the pull requests, False if something goes wrong
-        :rtype: list, bool
+        :type sort: string
+        :type stop: function
+        :returns: generator of JSON of the pull requests
+        :rtype: generator
+        :raises PageError: if a page could not be fetched
     """
     payload = {'state': state, 'base': base}
-    pulls = session.get(f'https://api.github.com/repos/{r}/pulls', params=payload)
-    if pulls.status_code != 200:
+    if sort != None:
+        payload['sort'] = sort
+        payload['direction'] = 'desc'
+    # Prefetched pages would be wasted when the listing stops early
+    prefetch = PREFETCH if stop == None else 0
+    for pj in iter_items(session, f'{get_api_url(session)}/repos/{r}/pulls', payload, prefetch):
+        if stop != None and stop(pj):
+            return
+        yield pj
+
+
+def pr_line(r, pull_num, ok):
+    """
+    Format the output line of one pull request
+        :param r: repository name 'author/repo-name'
+        :param pull_num: number of the pull request
+        :param ok: flag indicating success
+        :type r: string
+        :type pull_num: int
+        :type ok: bool
+        :returns: line to print
+        :rtype: string
+    """
+    if ok:
+        return color.BOLD + '  PR ' + color.END + f'https://github.com/{r}/pull/{pull_num} - ' + color.BOLD + color.GREEN + 'OK'
+    return color.BOLD + '  PR ' + color.END + f'https://github.com/{r}/pull/{pull_num} - ' + color.BOLD + color.RED + 'FAIL'
+
+
+def repo_line(r, ok):
+    """
+    Format the output line of one repository
+        :param r: repository name 'author/repo-name'
+        :param ok: flag indicating success
+        :type r: string
+        :type ok: bool
+        :returns: line to print
+        :rtype: string
+    """
+    if ok:
+        return color.BOLD + 'REPO ' + color.END + r + ' - ' + color.GREEN + color.BOLD + 'OK'
+    return color.BOLD + 'REPO ' + color.END + r + ' - ' + color.RED + color.BOLD + 'FAIL'
+
+
+def pr_lines(r, pull_num, fl, plan):
+    """
+    Format the output of one labeled pull request
+        :param r: repository name 'author/repo-name'
+        :param pull_num: number of the pull request
+        :param fl: flag indicating that the labels were set
+        :param plan: plan of the label changes from plan_label_changes()
+        :type r: string
+        :type pull_num: int
+        :type fl: bool
+        :type plan: dictionary
+        :returns: lines to print
+        :rtype: list
+    """
+    if fl == False:
+        return [pr_line(r, pull_num, False)]
+    labels_to_print = [('+', x) for x in plan['add']]
+    labels_to_print += [('-', x) for x in plan['remove']]
+    labels_to_print += [('=', x) for x in plan['keep']]
+    labels_to_print.sort(key=lambda tup: tup[1])
+    lines = [pr_line(r, pull_num, True)]
+    for l in labels_to_print:
+        if l[0] == '+':
+            lines.append('    ' + color.GREEN + f'+ {l[1]}' + color.END)
+        elif l[0] == '-':
+            lines.append('    ' + color.RED + f'- {l[1]}' + color.END)
+        elif l[0] == '=':
+            lines.append(f'    = {l[1]}')
+    return lines
+
+
+def get_listing(opts):
+    """
+    Get the parameters of the listing recorded in the state file
+        :param opts: options of the run, see make_options()
+        :type opts: dictionary
+        :returns: state, base branch and hash of the labeling rules
+        :rtype: list
+    """
+    return [opts['state'], opts['base'], opts['config']]
+
+
+def get_listing_order(r, opts):
+    """
+    Get the order of the PR listing, with a state file the recently updated PRs come first
+    and the listing stops at the first PR that did not change since the last run
+        :param r: repository name 'author/repo-name'
+        :param opts: options of the run, see make_options()
+        :type r: string
+        :type opts: dictionary
+        :returns: sort and stop arguments of the listing functions
+        :rtype: tuple
+    """
+    state = opts['state_file']
+    if state == None:
+        return None, None
+    listing = get_listing(opts)
+    return 'updated', lambda pull: state.is_seen(r, pull, opts['config'], listing)
+
+
+def is_changed_pull(r, pull, opts):
+    """
+    Check whether the PR head, labeling rules or labels changed since the last run
+        :param r: repository name 'author/repo-name'
+        :param pull: JSON of the listed pull request
+        :param opts: options of the run, see make_options()
+        :type r: string
+        :type pull: JSON
+        :type opts: dictionary
+        :returns: True if the pull request should be labeled
+        :rtype: bool
+    """
+    state = opts['state_file']
+    if state == None:
+        return True
+    if state.is_unchanged(r, pull, opts['config']):
+        state.record_update(r, pull)
         return False
+    return True
+
+
+def record_listing(r, opts, ok):
+    """
+    Record the result of listing the PRs of one repository in the state file
+        :param r: repository name 'author/repo-name'
+        :param opts: options of the run, see make_options()
+        :param ok: flag indicating that all the pages were fetched
+        :type r: string
+        :type opts: dictionary
+        :type ok: bool
+    """
+    state = opts['state_file']
+    if state == None:
+        return
+    if ok:
+        state.record_listing(r, get_listing(opts))
+    else:
+        state.record_failure(r)
+
 
-    pjlist = pulls.json()
-    if 'Link' in pulls.headers:
-        while True:
-            links = requests.utils.parse_header_links(pulls.headers['Link'])
-            n_flag = False
-            for l in links:
-                if l['rel'] == 'next':
-                    pulls = session.get(l['url'])
-                    if pulls.status_code != 200:
-                        return False
-                    n_flag = True
-                    break            
-            if n_flag == False:
-                break 
-            pjlist += pulls.json()
-    return pjlist
-
-
-def get_added_labels(l_new, l_old):
-    """
-    Get labels that are new to this PR
-        :param l_new: new labels to be added
-        :param l_old: labels that were already in the PR
-        :type l_new: list
-        :type l_old: list
-        :returns: list of labels that were added
+def record_pull(r, pull, opts, plan, fl):
+    """
+    Record the result of labeling one pull request in the state file
+        :param r: repository name 'author/repo-name'
+        :param pull: JSON of the pull request
+        :param opts: options of the run, see make_options()
+        :param plan: applied plan of the label changes, None if the files could not be fetched
+        :param fl: flag indicating that the labels were set
+        :type r: string
+        :type pull: JSON
+        :type opts: dictionary
+        :type plan: dictionary
+        :type fl: bool
+    """
+    state = opts['state_file']
+    if state == None:
+        return
+    if fl:
+        state.record_pull(r, pull, opts['config'], plan)
+    else:
+        state.record_failure(r)
+
+
+def label_pull(r, pull, opts, session):
+    """
+    Label one pull request
+        :param r: repository name 'author/repo-name'
+        :param pull: JSON of the pull request
+        :param opts: options of the run, see make_options()
+        :param session: open and authenticated session
+        :type r: string
+        :type pull: JSON
+        :type opts: dictionary
+        :type session: requests.Session()
+        :returns: lines describing the result
         :rtype: list
     """
-    ret = []
-    for l in l_new:
-        if l in l_old:
-            continue
+    pull_num = pull['number']
+    labels_current = get_current_labels(pull['labels'])
+    with opts['report'].pull(r, pull_num) as entry:
+        if 'files' in pull:
+            # Already fetched by the GraphQL backend
+            pull_filenames = pull['files']
         else:
-            ret.append(l)
-    return ret
+            pull_filenames = get_pr_files(r, session, pull_num)
+        if pull_filenames == False:
+            record_pull(r, pull, opts, None, False)
+            return [pr_line(r, pull_num, False)]
+        entry['files'] = len(pull_filenames)
+        start = time.perf_counter()
+        labels_new = get_all_labels(pull_filenames, opts['matcher'], opts['memo'], opts['config'])
+        entry['match_seconds'] = time.perf_counter() - start
+        plan = plan_label_changes(labels_new, labels_current, opts['fpatterns'], opts['delete_old'])
+        fl = apply_label_plan(r, pull_num, plan, session, opts['strict'])
+        entry['ok'] = fl != False
+    record_pull(r, pull, opts, plan, fl)
+    return pr_lines(r, pull_num, fl, plan)
 
 
-def get_new_in_current(l_new, l_old, pattern_dict):
+async def label_pull_async(r, pull, opts, session):
     """
-    Get those labels, that are supposed to be added but were already there and known
-        :param l_new: new labels
-        :param l_old: old labels
-        :param pattern_dict: directory of patterns that are used to match the filenames
-        :type l_new: list
-        :type l_old: list
-        :type pttern_dict: dictionary
-        :returns: list of knwon labels to be added, that were already in the pull request
+    Label one pull request using the asynchronous engine
+        :param r: repository name 'author/repo-name'
+        :param pull: JSON of the pull request
+        :param opts: options of the run, see make_options()
+        :param session: open asynchronous session
+        :type r: string
+        :type pull: JSON
+        :type opts: dictionary
+        :type session: aiohttp.ClientSession()
+        :returns: lines describing the result
         :rtype: list
     """
-    ret = []
-    ret2 = []
-    for l in l_new:
-        if l in l_old:
-            ret.append(l)
-    for l in ret:
-        if l in pattern_dict:
-            ret2.append(l)
-    return ret2
-
-
-def get_current_in_all(l_to_add, l_old, pattern_dict):
-    """
-    Get those labels that were already there and known
-        :param l_to_add: new labels
-        :param l_old: old labels
-        :type l_to_add: list
-        :type l_old: list
-        :param pattern_dict: directory of patterns that are used to match the filenames
-        :type pattern_dict: dictionary
-        :returns: list of the known assigned labels
-        :rtype: list
+    from filabel.aiogithub import get_pr_files_async, apply_label_plan_async
+    pull_num = pull['number']
+    labels_current = get_current_labels(pull['labels'])
+    with opts['report'].pull(r, pull_num) as entry:
+        pull_filenames = await get_pr_files_async(r, session, pull_num)
+        if pull_filenames == False:
+            record_pull(r, pull, opts, None, False)
+            return [pr_line(r, pull_num, False)]
+        entry['files'] = len(pull_filenames)
+        start = time.perf_counter()
+        labels_new = get_all_labels(pull_filenames, opts['matcher'], opts['memo'], opts['config'])
+        entry['match_seconds'] = time.perf_counter() - start
+        plan = plan_label_changes(labels_new, labels_current, opts['fpatterns'], opts['delete_old'])
+        fl = await apply_label_plan_async(r, pull_num, plan, session, opts['strict'])
+        entry['ok'] = fl != False
+    record_pull(r, pull, opts, plan, fl)
+    return pr_lines(r, pull_num, fl, plan)
+
+
+def label_repo(r, opts, session, pr_pool):
     """
-    ret = []
-    ret2 = []
-    for l in l_to_add:
-        if l in l_old:
-            ret.append(l)
-    for l in ret:
-        if l in pattern_dict:
-            ret2.append(l)
-    return ret2
+    Go through the pull requests of one repository and schedule their labeling as the pages arrive
+        :param r: repository name 'author/repo-name'
+        :param opts: options of the run, see make_options()
+        :param session: open and authenticated session
+        :param pr_pool: executor running the labeling of single pull requests
+        :type r: string
+        :type opts: dictionary
+        :type session: requests.Session()
+        :type pr_pool: concurrent.futures.Executor
+        :returns: flag indicating that all the PRs were listed and futures of the PR output lines in the listing order
+        :rtype: tuple
+    """
+    with opts['report'].repo(r) as entry:
+        sort, stop = get_listing_order(r, opts)
+        if opts['backend'] == 'graphql':
+            pulls = get_repo_prs_graphql(r, opts['state'], opts['base'], session, sort=sort, stop=stop)
+        else:
+            pulls = get_repo_prs(r, opts['state'], opts['base'], session, sort, stop)
+        pr_futures = []
+        try:
+            for p in pulls:
+                if is_changed_pull(r, p, opts):
+                    pr_futures.append(pr_pool.submit(label_pull, r, p, opts, session))
+        except PageError:
+            # The PRs from the pages before are labeled anyway
+            record_listing(r, opts, False)
+            return False, pr_futures
+        entry['ok'] = True
+    record_listing(r, opts, True)
+    return True, pr_futures
 
 
+async def label_repo_async(r, opts, session):
+    """
+    Go through the pull requests of one repository and schedule their labeling on the event loop as the pages arrive
+        :param r: repository name 'author/repo-name'
+        :param opts: options of the run, see make_options()
+        :param session: open asynchronous session
+        :type r: string
+        :type opts: dictionary
+        :type session: aiohttp.ClientSession()
+        :returns: flag indicating that all the PRs were listed and tasks producing the PR output lines in the listing order
+        :rtype: tuple
+    """
+    import asyncio
+    from filabel.aiogithub import get_repo_prs_async
+    with opts['report'].repo(r) as entry:
+        sort, stop = get_listing_order(r, opts)
+        pr_tasks = []
+        try:
+            async for p in get_repo_prs_async(r, opts['state'], opts['base'], session, sort, stop):
+                if is_changed_pull(r, p, opts):
+                    pr_tasks.append(asyncio.ensure_future(label_pull_async(r, p, opts, session)))
+        except PageError:
+            record_listing(r, opts, False)
+            return False, pr_tasks
+        entry['ok'] = True
+    record_listing(r, opts, True)
+    return True, pr_tasks
 
 
-def get_removed(l_new, l_old, fpatterns):
+async def main_async(config_auth, reposlugs, opts, t=None, out=None, cache=None):
     """
-    Get those labels that are supposed to be removed
-        :param l_new:  new labels
-        :param l_old: old labels
-        :param pattern_dict: directory of patterns that are used to match the filenames
-        :type l_new: list
-        :type l_old: list
-        :type pattern_dict: ditionary
-        :returns: list of removed labels
-        :rtype: list
+    Label the pull requests of all the repositories using the asynchronous engine
+        :param config_auth: configuration file with credentials
+        :param reposlugs: list of repo names ('owner/reponame')
+        :param opts: options of the run, see make_options()
+        :param t: GitHub token, read from config_auth if not given
+        :param out: function called with the index of the repository and every output line, print_line() if None
+        :param cache: HTTP cache for conditional requests, None to not cache
+        :type config_auth: file
+        :type reposlugs: list of strings
+        :type opts: dictionary
+        :type t: string
+        :type out: function
+        :type cache: filabel.cache.HTTPCache
+        :returns: False if the session could not be created, True otherwise
+        :rtype: bool
+    """
+    import asyncio
+    from filabel.aiogithub import create_async_session
+    out = out or print_line
+    session = create_async_session(config_auth, t=t, limit=opts['jobs'], limit_per_host=opts['jobs'],
+        limiter=opts['limiter'], api_url=opts['api_url'], metrics=opts['metrics'], cache=cache)
+    if session == False:
+        return False
+    async with session:
+        repo_tasks = [asyncio.ensure_future(label_repo_async(r, opts, session)) for r in reposlugs]
+        for i, (r, rt) in enumerate(zip(reposlugs, repo_tasks)):
+            ok, pr_tasks = await rt
+            out(i, repo_line(r, ok))
+            for pt in pr_tasks:
+                for line in await pt:
+                    out(i, line)
+    return True
+
+
+def make_options(fpatterns, state, base, delete_old, jobs, strict, backend='rest', state_file=None):
     """
-    ret = []
-    ret2 = []
-    for l in l_old:
-        if l in fpatterns:
-            ret.append(l)
-    for l in ret:
-        if l not in l_new:
-            ret2.append(l)
-    return ret2
+    Collect the options shared by all the labeled repositories and pull requests
+        :param fpatterns: parsed labeling rules
+        :param state: state of the pull requests to be labeled (open, closed, all)
+        :param base: base branch
+        :param delete_old: flag indicating that old unused labels should be deleted from the PR
+        :param jobs: number of concurrently processed pull requests and repositories
+        :param strict: check the labels with another GET request after setting them
+        :param backend: 'rest' or 'graphql' API used to get the pull requests
+        :param state_file: state of the previous runs, None to label all the pull requests
+        :type fpatterns: dictionary
+        :type state: string
+        :type base: string
+        :type delete_old: bool
+        :type jobs: int
+        :type strict: bool
+        :type backend: string
+        :type state_file: filabel.state.StateFile
+        :returns: options of the run, the rules are also compiled under 'matcher' and hashed under 'config',
+                  the labels of the paths are remembered in 'memo', the timings are recorded in 'report'
+                  and the GitHub requests in 'metrics'
+        :rtype: dictionary
+    """
+    return {
+        'fpatterns': fpatterns,
+        'matcher': compile_label_patterns(fpatterns),
+        'state': state,
+        'base': base,
+        'delete_old': delete_old,
+        'jobs': jobs,
+        'strict': strict,
+        'backend': backend,
+        'state_file': state_file,
+        'config': config_hash(fpatterns, delete_old),
+        'memo': LabelMemo(),
+        'report': RunReport(),
+        'metrics': Metrics(),
+    }
 
 
 @click.command()
@@ -186,22 +465,92 @@ def get_removed(l_new, l_old, fpatterns):
     type=click.File('r'), help='File with authorization configuration.')
 @click.option('-l', '--config-labels', metavar='FILENAME', 
     type=click.File('r'), help='File with labels configuration.')
+@click.option('-j', '--jobs', metavar='N', type=click.IntRange(min=1),
+    help='Number of pull requests and repositories processed at once.  [default: 1]', default=1)
+@click.option('-e', '--engine', type=click.Choice(['sync', 'async']),
+    help='Use threads or asyncio to talk to GitHub.  [default: sync]', default='sync')
+@click.option('-g', '--backend', type=click.Choice(['rest', 'graphql']),
+    help='GitHub API used to get the pull requests and their files.  [default: rest]', default='rest')
+@click.option('--strict/--no-strict',
+    help='Check the labels with another request after setting them.  [default: False]', default=False)
+@click.option('--cache-dir', metavar='DIR', envvar='FILABEL_CACHE_DIR',
+    help='Cache GitHub responses in this directory and use conditional requests.')
+@click.option('--cache-size', metavar='MB', type=click.IntRange(min=1),
+    help='Maximal size of the cache in megabytes.  [default: 100]', default=100)
+@click.option('--state-file', metavar='FILENAME', envvar='FILABEL_STATE_FILE',
+    help='Remember the labeled pull requests in this file and skip the unchanged ones next time.')
+@click.option('--api-url', metavar='URL', envvar='FILABEL_API_URL',
+    help='Base URL of the GitHub API.  [default: https://api.github.com]')
+@click.option('--stats/--no-stats',
+    help='Print statistics of the run to stderr.  [default: False]', default=False)
+@click.option('--report', metavar='FILENAME', type=click.File('w'),
+    help='Write the report of the run (timings, requests, rate limit) as JSON to the file.')
+@click.option('--profile', metavar='FILENAME',
+    help='Profile the run with cProfile and write the statistics to the file.')
+@click.option('-w', '--workers', metavar='N', type=click.IntRange(min=1),
+    help='Number of processes the repositories are distributed among.  [default: 1]', default=1)
+@click.option('--shard', metavar='I/N',
+    help='Only label the I-th of N disjoint shards of the repositories (e.g. 1/4), for running on several machines.')
+@click.option('--archived/--no-archived',
+    help='Label also the archived repositories matched by patterns.  [default: False]', default=False)
+@click.option('--forks/--no-forks',
+    help='Label also the forks matched by patterns.  [default: False]', default=False)
+@click.option('--empty/--no-empty',
+    help='Label also the repositories matched by patterns with no open pull requests.  [default: False]', default=False)
+@click.option('--discovery-ttl', metavar='SECONDS', type=click.IntRange(min=0),
+    help=f'Reuse the repositories listed for patterns for this long, 0 to always list them.  [default: {DISCOVERY_TTL}]',
+    default=DISCOVERY_TTL)
 
-def main(config_auth, config_labels, reposlugs, state, delete_old, base):
+def main(config_auth, config_labels, reposlugs, state, delete_old, base, jobs, engine, backend, strict,
+        cache_dir, cache_size, state_file, api_url, stats, report, profile, workers, shard,
+        archived, forks, empty, discovery_ttl):
     """
     Main function of the CLI module. For every reposlug it finds all its PRs and sets its labels.
         :param config_auth: name of the configuration file with credentials
         :param config_labels: name of the configuration file with label rules
-        :param reposlugs: list of repo names ('owner/reponame')
+        :param reposlugs: list of repo names ('owner/reponame') and patterns ('owner/*')
         :param state: state of the pull requests to be labeled (open, closed, all)
         :param delete_old: flag indicating that old unused labels should be deleted from the PR
         :param base: base branch
+        :param jobs: number of concurrently processed pull requests and repositories
+        :param engine: 'sync' for the thread pool, 'async' for the asyncio engine
+        :param backend: 'rest' to get every PR's files separately, 'graphql' to get many PRs with their files at once
+        :param strict: check the labels with another GET request after setting them
+        :param cache_dir: directory of the HTTP cache, None to not cache
+        :param cache_size: maximal size of the HTTP cache in megabytes
+        :param state_file: file with the state of the previous runs, None to label all the pull requests
+        :param api_url: base URL of the GitHub API, None for https://api.github.com
+        :param stats: flag indicating that statistics should be printed to stderr
+        :param report: file the JSON report of the run is written to, None to not write it
+        :param profile: name of the file with the cProfile statistics of the run, None to not profile it
+        :param workers: number of the processes the repositories are distributed among
+        :param shard: 'I/N' to label only the I-th of N shards of the repositories, None to label all of them
+        :param archived: flag indicating that the archived repositories matched by patterns should be labeled
+        :param forks: flag indicating that the forks matched by patterns should be labeled
+        :param empty: flag indicating that the repositories matched by patterns with no open PRs should be labeled
+        :param discovery_ttl: seconds the repositories listed for patterns are reused for, 0 to not reuse them
         :type config_auth: string
         :type config_labels: string
         :type reposlugs: list of strings
         :type state: string
         :type delete_old: bool
         :type base: string
+        :type jobs: int
+        :type engine: string
+        :type strict: bool
+        :type cache_dir: string
+        :type cache_size: int
+        :type state_file: string
+        :type api_url: string
+        :type stats: bool
+        :type report: file
+        :type profile: string
+        :type workers: int
+        :type shard: string
+        :type archived: bool
+        :type forks: bool
+        :type empty: bool
+        :type discovery_ttl: int
     """
     colorama.init(autoreset=True)
     # Validate inputs and parameters
@@ -215,77 +564,298 @@ def main(config_auth, config_labels, reposlugs, state, delete_old, base):
     if rep != True:
         print(f'Reposlug {rep} not valid!', file=sys.stderr)
         sys.exit(1)
+    if engine == 'async' and backend == 'graphql':
+        print('GraphQL backend can only be used with the sync engine!', file=sys.stderr)
+        sys.exit(1)
+    if engine == 'async' and sys.version_info < (3, 7):
+        print('Async engine needs Python 3.7 or newer!', file=sys.stderr)
+        sys.exit(1)
+    if profile != None and sys.version_info < (3, 7):
+        print('Profiling needs Python 3.7 or newer!', file=sys.stderr)
+        sys.exit(1)
 
     fpatterns = get_label_patterns(config_labels)
     if fpatterns == False:
         print('Labels configuration not usable!', file=sys.stderr)
         sys.exit(1)
-
-    # Open a session
-    session = create_session(config_auth)
-    if session == False:
+    token = get_auth(config_auth)
+    if token == False:
         print('Auth configuration not usable!', file=sys.stderr)
-        sys.exit(1)        
-
-    # Iterate through all the repositories
-    for r in reposlugs:
-        # Get all PRs of the current repo
-        pulls_json = get_repo_prs(r, state, base, session)
-        if pulls_json == False:
-            print(color.BOLD + 'REPO ' + color.END + r + ' - ' + color.RED + color.BOLD + 'FAIL')
-            continue
-        print(color.BOLD + 'REPO ' + color.END + r + ' - ' + color.GREEN + color.BOLD + 'OK')
-        # For each PR find its number, current labels and get info about the files
-        for n in range(len(pulls_json)):
-            pull_num = pulls_json[n]['number']
-            labels_current = get_current_labels(pulls_json[n]['labels'])
-            pull_files_json_list = get_pr_files(r, session, pull_num)
-            if pull_files_json_list == False:
-                print(color.BOLD + '  PR ' + color.END + f'https://github.com/{r}/pull/{pull_num} - ' + color.BOLD + color.RED + 'FAIL')
-                continue
-            pull_filenames = pull_files_json_list#get_pr_filenames(pull_files_json_list)   
-            labels_new = get_all_labels(pull_filenames, fpatterns)              
-
-            labels_to_add = []
-            labels_plus = []
-            labels_minus = []
-            labels_eq = []
-            fl = False
-            if delete_old == True:
-                # Delete old
-                u_labels_to_keep = get_unknown_labels_to_keep(labels_current, fpatterns)
-                labels_to_add = labels_new#labels_to_keep + labels_new
-                labels_to_add += u_labels_to_keep
-                labels_to_add = list(set(labels_to_add))
-                fl = add_labels(r, pull_num, labels_to_add, session)
-                labels_plus = get_added_labels(labels_new, labels_current)
-                labels_eq = get_new_in_current(labels_new, labels_current, fpatterns)
-                labels_minus = get_removed(labels_new, labels_current, fpatterns)                
-
-            else:
-                # No delete old
-                labels_to_add = labels_new + labels_current
-                labels_to_add = list(set(labels_to_add))
-                fl = add_labels(r, pull_num, labels_to_add, session)
-                labels_plus = get_added_labels(labels_new, labels_current)
-                labels_eq = get_current_in_all(labels_new, labels_current, fpatterns)
-
-            if fl == True:
-                labels_to_print = []
-                for x in labels_plus:
-                    labels_to_print.append(('+', x))
-                for x in labels_minus:
-                    labels_to_print.append(('-', x))
-                for x in labels_eq:
-                    labels_to_print.append(('=', x))
-                labels_to_print.sort(key=lambda tup: tup[1])
-                print(color.BOLD + '  PR ' + color.END + f'https://github.com/{r}/pull/{pull_num} - ' + color.BOLD + color.GREEN + 'OK')
-                for l in labels_to_print:
-                    if l[0] == '+':
-                        print('    ' + color.GREEN + f'+ {l[1]}' + color.END)
-                    elif l[0] == '-':
-                        print('    ' + color.RED + f'- {l[1]}' + color.END)
-                    elif l[0] == '=':
-                        print(f'    = {l[1]}')
-            else:
-                print(color.BOLD + '  PR ' + color.END + f'https://github.com/{r}/pull/{pull_num} - ' + color.BOLD + color.RED + 'FAIL')
+        sys.exit(1)
+    discovery = None
+    if any(is_pattern(r) for r in reposlugs):
+        filters = {'state': state, 'archived': archived, 'forks': forks, 'empty': empty}
+        reposlugs, discovery = discover(reposlugs, token, api_url, jobs, cache_dir, discovery_ttl, filters)
+    if shard != None:
+        parsed = parse_shard(shard)
+        if parsed == False:
+            print(f'Shard {shard} not valid!', file=sys.stderr)
+            sys.exit(1)
+        reposlugs = get_shard(reposlugs, *parsed)
+
+    settings = {
+        'fpatterns': fpatterns,
+        'state': state,
+        'base': base,
+        'delete_old': delete_old,
+        'jobs': jobs,
+        'strict': strict,
+        'engine': engine,
+        'backend': backend,
+        'cache_dir': cache_dir,
+        'cache_size': cache_size,
+        'state_file': state_file,
+        'api_url': api_url,
+        'token': token,
+        'profile': profile,
+    }
+    if workers > 1 and len(reposlugs) > 1:
+        run = run_workers(reposlugs, settings, workers)
+    else:
+        run = label_shard(reposlugs, settings, print_line)
+    run['discovery'] = discovery
+    if report != None:
+        json.dump(run, report, indent=2)
+        report.write('\n')
+    if stats:
+        print_stats(run)
+
+
+def discover(reposlugs, token, api_url, jobs, cache_dir, ttl, filters):
+    """
+    Expand the patterns among the reposlugs, the listings of the owners are cached in repos.json in the cache directory
+        :param reposlugs: list of repo names ('owner/reponame') and patterns ('owner/*')
+        :param token: GitHub token
+        :param api_url: base URL of the GitHub API, None for https://api.github.com
+        :param jobs: maximal number of owners listed at once
+        :param cache_dir: directory of the cache, the default one if None
+        :param ttl: seconds the listings are reused for, 0 to not cache them
+        :param filters: state of the labeled PRs and flags of the kept archived, forked and empty repositories
+        :type reposlugs: list of strings
+        :type token: string
+        :type api_url: string
+        :type jobs: int
+        :type cache_dir: string
+        :type ttl: int
+        :type filters: dictionary
+        :returns: repo names and the statistics of the discovery with its requests under 'http'
+        :rtype: tuple
+    """
+    from filabel.cache import default_cache_dir
+    directory = cache_dir or default_cache_dir()
+    cache = DiscoveryCache(os.path.join(directory, 'repos.json'), ttl) if ttl > 0 else None
+    metrics = Metrics()
+    session = create_session(None, t=token, pool_size=jobs * PREFETCH, limiter=RateLimiter(), api_url=api_url,
+        metrics=metrics)
+    reposlugs, discovery = discover_repos(reposlugs, session, jobs, cache, **filters)
+    if cache != None and discovery['listed'] != 0:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            cache.save()
+        except OSError as e:
+            print(f'Discovered repositories could not be cached: {e}', file=sys.stderr)
+    discovery['http'] = metrics.summary()
+    return reposlugs, discovery
+
+
+def print_line(index, line):
+    """
+    Print a line of the output
+        :param index: index of the repository the line belongs to
+        :param line: the line
+        :type index: int
+        :type line: string
+    """
+    print(line)
+
+
+def parse_shard(shard):
+    """
+    Parse the shard given as 'I/N'
+        :param shard: the shard, I from 1 to N
+        :type shard: string
+        :returns: index and number of the shards, False if it is not valid
+        :rtype: tuple, bool
+    """
+    parts = shard.split('/')
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        return False
+    i, n = int(parts[0]), int(parts[1])
+    if i < 1 or i > n:
+        return False
+    return i, n
+
+
+def get_shard(reposlugs, i, n):
+    """
+    Get the repositories of one shard. Every repository belongs to the shard given by the hash of its name,
+    so it stays in the same shard when the list of repositories changes.
+        :param reposlugs: list of repo names ('owner/reponame')
+        :param i: index of the shard, from 1 to n
+        :param n: number of the shards
+        :type reposlugs: list of strings
+        :type i: int
+        :type n: int
+        :returns: repo names of the shard in the original order
+        :rtype: list of strings
+    """
+    return [r for r in reposlugs if int(hashlib.sha1(r.lower().encode()).hexdigest(), 16) % n == i - 1]
+
+
+def main_sync(reposlugs, opts, token, cache=None, profiler=None, out=None):
+    """
+    Label the pull requests of all the repositories using thread pools
+        :param reposlugs: list of repo names ('owner/reponame')
+        :param opts: options of the run, see make_options()
+        :param token: GitHub token
+        :param cache: HTTP cache for conditional requests, None to not cache
+        :param profiler: profiler of the worker threads, None to not profile them
+        :param out: function called with the index of the repository and every output line, print_line() if None
+        :type reposlugs: list of strings
+        :type opts: dictionary
+        :type token: string
+        :type cache: filabel.cache.HTTPCache
+        :type profiler: filabel.report.Profiler
+        :type out: function
+    """
+    out = out or print_line
+    # Open a session shared by all the workers, every worker (listing the repositories or the files of the PRs)
+    # can be fetching up to PREFETCH pages at once
+    session = create_session(None, t=token, pool_size=2 * opts['jobs'] * PREFETCH, cache=cache, limiter=opts['limiter'],
+        api_url=opts['api_url'], metrics=opts['metrics'])
+
+    # Repositories are listed and PRs labeled in the background,
+    # the output is printed in the original order as the results come
+    # The workers are profiled too (the initializer is only known to Python 3.7+)
+    kwargs = {'initializer': profiler.start_thread} if profiler != None else {}
+    with ThreadPoolExecutor(max_workers=opts['jobs'], **kwargs) as repo_pool, \
+            ThreadPoolExecutor(max_workers=opts['jobs'], **kwargs) as pr_pool:
+        repo_futures = [repo_pool.submit(label_repo, r, opts, session, pr_pool) for r in reposlugs]
+        for i, (r, rf) in enumerate(zip(reposlugs, repo_futures)):
+            ok, pr_futures = rf.result()
+            out(i, repo_line(r, ok))
+            for pf in pr_futures:
+                for line in pf.result():
+                    out(i, line)
+
+
+def label_shard(reposlugs, settings, out=None):
+    """
+    Label the pull requests of the repositories in this process with its own session, rate limiter and label memo
+        :param reposlugs: list of repo names ('owner/reponame')
+        :param settings: options of the run and the GitHub token collected by main()
+        :param out: function called with the index of the repository and every output line as they come,
+                    None to return the lines (in a worker process, see run_workers())
+        :type reposlugs: list of strings
+        :type settings: dictionary
+        :type out: function
+        :returns: report of the run from filabel.report.RunReport.build(), without out also the output lines
+                  per index of the repository under 'lines', the state of the repositories under 'state'
+                  and the name of the file with the profile under 'profile'
+        :rtype: dictionary
+    """
+    worker = out == None
+    lines = {}
+    if worker:
+        out = lambda i, line: lines.setdefault(i, []).append(line)
+    profiler = Profiler() if settings['profile'] != None else None
+    state_file = StateFile(settings['state_file']) if settings['state_file'] != None else None
+    opts = make_options(settings['fpatterns'], settings['state'], settings['base'], settings['delete_old'],
+        settings['jobs'], settings['strict'], settings['backend'], state_file)
+    # All the requests of the process share one rate limit budget
+    opts['limiter'] = RateLimiter()
+    opts['api_url'] = settings['api_url']
+
+    cache = None
+    if settings['cache_dir'] != None:
+        from filabel.cache import HTTPCache
+        cache = HTTPCache(settings['cache_dir'], settings['cache_size'] * 1024 * 1024)
+    if settings['engine'] == 'async':
+        import asyncio
+        asyncio.run(main_async(None, reposlugs, opts, settings['token'], out, cache))
+    else:
+        main_sync(reposlugs, opts, settings['token'], cache, profiler, out)
+
+    run = opts['report'].build(opts['metrics'], opts['limiter'], opts['memo'], cache)
+    if not worker:
+        if state_file != None:
+            state_file.save()
+        if profiler != None:
+            profiler.dump(settings['profile'])
+        return run
+    run['lines'] = lines
+    run['state'] = state_file.export(reposlugs) if state_file != None else None
+    if profiler != None:
+        run['profile'] = f'{settings["profile"]}.{os.getpid()}'
+        profiler.dump(run['profile'])
+    return run
+
+
+def run_workers(reposlugs, settings, workers):
+    """
+    Distribute the repositories among worker processes, each of them labels its share with its own session.
+    The output is printed in the original order and the reports, states and profiles of the workers are merged.
+        :param reposlugs: list of repo names ('owner/reponame')
+        :param settings: options of the run and the GitHub token collected by main()
+        :param workers: number of the worker processes
+        :type reposlugs: list of strings
+        :type settings: dictionary
+        :type workers: int
+        :returns: report of the whole run, see filabel.report.merge_reports()
+        :rtype: dictionary
+    """
+    # Only the runs with workers pay for importing multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    start = time.perf_counter()
+    workers = min(workers, len(reposlugs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Every worker gets every n-th repository, so big and small ones are mixed
+        futures = [pool.submit(label_shard, reposlugs[k::workers], settings) for k in range(workers)]
+        for i in range(len(reposlugs)):
+            for line in futures[i % workers].result()['lines'].get(i // workers, []):
+                print(line)
+        runs = [f.result() for f in futures]
+    if settings['state_file'] != None:
+        # Only this process writes the state file
+        state_file = StateFile(settings['state_file'])
+        for run in runs:
+            state_file.merge(run['state'])
+        state_file.save()
+    if settings['profile'] != None:
+        filenames = [run['profile'] for run in runs]
+        merge_profiles(filenames, settings['profile'])
+        for filename in filenames:
+            os.remove(filename)
+    return merge_reports(runs, reposlugs, start)
+
+
+def print_stats(run):
+    """
+    Print statistics of the run to stderr
+        :param run: report of the run from filabel.report.RunReport.build() or filabel.report.merge_reports()
+        :type run: dictionary
+    """
+    st = run.get('discovery')
+    if st != None:
+        print(f'Discovery: {st["seconds"]:.2f} s, {st["repos"]} repositories matched {st["patterns"]} patterns, '
+            f'{st["skipped"]} skipped, {st["listed"]} owners listed, {st["cached"]} cached, '
+            f'{st["http"]["requests"]} requests', file=sys.stderr)
+    print(f'Run: {run["wall_seconds"]:.2f} s, {len(run["repos"])} repositories, '
+        f'{sum(len(r["pulls"]) for r in run["repos"])} pull requests, '
+        f'label matching {run["match_seconds"]:.2f} s', file=sys.stderr)
+    http = run['http']
+    print(f'Requests: {http["requests"]} requests, {http["bytes"] / 1024:.1f} kB received, '
+        f'{http["seconds"]:.2f} s in requests (summed over the concurrent ones)', file=sys.stderr)
+    st = run['rate_limit']
+    print(f'Rate limit: {st["requests"]} requests, {st["consumed"]} of the quota consumed, '
+        f'{st["rate_limited"]} rate limited, waited {st["waited"]:.1f} s', file=sys.stderr)
+    for name, res in sorted(st['resources'].items()):
+        print(f'Rate limit {name}: {res["remaining"]} of {res["limit"]} remaining', file=sys.stderr)
+    st = run['cache']
+    if st != None:
+        print(f'Cache: {st["hits"]} hits, {st["misses"]} misses ({100 * st["hit_ratio"]:.1f} % hit ratio), '
+            f'{st["entries"]} entries, {st["size"] / 1024 / 1024:.1f} MB of {st["max_size"] / 1024 / 1024:.0f} MB',
+            file=sys.stderr)
+    st = run['label_memo']
+    print(f'Label memo: {st["hits"]} hits, {st["misses"]} misses ({100 * st["hit_ratio"]:.1f} % hit ratio), '
+        f'{st["entries"]} of {st["size"]} paths', file=sys.stderr)
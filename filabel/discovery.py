@@ -0,0 +1,234 @@
+"""
+Discovery of the repositories given by patterns such as 'org/*' or 'owner/filabel-*'.
+The repositories of every owner are listed once, the owners concurrently, and filtered.
+The listings can be kept in a file for a while, so repeated runs do not list the owners again.
+"""
+
+import fnmatch
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from filabel.github import get_api_url, iter_items, PageError, PER_PAGE, PREFETCH
+
+
+"""
+Characters making a repository name a pattern (see fnmatch)
+"""
+PATTERN_CHARS = '*?['
+
+"""
+Seconds the listed repositories of an owner are reused for
+"""
+DISCOVERY_TTL = 3600
+
+"""
+Version of the discovery cache file format, files with another version are ignored
+"""
+DISCOVERY_VERSION = 1
+
+"""
+Fields of the listed repositories kept in the cache
+"""
+REPO_FIELDS = ('full_name', 'archived', 'fork', 'open_issues_count')
+
+
+def is_pattern(reposlug):
+    """
+    Check whether the reposlug is a pattern of repository names
+        :param reposlug: 'owner/reponame' or 'owner/pattern'
+        :type reposlug: string
+        :returns: True if the repository name contains a pattern character
+        :rtype: bool
+    """
+    return any(c in reposlug for c in PATTERN_CHARS)
+
+
+def list_owner_repos(owner, session):
+    """
+    List all the repositories of an organization, or the public repositories of a user if there is no such organization
+        :param owner: login of the organization or user
+        :param session: open and authenticated session
+        :type owner: string
+        :type session: requests.Session()
+        :returns: JSON of the repositories sorted by name, with only the fields in REPO_FIELDS
+        :rtype: list
+        :raises PageError: if a page could not be fetched
+    """
+    api_url = get_api_url(session)
+    params = {'per_page': PER_PAGE, 'sort': 'full_name', 'direction': 'asc'}
+    try:
+        repos = list(iter_items(session, f'{api_url}/orgs/{owner}/repos', dict(params, type='all'), PREFETCH))
+    except PageError as e:
+        if e.status != 404:
+            raise
+        repos = list(iter_items(session, f'{api_url}/users/{owner}/repos', dict(params, type='owner'), PREFETCH))
+    return [{k: rj.get(k) for k in REPO_FIELDS} for rj in repos]
+
+
+def filter_repos(repos, pattern, state='open', archived=False, forks=False, empty=False):
+    """
+    Get the names of the listed repositories matching the pattern
+        :param repos: JSON of the repositories from list_owner_repos()
+        :param pattern: pattern of the repository names ('owner/filabel-*'), case insensitive
+        :param state: state of the labeled pull requests, repositories with no open issues are empty only for 'open'
+        :param archived: flag indicating that the archived repositories should be kept
+        :param forks: flag indicating that the forks should be kept
+        :param empty: flag indicating that the repositories with no open pull requests should be kept
+        :type repos: list
+        :type pattern: string
+        :type state: string
+        :type archived: bool
+        :type forks: bool
+        :type empty: bool
+        :returns: names of the matching repositories and the number of the ones skipped by the filters
+        :rtype: tuple
+    """
+    ret = []
+    skipped = 0
+    pattern = pattern.lower()
+    for rj in repos:
+        if not fnmatch.fnmatchcase(rj['full_name'].lower(), pattern):
+            continue
+        # The open issues count includes the open pull requests
+        if (rj['archived'] and not archived) or (rj['fork'] and not forks) or \
+                (state == 'open' and rj['open_issues_count'] == 0 and not empty):
+            skipped += 1
+            continue
+        ret.append(rj['full_name'])
+    return ret, skipped
+
+
+class DiscoveryCache:
+    """
+    JSON file with the listed repositories of the owners and the time they were listed
+    """
+
+    def __init__(self, path, ttl=DISCOVERY_TTL):
+        """
+        Load the listings, a missing or unreadable file is treated as empty
+            :param path: path to the cache file
+            :param ttl: seconds a listing is reused for
+            :type path: string
+            :type ttl: float
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.owners = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == DISCOVERY_VERSION:
+                self.owners = data['owners']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, key):
+        """
+        Get the listing if it is not older than the TTL
+            :param key: API URL and login of the owner
+            :type key: string
+            :returns: JSON of the repositories, None if not cached or expired
+            :rtype: list
+        """
+        with self.lock:
+            entry = self.owners.get(key)
+        if entry == None or time.time() - entry['time'] >= self.ttl:
+            return None
+        return entry['repos']
+
+    def put(self, key, repos):
+        """
+        Remember the listing of the owner listed just now
+            :param key: API URL and login of the owner
+            :param repos: JSON of the repositories
+            :type key: string
+            :type repos: list
+        """
+        with self.lock:
+            self.owners[key] = {'time': time.time(), 'repos': repos}
+
+    def save(self):
+        """
+        Write the listings to the file without the expired ones, the old file is replaced only when the new one is written completely
+        """
+        tmp = f'{self.path}.tmp'
+        now = time.time()
+        with self.lock:
+            self.owners = {k: v for k, v in self.owners.items() if now - v['time'] < self.ttl}
+            with open(tmp, 'w') as f:
+                json.dump({'version': DISCOVERY_VERSION, 'owners': self.owners}, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def discover_repos(reposlugs, session, jobs=1, cache=None, state='open', archived=False, forks=False, empty=False):
+    """
+    Replace the patterns among the reposlugs with the names of the matching repositories.
+    The owners are listed concurrently (and their pages prefetched), every owner only once.
+        :param reposlugs: list of repo names ('owner/reponame') and patterns ('owner/*')
+        :param session: open and authenticated session
+        :param jobs: maximal number of owners listed at once
+        :param cache: cache of the listings, None to always list the owners
+        :param state: state of the labeled pull requests, see filter_repos()
+        :param archived: flag indicating that the archived repositories should be kept
+        :param forks: flag indicating that the forks should be kept
+        :param empty: flag indicating that the repositories with no open pull requests should be kept
+        :type reposlugs: list of strings
+        :type session: requests.Session()
+        :type jobs: int
+        :type cache: DiscoveryCache
+        :type state: string
+        :type archived: bool
+        :type forks: bool
+        :type empty: bool
+        :returns: repo names with the patterns expanded in place (sorted by name, without the repos already given)
+                  and statistics of the discovery
+        :rtype: tuple
+    """
+    start = time.perf_counter()
+    api_url = get_api_url(session)
+    owners = list(dict.fromkeys(r.split('/')[0].lower() for r in reposlugs if is_pattern(r)))
+    listings = {}
+    stats = {'patterns': 0, 'listed': 0, 'cached': 0, 'repos': 0, 'skipped': 0}
+    to_list = []
+    for owner in owners:
+        repos = cache.get(f'{api_url} {owner}') if cache != None else None
+        if repos != None:
+            listings[owner] = repos
+            stats['cached'] += 1
+        else:
+            to_list.append(owner)
+
+    if len(to_list) != 0:
+        with ThreadPoolExecutor(max_workers=min(jobs, len(to_list))) as pool:
+            futures = [pool.submit(list_owner_repos, owner, session) for owner in to_list]
+            for owner, future in zip(to_list, futures):
+                try:
+                    listings[owner] = future.result()
+                except (PageError, requests.exceptions.RequestException) as e:
+                    print(f'Repositories of {owner} could not be listed: {e}', file=sys.stderr)
+                    continue
+                stats['listed'] += 1
+                if cache != None:
+                    cache.put(f'{api_url} {owner}', listings[owner])
+
+    ret = []
+    seen = {r.lower() for r in reposlugs if not is_pattern(r)}
+    for r in reposlugs:
+        if not is_pattern(r):
+            ret.append(r)
+            continue
+        stats['patterns'] += 1
+        names, skipped = filter_repos(listings.get(r.split('/')[0].lower(), []), r, state, archived, forks, empty)
+        stats['skipped'] += skipped
+        for name in sorted(names, key=str.lower):
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                ret.append(name)
+                stats['repos'] += 1
+    stats['seconds'] = time.perf_counter() - start
+    return ret, stats
@@ -7,19 +7,38 @@ import json
 import fnmatch
 import configparser
 import sys
+import os
+import re
+import queue
+import threading
+import time
+import contextlib
+import hashlib
+import collections
+import itertools
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from filabel.metrics import caller_scope
+
 
 """
-GitHub authorization token
+Base URL of the GitHub API used when no other is configured
 """
-token = 'abc'
+API_URL = 'https://api.github.com'
 
 
-def token_auth(req):
+def token_auth(token):
     """
-    Helper function for the GitHub session
+    Create the authorization helper for the GitHub session
+        :param token: GitHub token
+        :type token: string
+        :returns: function setting the Authorization header of a request
+        :rtype: function
     """
-    req.headers['Authorization'] = f'token {token}'
-    return req
+    def auth(req):
+        req.headers['Authorization'] = f'token {token}'
+        return req
+    return auth
 
 
 def get_auth(f):
@@ -44,26 +63,389 @@ def get_auth(f):
     return ret
 
 
-def create_session(config_auth, s=None, t=None):
+class GitHubAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter used by the GitHub sessions. If it has a cache,
+    GET requests are sent as conditional requests and 304 responses are answered from the cache.
+    If it has a rate limiter, all the requests are scheduled by it and rate limited requests are retried.
+    If it has metrics, the duration and status of every request sent to GitHub are recorded.
+    """
+
+    def __init__(self, cache=None, limiter=None, metrics=None, **kwargs):
+        """
+        Create the adapter
+            :param cache: HTTP cache, None to not cache the responses
+            :param limiter: rate limit scheduler, None to not schedule the requests
+            :param metrics: metrics of the requests, None to not record them
+            :param kwargs: arguments of requests.adapters.HTTPAdapter
+            :type cache: filabel.cache.HTTPCache
+            :type limiter: filabel.ratelimit.RateLimiter
+            :type metrics: filabel.metrics.Metrics
+        """
+        self.cache = cache
+        self.limiter = limiter
+        self.metrics = metrics
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """
+        Send the request, see requests.adapters.HTTPAdapter.send()
+        """
+        if self.limiter == None:
+            return self.send_cached(request, **kwargs)
+        attempt = 0
+        while True:
+            self.limiter.acquire(request.url)
+            resp = self.send_cached(request, **kwargs)
+            text = resp.text if resp.status_code in (403, 429) else None
+            if self.limiter.update(request.url, resp.status_code, resp.headers, text, attempt) == None:
+                return resp
+            # The limiter makes the next acquire() wait before the retry
+            attempt += 1
+
+    def send_cached(self, request, **kwargs):
+        """
+        Send the request, answer it from the cache if GitHub says it was not modified
+        """
+        if self.cache == None or request.method != 'GET':
+            return self.send_measured(request, **kwargs)
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry != None:
+            if 'ETag' in entry['headers']:
+                request.headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                request.headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        resp = self.send_measured(request, **kwargs)
+        if entry != None and resp.status_code == 304:
+            self.cache.hit(key)
+            resp.status_code = 200
+            resp.reason = 'OK'
+            resp.headers.update(entry['headers'])
+            resp._content = entry['body']
+            return resp
+        if resp.status_code == 200 and ('ETag' in resp.headers or 'Last-Modified' in resp.headers):
+            self.cache.put(key, request.url, resp.headers, resp.content)
+        else:
+            self.cache.miss()
+        return resp
+
+    def send_measured(self, request, **kwargs):
+        """
+        Send the request to GitHub, record its duration, status and size if the adapter has metrics
+        """
+        if self.metrics == None:
+            return super().send(request, **kwargs)
+        start = time.perf_counter()
+        try:
+            resp = super().send(request, **kwargs)
+            size = len(resp.content)
+        except requests.exceptions.RequestException:
+            self.metrics.record_request(request.method, request.url, 'error', time.perf_counter() - start)
+            raise
+        self.metrics.record_request(request.method, request.url, resp.status_code, time.perf_counter() - start, size)
+        return resp
+
+
+def get_api_url(session=None):
+    """
+    Get the base URL of the GitHub API: the one of the session, FILABEL_API_URL or https://api.github.com
+        :param session: session with optional api_url attribute
+        :type session: requests.Session()
+        :returns: base URL without the trailing slash
+        :rtype: string
+    """
+    url = getattr(session, 'api_url', None) or os.getenv('FILABEL_API_URL') or API_URL
+    return url.rstrip('/')
+
+
+def create_session(config_auth, s=None, t=None, pool_size=None, cache=None, limiter=None, api_url=None, metrics=None):
     """
     Create session using the access token
         :param config_auth: configuration file containing credentials
         :param s: debug param
         :param t: debug param
+        :param pool_size: number of connections kept open to GitHub, requests default if None
+        :param cache: HTTP cache for conditional requests, None to not cache
+        :param limiter: rate limit scheduler of the requests, None to not schedule them
+        :param api_url: base URL of the GitHub API, see get_api_url() if None
+        :param metrics: metrics of the requests, None to not record them
         :type config_auth: file
+        :type pool_size: int
+        :type cache: filabel.cache.HTTPCache
+        :type limiter: filabel.ratelimit.RateLimiter
+        :type api_url: string
+        :type metrics: filabel.metrics.Metrics
         :returns: open GitHub session, False if something went wrong
         :rtype: requests.Session(), bool
     """
-    global token
     token = t or get_auth(config_auth)
     if token == False:
         return False
     session = s or requests.Session()
     session.headers = {'User-Agent': 'soucevi1'}
-    session.auth = token_auth
+    session.auth = token_auth(token)
+    session.api_url = api_url
+    pool_size = pool_size or requests.adapters.DEFAULT_POOLSIZE
+    adapter = GitHubAdapter(cache, limiter, metrics, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     return session
 
 
+class SessionPool:
+    """
+    Thread-safe pool of open GitHub sessions that are reused across requests,
+    so the connections to GitHub are kept alive
+    """
+
+    def __init__(self, token, size=10, connections=4, cache=None, limiter=None, metrics=None):
+        """
+        Create an empty pool
+            :param token: GitHub token of the sessions
+            :param size: maximal number of idle sessions kept open
+            :param connections: number of connections kept open by one session
+            :param cache: HTTP cache used by the sessions, None to not cache
+            :param limiter: rate limit scheduler used by the sessions, None to not schedule the requests
+            :param metrics: metrics of the requests of the sessions, None to not record them
+            :type token: string
+            :type size: int
+            :type connections: int
+            :type cache: filabel.cache.HTTPCache
+            :type limiter: filabel.ratelimit.RateLimiter
+            :type metrics: filabel.metrics.Metrics
+        """
+        self.token = token
+        self.cache = cache
+        self.limiter = limiter
+        self.metrics = metrics
+        self.size = size
+        self.connections = connections
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Borrow a session from the pool, a new one is opened if there is no idle session
+            :returns: context manager giving open GitHub session
+            :rtype: contextmanager
+        """
+        try:
+            s = self.idle.get_nowait()
+            with self.lock:
+                self.hits += 1
+        except queue.Empty:
+            s = create_session(None, t=self.token, pool_size=self.connections, cache=self.cache,
+                limiter=self.limiter, metrics=self.metrics)
+            with self.lock:
+                self.misses += 1
+        try:
+            yield s
+        finally:
+            if self.idle.qsize() < self.size:
+                self.idle.put(s)
+            else:
+                s.close()
+
+    def stats(self):
+        """
+        Get usage statistics of the pool
+            :returns: number of reused sessions ('hits'), newly opened sessions ('misses') and idle sessions
+            :rtype: dictionary
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'idle': self.idle.qsize(), 'size': self.size}
+
+    def close(self):
+        """
+        Close all the idle sessions
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+"""
+Maximal number of items on one page of a GitHub listing
+"""
+PER_PAGE = 100
+
+"""
+Maximal number of pages of one listing fetched at the same time
+"""
+PREFETCH = 4
+
+"""
+Default maximal number of paths remembered by LabelMemo
+"""
+LABEL_MEMO_SIZE = 10000
+
+"""
+Default maximal number of pull requests remembered by PullFilesCache
+"""
+PULL_FILES_CACHE_SIZE = 1000
+
+"""
+Maximal number of files GitHub lists in a comparison of two commits
+"""
+COMPARE_MAX_FILES = 300
+
+
+class PageError(Exception):
+    """
+    Raised when one of the pages could not be fetched
+    """
+    def __init__(self, status, url):
+        super().__init__(f'Response code: {status} from {url}')
+        self.status = status
+        self.url = url
+
+
+def get_next_page(headers):
+    """
+    Get the URL of the next page of a GitHub listing from the Link header
+        :param headers: headers of the response
+        :type headers: dictionary
+        :returns: URL of the next page, None if this is the last one
+        :rtype: string
+    """
+    if 'Link' not in headers:
+        return None
+    for l in requests.utils.parse_header_links(headers['Link']):
+        if l['rel'] == 'next':
+            return l['url']
+    return None
+
+
+def get_page_urls(headers):
+    """
+    Get the URLs of all the remaining pages of a GitHub listing from the next and last links of the Link header
+        :param headers: headers of the response
+        :type headers: dictionary
+        :returns: URLs of the remaining pages in order, None if they cannot be numbered
+        :rtype: list
+    """
+    if 'Link' not in headers:
+        return None
+    links = {l['rel']: l['url'] for l in requests.utils.parse_header_links(headers['Link'])}
+    if 'next' not in links or 'last' not in links:
+        return None
+    first = urllib.parse.parse_qs(urllib.parse.urlparse(links['next']).query).get('page')
+    last_url = urllib.parse.urlparse(links['last'])
+    query = urllib.parse.parse_qs(last_url.query)
+    if first == None or 'page' not in query:
+        return None
+    urls = []
+    for page in range(int(first[0]), int(query['page'][0]) + 1):
+        query['page'] = [str(page)]
+        urls.append(last_url._replace(query=urllib.parse.urlencode(query, doseq=True)).geturl())
+    return urls
+
+
+def get_page(session, url):
+    """
+    Get one page of a GitHub listing
+        :param session: open and authenticated session
+        :param url: URL of the page
+        :type session: requests.Session()
+        :type url: string
+        :returns: JSON of the page
+        :rtype: list
+        :raises PageError: if the page could not be fetched
+    """
+    ret = session.get(url)
+    if ret.status_code != 200:
+        raise PageError(ret.status_code, url)
+    return ret.json()
+
+
+def iter_prefetched(session, urls, prefetch):
+    """
+    Fetch the pages at the same time and go through them in order,
+    at most prefetch pages are being fetched or waiting to be processed
+        :param session: open and authenticated session
+        :param urls: URLs of the pages
+        :param prefetch: maximal number of pages fetched at the same time
+        :type session: requests.Session()
+        :type urls: list
+        :type prefetch: int
+        :returns: generator of the JSON pages
+        :rtype: generator
+        :raises PageError: if a page could not be fetched
+    """
+    urls = iter(urls)
+    # The pages are fetched in the metrics scope of the caller
+    run = caller_scope()
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        futures = collections.deque(pool.submit(run, get_page, session, u)
+            for u in itertools.islice(urls, prefetch))
+        try:
+            while len(futures) != 0:
+                page = futures.popleft().result()
+                for u in itertools.islice(urls, 1):
+                    futures.append(pool.submit(run, get_page, session, u))
+                yield page
+        finally:
+            # Listing stopped early or failed, the pages not being fetched yet are not needed
+            for f in futures:
+                f.cancel()
+
+
+def iter_pages(session, url, params=None, prefetch=0):
+    """
+    Go through all the pages of a GitHub listing following the Link header
+        :param session: open and authenticated session
+        :param url: URL of the first page
+        :param params: query parameters of the first page, per_page is set to the maximum
+        :param prefetch: maximal number of the remaining pages fetched at the same time when the last page is known,
+                         0 to fetch a page only when the previous one was processed
+        :type session: requests.Session()
+        :type url: string
+        :type params: dictionary
+        :type prefetch: int
+        :returns: generator of the JSON pages
+        :rtype: generator
+        :raises PageError: if a page could not be fetched
+    """
+    params = dict(params or {}, per_page=PER_PAGE)
+    while url != None:
+        ret = session.get(url, params=params)
+        if ret.status_code != 200:
+            raise PageError(ret.status_code, url)
+        yield ret.json()
+        urls = get_page_urls(ret.headers) if prefetch > 0 else None
+        if urls != None:
+            yield from iter_prefetched(session, urls, prefetch)
+            return
+        # The next page URL already contains all the parameters
+        url = get_next_page(ret.headers)
+        params = None
+
+
+def iter_items(session, url, params=None, prefetch=0):
+    """
+    Go through all the items of a GitHub listing as the pages arrive
+        :param session: open and authenticated session
+        :param url: URL of the first page
+        :param params: query parameters of the first page
+        :param prefetch: maximal number of pages fetched at the same time, see iter_pages()
+        :type session: requests.Session()
+        :type url: string
+        :type params: dictionary
+        :type prefetch: int
+        :returns: generator of the items
+        :rtype: generator
+        :raises PageError: if a page could not be fetched
+    """
+    for page in iter_pages(session, url, params, prefetch):
+        yield from page
+
+
 def get_pr_files(r, session, pull_num):
     """
     Get list containing all the files that are modified in the current pull request
@@ -76,65 +458,274 @@ def get_pr_files(r, session, pull_num):
         :returns: list of files contained in the pull requests
         :rtype: list
     """
-    pull_files = session.get(f'https://api.github.com/repos/{r}/pulls/{pull_num}/files')
-    if pull_files.status_code != 200:
-        print(f'Response code: {pull_files.status_code} from https://api.github.com/repos/{r}/pulls/{pull_num}/files', file=sys.stderr)
+    try:
+        return get_pr_filenames(iter_items(session, f'{get_api_url(session)}/repos/{r}/pulls/{pull_num}/files',
+            prefetch=PREFETCH))
+    except PageError as e:
+        print(e, file=sys.stderr)
         return False
-    flist = get_pr_filenames(pull_files.json())
-
-    lasturl = 'abc'
-    if 'Link' not in pull_files.headers:
-        return flist
-
-    while True:
-        links = requests.utils.parse_header_links(pull_files.headers['Link'])
-        n_flag = False
-        for l in links:
-            if l['rel'] == 'next':
-                pull_files = session.get(l['url'])
-                if pull_files.status_code != 200:
-                    print(f'Response code: {pull_files.status_code} from https://api.github.com/repos/{r}/pulls/{pull_num}/files', file=sys.stderr)
-                    return False
-                n_flag = True
-                break
-        if n_flag == False:
-            break
-        flist += get_pr_filenames(pull_files.json())        
-    return flist
 
 
+def get_delta_paths(cj):
+    """
+    Get the paths changed between two commits of the PR, if they can only add files to the PR
+        :param cj: JSON of the comparison of the two commits
+        :type cj: JSON
+        :returns: list of added paths, None if the delta is ambiguous
+                  (force push, merge commits, modified, removed or renamed files, list of files cut by GitHub)
+        :rtype: list
+    """
+    if cj.get('status') != 'ahead':
+        return None
+    # A merge (e.g. "Update branch" merging the base into the PR) brings in the files changed on the base
+    if any(len(c.get('parents', [])) > 1 for c in cj.get('commits', [])):
+        return None
+    files = cj.get('files', [])
+    if len(files) >= COMPARE_MAX_FILES:
+        return None
+    # A modified file may be reverted to its content on the base, removed or renamed paths may drop out of the PR,
+    # all of them together with their labels
+    if any(f['status'] != 'added' for f in files):
+        return None
+    return get_pr_filenames(files)
+
+
+def get_pr_delta(r, session, base, head):
+    """
+    Get the paths changed in the PR since the given commit
+        :param r: string 'author/repo-name'
+        :param session: open and authenticated session
+        :param base: SHA of the older head of the PR
+        :param head: SHA of the current head of the PR
+        :type r: string
+        :type session: requests.Session()
+        :type base: string
+        :type head: string
+        :returns: list of changed paths, None if they cannot be used instead of listing all the files
+        :rtype: list
+    """
+    ret = session.get(f'{get_api_url(session)}/repos/{r}/compare/{base}...{head}')
+    if ret.status_code != 200:
+        return None
+    return get_delta_paths(ret.json())
+
+
+class PullFilesCache:
+    """
+    Bounded cache of the files of the recently labeled pull requests shared by all the threads,
+    the least recently labeled pull requests are forgotten first
+    """
+
+    def __init__(self, size=PULL_FILES_CACHE_SIZE):
+        """
+        Create an empty cache
+            :param size: maximal number of remembered pull requests
+            :type size: int
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.pulls = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def get(self, key):
+        """
+        Get the files of the pull request
+            :param key: repository name and number of the pull request
+            :type key: tuple
+            :returns: SHA of the head the files belong to, set of the paths and the base they were listed against,
+                      None if not cached
+            :rtype: tuple
+        """
+        with self.lock:
+            return self.pulls.get(key)
+
+    def put(self, key, sha, paths, base=None):
+        """
+        Remember the files of the pull request
+            :param key: repository name and number of the pull request
+            :param sha: SHA of the head the files belong to
+            :param paths: paths of the files
+            :param base: ref and SHA of the base branch the files were listed against
+            :type key: tuple
+            :type sha: string
+            :type paths: set
+            :type base: tuple
+        """
+        with self.lock:
+            self.pulls[key] = (sha, frozenset(paths), base)
+            self.pulls.move_to_end(key)
+            if len(self.pulls) > self.size:
+                self.pulls.popitem(last=False)
+
+    def count(self, kind):
+        """
+        Count how the files of a pull request were found out
+            :param kind: 'delta', 'cold' (not cached), 'ambiguous' or 'full' listing
+            :type kind: string
+        """
+        with self.lock:
+            self.counts[kind] += 1
+
+    def stats(self):
+        """
+        Get usage statistics of the cache
+            :returns: number of remembered pull requests, maximal size and counts of the ways the files were found out
+            :rtype: dictionary
+        """
+        with self.lock:
+            ret = {k: self.counts[k] for k in ('delta', 'cold', 'ambiguous', 'full')}
+            ret['entries'] = len(self.pulls)
+            ret['size'] = self.size
+            return ret
+
 
 def get_pr_filenames(fj):
     """
     Parse filenames from file json
         :param fj: pull requests files JSON
-        :type fj: JSON
+        :type fj: JSON, iterable
         :returns: list of filenames from one pull request
         :rtype: list
     """
     fns = []
-    for i in range(len(fj)):
-        fns.append(fj[i]['filename'])
+    for f in fj:
+        fns.append(f['filename'])
     return fns
 
 
 
-def get_all_labels(filenames, pattern_dict):
+def compile_label_patterns(pattern_dict):
+    """
+    Compile the labeling rules into one regular expression per label
+        :param pattern_dict: rules for labeling
+        :type pattern_dict: dictionary
+        :returns: list of (label, compiled regex) pairs in the order of the rules
+        :rtype: list
+    """
+    ret = []
+    for entry in pattern_dict:
+        patts = [fnmatch.translate(os.path.normcase(p)) for p in pattern_dict[entry]]
+        if len(patts) == 0:
+            continue
+        ret.append((entry, re.compile('|'.join(f'(?:{p})' for p in patts))))
+    return ret
+
+
+def config_hash(pattern_dict, delete_old=True):
+    """
+    Get the hash of the labeling rules, the labels change when it changes
+        :param pattern_dict: parsed labeling rules
+        :param delete_old: flag indicating that old unused labels are deleted from the PR
+        :type pattern_dict: dictionary
+        :type delete_old: bool
+        :returns: hex digest of the rules
+        :rtype: string
+    """
+    rules = json.dumps({'labels': pattern_dict, 'delete_old': delete_old}, sort_keys=True)
+    return hashlib.sha256(rules.encode()).hexdigest()
+
+
+class LabelMemo:
+    """
+    Bounded memo of the labels matching single paths shared by all the threads,
+    the least recently used paths are forgotten first
+    """
+
+    def __init__(self, size=LABEL_MEMO_SIZE):
+        """
+        Create an empty memo
+            :param size: maximal number of remembered paths
+            :type size: int
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.labels = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path_labels(self, key, path, compiled):
+        """
+        Get the labels matching the path
+            :param key: hash of the labeling rules from config_hash()
+            :param path: path of the file
+            :param compiled: labeling rules compiled by compile_label_patterns()
+            :type key: string
+            :type path: string
+            :type compiled: list
+            :returns: matching labels in the order of the rules
+            :rtype: tuple
+        """
+        with self.lock:
+            ret = self.labels.get((key, path))
+            if ret != None:
+                self.hits += 1
+                self.labels.move_to_end((key, path))
+                return ret
+            self.misses += 1
+        fn = os.path.normcase(path)
+        ret = tuple(entry for entry, regex in compiled if regex.match(fn))
+        with self.lock:
+            self.labels[(key, path)] = ret
+            if len(self.labels) > self.size:
+                self.labels.popitem(last=False)
+        return ret
+
+    def stats(self):
+        """
+        Get usage statistics of the memo
+            :returns: hits, misses, hit ratio, number of remembered paths and maximal size
+            :rtype: dictionary
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total != 0 else 0.0,
+                'entries': len(self.labels),
+                'size': self.size,
+            }
+
+
+def get_all_labels(filenames, pattern_dict, memo=None, key=None):
     """
     Get labels to add to the PR
         :param filenames: list of filenams
-        :param patern_dict: rules for labeling
+        :param patern_dict: rules for labeling, either parsed or already compiled by compile_label_patterns()
+        :param memo: memo of the labels of single paths, None to match every path
+        :param key: hash of the labeling rules from config_hash(), needed with memo
         :type filnames: list
-        :type pattern_dict: dictionary
+        :type pattern_dict: dictionary, list
+        :type memo: LabelMemo
+        :type key: string
         :returns: list of labels belonging to the pull request
         :rtype: list
     """
+    if isinstance(pattern_dict, dict):
+        pattern_dict = compile_label_patterns(pattern_dict)
+    # The same path can be listed more than once (e.g. renamed files)
+    filenames = dict.fromkeys(filenames)
+    if memo != None:
+        ret = []
+        for fn in filenames:
+            if len(ret) == len(pattern_dict):
+                break
+            ret += [entry for entry in memo.get_path_labels(key, fn, pattern_dict) if entry not in ret]
+        return ret
     ret = []
+    remaining = list(pattern_dict)
     for fn in filenames:
-        for entry in pattern_dict:
-            for i in range(len(pattern_dict[entry])):
-                if (fnmatch.fnmatch(fn, pattern_dict[entry][i])) and (entry not in ret):
-                    ret.append(entry)              
+        if len(remaining) == 0:
+            break
+        fn = os.path.normcase(fn)
+        # Labels that already matched are not tried again
+        left = []
+        for entry, regex in remaining:
+            if regex.match(fn):
+                ret.append(entry)
+            else:
+                left.append((entry, regex))
+        remaining = left
     return ret
 
 
@@ -185,28 +776,142 @@ def get_unknown_labels_to_keep(labels_curr, pattern_dict):
 
 
 
-def add_labels(repo, pull_num, labels, session):
+"""
+Number of single label requests (one POST adding labels, one DELETE per removed label)
+that is still cheaper than replacing the whole list of labels
+"""
+SMALL_CHANGE = 1
+
+
+def plan_label_changes(labels_new, labels_current, pattern_dict, delete_old=True):
+    """
+    Compute what has to change on the PR to get the matching labels
+        :param labels_new: labels matching the files of the PR
+        :param labels_current: labels the PR has now
+        :param pattern_dict: rules for labeling
+        :param delete_old: flag indicating that known labels that do not match anymore should be removed
+        :type labels_new: list
+        :type labels_current: list
+        :type pattern_dict: dictionary
+        :type delete_old: bool
+        :returns: sets of labels under 'add', 'remove', 'keep' (matching labels already there) and 'final'
+        :rtype: dictionary
+    """
+    new = set(labels_new)
+    current = set(labels_current)
+    remove = set()
+    if delete_old:
+        remove = {l for l in current if l in pattern_dict} - new
+    return {
+        'add': new - current,
+        'remove': remove,
+        'keep': new & current,
+        'final': (current - remove) | (new - current),
+    }
+
+
+def plan_is_noop(plan):
+    """
+    Find out whether the plan changes anything
+        :param plan: plan from plan_label_changes()
+        :type plan: dictionary
+        :returns: True if there is nothing to add or remove
+        :rtype: bool
+    """
+    return len(plan['add']) == 0 and len(plan['remove']) == 0
+
+
+def plan_is_small(plan):
+    """
+    Find out whether the plan should be applied by single label requests
+        :param plan: plan from plan_label_changes()
+        :type plan: dictionary
+        :returns: True if adding and removing single labels takes at most SMALL_CHANGE requests
+        :rtype: bool
+    """
+    requests_needed = len(plan['remove'])
+    if len(plan['add']) != 0:
+        requests_needed += 1
+    return requests_needed <= SMALL_CHANGE
+
+
+def apply_label_plan(repo, pull_num, plan, session, strict=False):
+    """
+    Change the labels of the PR according to the plan, nothing is sent if there is no change
+        :param repo: repository
+        :param pull_num: number of pull request
+        :param plan: plan from plan_label_changes()
+        :param session: open Github session
+        :param strict: check the labels with another GET request instead of the responses
+        :type repo: string
+        :type pull_num: int
+        :type plan: dictionary
+        :type session: requests.Session
+        :type strict: bool
+        :returns: True if labels were changed successfully, False otherwise
+        :rtype: bool
+    """
+    if plan_is_noop(plan):
+        return True
+    if not plan_is_small(plan):
+        return add_labels(repo, pull_num, list(plan['final']), session, strict)
+    url = f'{get_api_url(session)}/repos/{repo}/issues/{pull_num}/labels'
+    llist = None
+    if len(plan['add']) != 0:
+        ret = session.post(url, data=json.dumps({'labels': sorted(plan['add'])}))
+        if ret.status_code != 200:
+            return False
+        llist = get_label_names(ret.json())
+    for l in sorted(plan['remove']):
+        ret = session.delete(f'{url}/{requests.utils.quote(l, safe="")}')
+        if ret.status_code != 200:
+            return False
+        llist = get_label_names(ret.json())
+    if strict:
+        return test_labels_added(repo, pull_num, list(plan['final']), session)
+    return check_plan_applied(plan, llist)
+
+
+def check_plan_applied(plan, llist):
+    """
+    Check the labels returned by GitHub after single label requests
+        :param plan: plan from plan_label_changes()
+        :param llist: labels of the PR returned by the last request
+        :type plan: dictionary
+        :type llist: list
+        :returns: True if all the added labels are there and none of the removed ones
+        :rtype: bool
+    """
+    # Other labels may have been changed by someone else meanwhile, they are not checked
+    llist = set(llist)
+    return plan['add'] <= llist and len(plan['remove'] & llist) == 0
+
+
+def add_labels(repo, pull_num, labels, session, strict=False):
     """
     Add all the labels to the PR
         :param repo: repository
         :param pull_num: number of pull request
         :param labels: labels to add
         :param session: open Github session
+        :param strict: check the labels with another GET request instead of the PUT response
         :type repo: string
         :type pull_num: int
         :type labels: list
         :type session: requests.Session
+        :type strict: bool
         :returns: True if labels added successfully, False otherwise
         :rtype: bool
     """
     params = json.dumps(labels)
-    ret = session.put(f'https://api.github.com/repos/{repo}/issues/{pull_num}/labels', 
+    ret = session.put(f'{get_api_url(session)}/repos/{repo}/issues/{pull_num}/labels', 
         data=params)
     if ret.status_code != 200:
         return False
-    if test_labels_added(repo, pull_num, labels, session) == False:
-        return False
-    return True
+    if strict:
+        return test_labels_added(repo, pull_num, labels, session)
+    # GitHub answers with the resulting labels of the issue
+    return set(get_label_names(ret.json())) == set(labels)
 
 
 def get_current_labels(lj):
@@ -237,36 +942,18 @@ def test_labels_added(repo, pull_num, labels, session):
         :returns: True if labels are correct, False oherwise
         :rtype: bool
     """
-    ret = session.get(f'https://api.github.com/repos/{repo}/issues/{pull_num}/labels')
-    if ret.status_code != 200:
-        return False
-
-    llist = get_label_names(ret.json())
-
-    if 'Link' in ret.headers:
-        while True:
-            links = requests.utils.parse_header_links(ret.headers['Link'])
-            n_flag = False
-            for l in links:
-                if l['rel'] == 'next':
-                    ret = session.get(l['url'])
-                    if ret.status_code != 200:
-                        return False
-                    n_flag = True
-                    break
-            llist += get_label_names(ret.json())
-            if n_flag == False:
-                break    
-    if set(llist) != set(labels):
+    try:
+        llist = get_label_names(iter_items(session, f'{get_api_url(session)}/repos/{repo}/issues/{pull_num}/labels'))
+    except PageError:
         return False
-    return True
+    return set(llist) == set(labels)
 
 
 def get_label_names(l_json):
     """
     Get names of all the labels in given json
         :param l_json: list of labels jsons
-        :type l_json: list
+        :type l_json: list, iterable
         :returns: list of labels names
         :rtype: list
     """
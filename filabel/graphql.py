@@ -0,0 +1,188 @@
+"""
+GraphQL backend of filabel. Gets the numbers, labels and changed files of many pull requests in one query
+instead of one REST request per pull request.
+"""
+
+import json
+import sys
+from filabel.github import get_api_url, PageError
+
+
+"""
+Path of the GraphQL endpoint under the base URL of the API
+"""
+GRAPHQL_PATH = '/graphql'
+
+"""
+GraphQL pull request states for the REST state filter
+"""
+STATES = {
+    'open': ['OPEN'],
+    'closed': ['CLOSED', 'MERGED'],
+    'all': ['OPEN', 'CLOSED', 'MERGED'],
+}
+
+PULLS_QUERY = '''
+query($owner: String!, $name: String!, $states: [PullRequestState!], $base: String, $cursor: String, $perPage: Int!,
+      $order: IssueOrder!) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $perPage, after: $cursor, states: $states, baseRefName: $base, orderBy: $order) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        headRefOid
+        updatedAt
+        labels(first: 100) { pageInfo { hasNextPage endCursor } nodes { name } }
+        files(first: 100) { pageInfo { hasNextPage endCursor } nodes { path } }
+      }
+    }
+  }
+}
+'''
+
+FILES_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      files(first: 100, after: $cursor) { pageInfo { hasNextPage endCursor } nodes { path } }
+    }
+  }
+}
+'''
+
+LABELS_QUERY = '''
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      labels(first: 100, after: $cursor) { pageInfo { hasNextPage endCursor } nodes { name } }
+    }
+  }
+}
+'''
+
+
+class QueryError(PageError):
+    """
+    Raised when a page of pull requests could not be fetched by a GraphQL query
+    """
+    def __init__(self, url):
+        Exception.__init__(self, f'GraphQL query failed: {url}')
+        self.status = None
+        self.url = url
+
+
+def run_query(session, query, variables, url=None):
+    """
+    Run one GraphQL query
+        :param session: open and authenticated session
+        :param query: GraphQL query
+        :param variables: variables of the query
+        :param url: GraphQL endpoint, GRAPHQL_PATH under the API URL of the session if None
+        :type session: requests.Session()
+        :type query: string
+        :type variables: dictionary
+        :type url: string
+        :returns: 'data' of the response, False if something went wrong
+        :rtype: dictionary, bool
+    """
+    url = url or get_api_url(session) + GRAPHQL_PATH
+    ret = session.post(url, data=json.dumps({'query': query, 'variables': variables}))
+    if ret.status_code != 200:
+        print(f'Response code: {ret.status_code} from {url}', file=sys.stderr)
+        return False
+    body = ret.json()
+    if (body.get('data') or {}).get('repository') == None:
+        # Missing repository is not an error worth printing, the same as 404 of the REST API
+        if any(e.get('type') != 'NOT_FOUND' for e in body.get('errors', [])):
+            print(f'GraphQL errors: {body["errors"]}', file=sys.stderr)
+        return False
+    return body['data']
+
+
+def get_rest_of_connection(session, query, variables, name, connection, key, url=None):
+    """
+    Get the remaining pages of a connection of one pull request (files or labels)
+        :param session: open and authenticated session
+        :param query: query getting the next page of the connection
+        :param variables: variables of the query without the cursor
+        :param name: name of the connection in the pull request
+        :param connection: already fetched first page of the connection
+        :param key: key of the value in the connection nodes
+        :param url: GraphQL endpoint, GRAPHQL_PATH under the API URL of the session if None
+        :type session: requests.Session()
+        :type query: string
+        :type variables: dictionary
+        :type name: string
+        :type connection: dictionary
+        :type key: string
+        :type url: string
+        :returns: values of all the nodes, False if something went wrong
+        :rtype: list, bool
+    """
+    ret = [n[key] for n in connection['nodes']]
+    page_info = connection['pageInfo']
+    while page_info['hasNextPage']:
+        data = run_query(session, query, dict(variables, cursor=page_info['endCursor']), url)
+        if data == False or data['repository']['pullRequest'] == None:
+            return False
+        connection = data['repository']['pullRequest'][name]
+        ret += [n[key] for n in connection['nodes']]
+        page_info = connection['pageInfo']
+    return ret
+
+
+def get_repo_prs_graphql(r, state, base, session, url=None, per_page=50, sort=None, stop=None):
+    """
+    Go through all pull requests of a given repository together with their labels and files as the pages arrive
+        :param r: repository name 'author/repo-name'
+        :param state: state of the PR (open, closed, all)
+        :param base: base branch
+        :param session: open and authenticated session
+        :param url: GraphQL endpoint, GRAPHQL_PATH under the API URL of the session if None
+        :param per_page: number of pull requests fetched in one query
+        :param sort: 'updated' to list the recently updated PRs first, None for the newest PRs first
+        :param stop: function telling that the listing can stop at the given PR, None to list all
+        :type r: string
+        :type state: string
+        :type base: string
+        :type session: requests.Session()
+        :type url: string
+        :type per_page: int
+        :type sort: string
+        :type stop: function
+        :returns: generator of the pull requests in the REST format ('number', 'labels', 'head', 'updated_at') with list of filenames under 'files' (False if they could not be fetched)
+        :rtype: generator
+        :raises QueryError: if a page of pull requests could not be fetched
+    """
+    owner, name = r.split('/')
+    url = url or get_api_url(session) + GRAPHQL_PATH
+    variables = {'owner': owner, 'name': name, 'states': STATES[state], 'base': base,
+        'cursor': None, 'perPage': per_page,
+        'order': {'field': 'UPDATED_AT' if sort == 'updated' else 'CREATED_AT', 'direction': 'DESC'}}
+    while True:
+        data = run_query(session, PULLS_QUERY, variables, url)
+        if data == False:
+            raise QueryError(url)
+        connection = data['repository']['pullRequests']
+        for node in connection['nodes']:
+            pull_vars = {'owner': owner, 'name': name, 'number': node['number']}
+            # Pull requests with huge lists of files or labels are paged one by one
+            labels = get_rest_of_connection(session, LABELS_QUERY, pull_vars, 'labels',
+                node['labels'], 'name', url)
+            if labels == False:
+                raise QueryError(url)
+            pull = {
+                'number': node['number'],
+                'labels': [{'name': l} for l in labels],
+                'head': {'sha': node['headRefOid']},
+                'updated_at': node['updatedAt'],
+            }
+            if stop != None and stop(pull):
+                return
+            # A pull request whose files could not be fetched fails alone, as with the REST backend
+            pull['files'] = get_rest_of_connection(session, FILES_QUERY, pull_vars, 'files',
+                node['files'], 'path', url)
+            yield pull
+        if not connection['pageInfo']['hasNextPage']:
+            return
+        variables['cursor'] = connection['pageInfo']['endCursor']
@@ -0,0 +1,207 @@
+"""
+Background processing of the webhook jobs used by the web module.
+"""
+
+import collections
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+class DeliveryLog:
+    """
+    IDs of the recent deliveries (X-GitHub-Delivery), so a redelivered webhook is processed only once
+    """
+
+    def __init__(self, remember=1000):
+        """
+        Create an empty log
+            :param remember: number of delivery IDs remembered
+            :type remember: int
+        """
+        self.remember = remember
+        self.lock = threading.Lock()
+        self.deliveries = collections.OrderedDict()
+
+    def add(self, delivery):
+        """
+        Remember the delivery, the oldest one is forgotten when there are too many
+            :param delivery: ID of the delivery
+            :type delivery: string
+            :returns: False if the delivery was seen already, True otherwise
+            :rtype: bool
+        """
+        with self.lock:
+            if delivery in self.deliveries:
+                return False
+            self.deliveries[delivery] = True
+            if len(self.deliveries) > self.remember:
+                self.deliveries.popitem(last=False)
+            return True
+
+    def discard(self, delivery):
+        """
+        Forget the delivery, e.g. when it was not processed, so it is processed when it is delivered again
+            :param delivery: ID of the delivery
+            :type delivery: string
+        """
+        with self.lock:
+            self.deliveries.pop(delivery, None)
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs processed by a fixed number of worker threads.
+    Jobs with an already seen delivery ID are ignored. Jobs with the same key
+    (e.g. one pull request) arriving within a time window are coalesced into
+    the latest one and two jobs with the same key never run at the same time.
+    """
+
+    def __init__(self, workers=4, size=100, remember=1000, window=0):
+        """
+        Create the queue, the worker threads are started with the first job
+            :param workers: number of worker threads
+            :param size: maximal number of jobs waiting in the queue
+            :param remember: number of delivery IDs remembered for deduplication
+            :param window: seconds a keyed job waits for newer jobs with the same key
+            :type workers: int
+            :type size: int
+            :type remember: int
+            :type window: float
+        """
+        self.workers = workers
+        self.size = size
+        self.window = window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.deliveries = DeliveryLog(remember)
+        self.pending = {}
+        # Number of the jobs waiting, a keyed job is counted once whether it is in the queue or not yet
+        self.waiting = 0
+        self.running = set()
+        self.threads = []
+        self.busy = 0
+        self.counts = {'accepted': 0, 'duplicate': 0, 'coalesced': 0, 'rejected': 0, 'done': 0, 'failed': 0}
+
+    def submit(self, func, *args, delivery=None, key=None):
+        """
+        Put a job to the queue
+            :param func: function to call, the job fails if it returns False or raises
+            :param args: arguments of the function
+            :param delivery: ID of the delivery (X-GitHub-Delivery), None if unknown
+            :param key: jobs with the same key are coalesced, None to always run the job
+            :type func: function
+            :type delivery: string
+            :type key: hashable
+            :returns: 'accepted', 'coalesced' (replaced a waiting job), 'duplicate' or 'rejected' if the queue is full
+            :rtype: string
+        """
+        with self.lock:
+            if delivery != None and not self.deliveries.add(delivery):
+                self.counts['duplicate'] += 1
+                return 'duplicate'
+            if key != None and key in self.pending:
+                # The waiting job runs with the newest arguments
+                self.pending[key] = (func, args)
+                ret = 'coalesced'
+            elif self.waiting >= self.size:
+                if delivery != None:
+                    self.deliveries.discard(delivery)
+                self.counts['rejected'] += 1
+                return 'rejected'
+            elif key != None:
+                self.pending[key] = (func, args)
+                self.waiting += 1
+                if key not in self.running:
+                    self.schedule(key)
+                ret = 'accepted'
+            else:
+                self.queue.put((func, args))
+                self.waiting += 1
+                ret = 'accepted'
+            self.counts[ret] += 1
+            if len(self.threads) == 0:
+                self.start()
+        return ret
+
+    def schedule(self, key):
+        """
+        Queue the pending job with the key after the coalescing window, must be called with the lock held
+            :param key: key of the job
+            :type key: hashable
+        """
+        if self.window <= 0:
+            self.queue.put((None, key))
+            return
+        t = threading.Timer(self.window, self.queue.put, ((None, key),))
+        t.daemon = True
+        t.start()
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, name=f'filabel-worker-{i}', daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        """
+        Main loop of a worker thread
+        """
+        while True:
+            func, args = self.queue.get()
+            key = None
+            with self.lock:
+                if func == None:
+                    # Coalesced job, take its newest arguments
+                    key = args
+                    func, args = self.pending.pop(key)
+                    self.running.add(key)
+                self.waiting -= 1
+                self.busy += 1
+            ok = False
+            try:
+                ok = func(*args) != False
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            with self.lock:
+                self.busy -= 1
+                self.counts['done' if ok else 'failed'] += 1
+                if key != None:
+                    self.running.discard(key)
+                    # Jobs that came while running are run once more
+                    if key in self.pending:
+                        self.schedule(key)
+            self.queue.task_done()
+
+    def wait(self):
+        """
+        Wait until all the queued jobs are processed, including the coalesced ones
+        """
+        while True:
+            self.queue.join()
+            with self.lock:
+                if len(self.pending) == 0 and len(self.running) == 0:
+                    return
+            time.sleep(0.01)
+
+    def stats(self):
+        """
+        Get the state of the queue
+            :returns: queue depth, busy workers, saturation (busy / workers), coalesced jobs waiting or running and job counts
+            :rtype: dictionary
+        """
+        with self.lock:
+            ret = dict(self.counts)
+            ret['depth'] = self.waiting
+            ret['size'] = self.size
+            ret['workers'] = self.workers
+            ret['busy'] = self.busy
+            ret['pending'] = len(self.pending)
+            ret['running'] = len(self.running)
+            ret['saturation'] = self.busy / self.workers
+        return ret
@@ -0,0 +1,358 @@
+"""
+Metrics of the web application exposed in the Prometheus text format.
+Recording a value only updates a few numbers under a lock, the text is rendered only when the metrics are scraped.
+"""
+
+import bisect
+import collections
+import contextlib
+import math
+import re
+import threading
+import time
+import urllib.parse
+try:
+    import contextvars
+except ImportError:
+    # Python 3.6, the scope is kept per thread, see ThreadScope
+    contextvars = None
+
+
+"""
+Content type of the Prometheus text format
+"""
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+"""
+Upper bounds of the histogram buckets of durations in seconds
+"""
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+"""
+Upper bounds of the histogram buckets of counts (pages and files of a pull request)
+"""
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 300, 1000, 3000)
+
+"""
+Recorded metrics: name -> (type, help, label names, histogram buckets)
+"""
+METRICS = {
+    'filabel_stage_seconds': ('histogram', 'Duration of the stages of handling a webhook.',
+        ('stage',), TIME_BUCKETS),
+    'filabel_stage_failures_total': ('counter', 'Number of failed stages of handling a webhook.',
+        ('stage',), None),
+    'filabel_github_requests_total': ('counter', 'Number of GitHub API requests by endpoint and status.',
+        ('method', 'endpoint', 'status'), None),
+    'filabel_github_request_seconds': ('histogram', 'Duration of the GitHub API requests by endpoint.',
+        ('method', 'endpoint'), TIME_BUCKETS),
+    'filabel_github_response_bytes_total': ('counter', 'Size of the bodies of the GitHub API responses by endpoint.',
+        ('method', 'endpoint'), None),
+    'filabel_pull_pages': ('histogram', 'Number of pages of files (or commit comparisons) fetched per pull request.',
+        (), COUNT_BUCKETS),
+    'filabel_pull_files': ('histogram', 'Number of files of the labeled pull requests.',
+        (), COUNT_BUCKETS),
+    'filabel_labels_changed_total': ('counter', 'Number of labels added to and removed from pull requests.',
+        ('change',), None),
+}
+
+"""
+Paths of the GitHub API and the endpoints they are counted to, so the number of series does not grow with the repositories
+"""
+ENDPOINTS = [
+    (re.compile(r'/repos/[^/]+/[^/]+/pulls/\d+/files$'), '/repos/:owner/:repo/pulls/:number/files'),
+    (re.compile(r'/repos/[^/]+/[^/]+/pulls$'), '/repos/:owner/:repo/pulls'),
+    (re.compile(r'/repos/[^/]+/[^/]+/compare/[^/]+$'), '/repos/:owner/:repo/compare/:basehead'),
+    (re.compile(r'/repos/[^/]+/[^/]+/issues/\d+/labels/[^/]+$'), '/repos/:owner/:repo/issues/:number/labels/:name'),
+    (re.compile(r'/repos/[^/]+/[^/]+/issues/\d+/labels$'), '/repos/:owner/:repo/issues/:number/labels'),
+    (re.compile(r'/orgs/[^/]+/repos$'), '/orgs/:org/repos'),
+    (re.compile(r'/users/[^/]+/repos$'), '/users/:username/repos'),
+    (re.compile(r'/user$'), '/user'),
+    (re.compile(r'/graphql$'), '/graphql'),
+]
+
+class ThreadScope:
+    """
+    Replacement of contextvars.ContextVar on Python 3.6 keeping the value per thread,
+    the coroutines running on one thread share it
+    """
+
+    def __init__(self):
+        """
+        Create the variable, its value is None in every thread
+        """
+        self.local = threading.local()
+
+    def get(self):
+        """
+        Get the value of the calling thread
+            :returns: the value, None if it was not set
+            :rtype: object
+        """
+        return getattr(self.local, 'value', None)
+
+    def set(self, value):
+        """
+        Set the value of the calling thread
+            :param value: new value
+            :type value: object
+            :returns: token to pass to reset(), the previous value
+            :rtype: object
+        """
+        token = self.get()
+        self.local.value = value
+        return token
+
+    def reset(self, token):
+        """
+        Set the value back to the one before set()
+            :param token: token from set()
+            :type token: object
+        """
+        self.local.value = token
+
+
+"""
+Counter of the successful (or not modified) GitHub requests per endpoint of the current scope, see Metrics.scope()
+"""
+current_scope = contextvars.ContextVar('filabel_metrics_scope', default=None) if contextvars != None else ThreadScope()
+
+
+def caller_scope():
+    """
+    Get a function running other functions in the current scope, used to count the requests of helper threads
+    (e.g. prefetching pages) to the scope of the thread they work for
+        :returns: function called with the function to run and its arguments, returning its result
+        :rtype: function
+    """
+    if contextvars != None:
+        context = contextvars.copy_context()
+        return lambda func, *args: context.copy().run(func, *args)
+    calls = current_scope.get()
+    def run(func, *args):
+        token = current_scope.set(calls)
+        try:
+            return func(*args)
+        finally:
+            current_scope.reset(token)
+    return run
+
+
+def get_endpoint(url):
+    """
+    Get the endpoint of the GitHub API the URL belongs to
+        :param url: URL of the request
+        :type url: string
+        :returns: path of the endpoint with placeholders (e.g. /repos/:owner/:repo/pulls), 'other' if it is not known
+        :rtype: string
+    """
+    path = urllib.parse.urlparse(url).path.rstrip('/')
+    for pattern, endpoint in ENDPOINTS:
+        if pattern.search(path) != None:
+            return endpoint
+    return 'other'
+
+
+def format_value(value):
+    """
+    Format a sample value in the Prometheus text format
+        :param value: the value
+        :type value: int, float
+        :returns: formatted value
+        :rtype: string
+    """
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(names, values, extra=None):
+    """
+    Format the labels of a sample in the Prometheus text format
+        :param names: label names
+        :param values: label values in the order of the names
+        :param extra: additional label (name, value), e.g. the 'le' of a histogram bucket
+        :type names: tuple
+        :type values: tuple
+        :type extra: tuple
+        :returns: labels in braces, empty string if there are none
+        :rtype: string
+    """
+    pairs = list(zip(names, values))
+    if extra != None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in pairs]
+    return '{' + ','.join(f'{n}="{v}"' for n, v in escaped) + '}'
+
+
+class Metrics:
+    """
+    Thread-safe registry of the counters and histograms listed in METRICS
+    """
+
+    def __init__(self):
+        """
+        Create the registry with no recorded values
+        """
+        self.lock = threading.Lock()
+        # name -> label values -> counter value or [bucket counts..., sum, count]
+        self.values = {name: {} for name in METRICS}
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Increase a counter
+            :param name: name of the counter
+            :param labels: label values in the order of its label names
+            :param value: increment
+            :type name: string
+            :type labels: tuple
+            :type value: int
+        """
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """
+        Record a value to a histogram
+            :param name: name of the histogram
+            :param value: observed value
+            :param labels: label values in the order of its label names
+            :type name: string
+            :type value: float
+            :type labels: tuple
+        """
+        buckets = METRICS[name][3]
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            series = self.values[name]
+            h = series.get(labels)
+            if h == None:
+                # Counts of the buckets (the last one is +Inf), sum and count
+                h = series[labels] = [0] * (len(buckets) + 1) + [0, 0]
+            h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Measure the duration of a stage. The stage is counted as failed if it raises
+        or if 'ok' of the yielded dictionary is set to False.
+            :param stage: name of the stage
+            :type stage: string
+            :returns: context manager giving the dictionary with 'ok'
+            :rtype: contextmanager
+        """
+        result = {'ok': True}
+        start = time.perf_counter()
+        try:
+            yield result
+        except BaseException:
+            result['ok'] = False
+            raise
+        finally:
+            self.observe('filabel_stage_seconds', time.perf_counter() - start, (stage,))
+            if result['ok'] == False:
+                self.inc('filabel_stage_failures_total', (stage,))
+
+    @contextlib.contextmanager
+    def scope(self):
+        """
+        Count the successful or not modified GitHub requests made in the context
+        (also by the threads prefetching pages for it)
+            :returns: context manager giving the counter of the requests per endpoint
+            :rtype: contextmanager
+        """
+        calls = collections.Counter()
+        token = current_scope.set(calls)
+        try:
+            yield calls
+        finally:
+            current_scope.reset(token)
+
+    def record_request(self, method, url, status, seconds, size=0):
+        """
+        Record a GitHub API request
+            :param method: HTTP method
+            :param url: URL of the request
+            :param status: status code of the response, 'error' if there is none
+            :param seconds: duration of the request
+            :param size: size of the body of the response in bytes
+            :type method: string
+            :type url: string
+            :type status: int, string
+            :type seconds: float
+            :type size: int
+        """
+        endpoint = get_endpoint(url)
+        self.inc('filabel_github_requests_total', (method, endpoint, str(status)))
+        self.observe('filabel_github_request_seconds', seconds, (method, endpoint))
+        self.inc('filabel_github_response_bytes_total', (method, endpoint), size)
+        calls = current_scope.get()
+        if calls != None and status in (200, 304):
+            calls[endpoint] += 1
+
+    def record_pull(self, pages, files, plan):
+        """
+        Record a labeled pull request
+            :param pages: number of the pages of files fetched
+            :param files: number of the files of the pull request
+            :param plan: applied plan from filabel.github.plan_label_changes(), None if it was not applied
+            :type pages: int
+            :type files: int
+            :type plan: dictionary
+        """
+        self.observe('filabel_pull_pages', pages)
+        self.observe('filabel_pull_files', files)
+        if plan != None:
+            self.inc('filabel_labels_changed_total', ('added',), len(plan['add']))
+            self.inc('filabel_labels_changed_total', ('removed',), len(plan['remove']))
+
+    def summary(self):
+        """
+        Sum up the recorded GitHub requests
+            :returns: number of requests, their total duration in seconds and size of the responses in bytes,
+                      also per endpoint under 'endpoints' ({'GET /user': {...}})
+            :rtype: dictionary
+        """
+        with self.lock:
+            times = dict(self.values['filabel_github_request_seconds'])
+            sizes = dict(self.values['filabel_github_response_bytes_total'])
+        ret = {'requests': 0, 'seconds': 0.0, 'bytes': 0, 'endpoints': {}}
+        for (method, endpoint), h in sorted(times.items()):
+            size = sizes.get((method, endpoint), 0)
+            ret['endpoints'][f'{method} {endpoint}'] = {'requests': h[-1], 'seconds': h[-2], 'bytes': size}
+            ret['requests'] += h[-1]
+            ret['seconds'] += h[-2]
+            ret['bytes'] += size
+        return ret
+
+    def render(self):
+        """
+        Render all the recorded values in the Prometheus text format
+            :returns: the metrics
+            :rtype: string
+        """
+        with self.lock:
+            values = {name: {k: list(v) if isinstance(v, list) else v for k, v in series.items()}
+                for name, series in self.values.items()}
+        lines = []
+        for name, (kind, help, label_names, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(values[name].items()):
+                if kind == 'counter':
+                    lines.append(f'{name}{format_labels(label_names, labels)} {format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + [math.inf], value):
+                    cumulative += count
+                    le = ('le', format_value(float(bound)))
+                    lines.append(f'{name}_bucket{format_labels(label_names, labels, le)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(label_names, labels)} {format_value(value[-2])}')
+                lines.append(f'{name}_count{format_labels(label_names, labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
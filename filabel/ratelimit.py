@@ -0,0 +1,176 @@
+"""
+Rate limit aware scheduling of the GitHub requests.
+The scheduler reads the X-RateLimit-* and Retry-After headers of the responses,
+slows the requests down before the quota is exhausted and tells when a rate limited request should be retried.
+"""
+
+import threading
+import time
+import urllib.parse
+
+
+def get_resource(url):
+    """
+    Get the rate limit resource a request to the URL counts to
+        :param url: URL of the request
+        :type url: string
+        :returns: 'graphql', 'search' or 'core'
+        :rtype: string
+    """
+    path = urllib.parse.urlparse(url).path
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if '/search/' in path:
+        return 'search'
+    return 'core'
+
+
+class RateLimiter:
+    """
+    Budget of the GitHub requests shared by all the threads using it
+    """
+
+    def __init__(self, reserve=50, pace_below=500, backoff=60, max_retries=5, max_wait=None):
+        """
+        Create the scheduler
+            :param reserve: number of requests never used before the quota is reset
+            :param pace_below: when less requests remain, they are spread evenly until the reset
+            :param backoff: seconds to wait after the first secondary rate limit without Retry-After, doubled for each retry
+            :param max_retries: maximal number of retries of one rate limited request
+            :param max_wait: maximal number of seconds to wait at once, a rate limited request that would have to wait
+                             longer is not retried, None for no limit
+            :type reserve: int
+            :type pace_below: int
+            :type backoff: float
+            :type max_retries: int
+            :type max_wait: float
+        """
+        self.reserve = reserve
+        self.pace_below = pace_below
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.paused_until = 0
+        self.counts = {'requests': 0, 'rate_limited': 0, 'retries': 0, 'waits': 0, 'waited': 0.0}
+
+    def get_state(self, resource):
+        """
+        Get the known quota of the resource, must be called with the lock held
+            :param resource: rate limit resource
+            :type resource: string
+            :returns: limit, remaining, reset time, slot of the next paced request and used quota per reset window
+            :rtype: dictionary
+        """
+        if resource not in self.resources:
+            self.resources[resource] = {'limit': None, 'remaining': None, 'reset': None,
+                'next_slot': 0, 'windows': {}}
+        return self.resources[resource]
+
+    def reserve_request(self, url):
+        """
+        Reserve a request and find out how long to wait before sending it
+            :param url: URL of the request
+            :type url: string
+            :returns: seconds to wait
+            :rtype: float
+        """
+        now = time.time()
+        with self.lock:
+            self.counts['requests'] += 1
+            wait = max(0, self.paused_until - now)
+            st = self.get_state(get_resource(url))
+            if st['remaining'] != None and st['reset'] != None and st['reset'] > now:
+                budget = st['remaining'] - self.reserve
+                if budget <= 0:
+                    # Quota is (almost) exhausted, pause until it is reset
+                    wait = max(wait, st['reset'] - now + 1)
+                elif st['remaining'] < self.pace_below:
+                    slot = max(now, st['next_slot'])
+                    st['next_slot'] = slot + (st['reset'] - now) / budget
+                    wait = max(wait, slot - now)
+                # Other threads see this request as already sent
+                st['remaining'] -= 1
+            if self.max_wait != None:
+                wait = min(wait, self.max_wait)
+            if wait > 0:
+                self.counts['waits'] += 1
+                self.counts['waited'] += wait
+        return wait
+
+    def acquire(self, url):
+        """
+        Wait until the request can be sent
+            :param url: URL of the request
+            :type url: string
+        """
+        wait = self.reserve_request(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, url, status, headers, text, attempt=0):
+        """
+        Update the quota from the response and find out whether it was rate limited
+            :param url: URL of the request
+            :param status: status code of the response
+            :param headers: headers of the response
+            :param text: body of the response, only used for 403 responses
+            :param attempt: number of the previous retries of the request
+            :type url: string
+            :type status: int
+            :type headers: dictionary
+            :type text: string
+            :type attempt: int
+            :returns: seconds to wait before retrying the request, None if it should not be retried
+            :rtype: float
+        """
+        now = time.time()
+        with self.lock:
+            st = self.get_state(headers.get('X-RateLimit-Resource') or get_resource(url))
+            if 'X-RateLimit-Remaining' in headers:
+                st['remaining'] = int(headers['X-RateLimit-Remaining'])
+                st['limit'] = int(headers.get('X-RateLimit-Limit', 0)) or st['limit']
+                if 'X-RateLimit-Reset' in headers:
+                    st['reset'] = int(headers['X-RateLimit-Reset'])
+                used = headers.get('X-RateLimit-Used')
+                used = int(used) if used != None else (st['limit'] or 0) - st['remaining']
+                window = st['windows'].setdefault(st['reset'], [used, used])
+                window[0] = min(window[0], used)
+                window[1] = max(window[1], used)
+            if status not in (403, 429):
+                return None
+            wait = None
+            if 'Retry-After' in headers:
+                wait = float(headers['Retry-After'])
+            elif st['remaining'] == 0 and st['reset'] != None:
+                wait = max(0, st['reset'] - now) + 1
+            elif 'rate limit' in (text or '').lower():
+                # Secondary rate limit without Retry-After, back off exponentially
+                wait = self.backoff * 2 ** attempt
+            if wait == None:
+                return None
+            self.counts['rate_limited'] += 1
+            if attempt >= self.max_retries or (self.max_wait != None and wait > self.max_wait):
+                return None
+            self.counts['retries'] += 1
+            self.paused_until = max(self.paused_until, now + wait)
+            return wait
+
+    def stats(self):
+        """
+        Get the consumed quota and the waiting statistics
+            :returns: requests, quota consumed, rate limited responses, retries, waits and per resource quota
+            :rtype: dictionary
+        """
+        with self.lock:
+            ret = dict(self.counts)
+            ret['consumed'] = 0
+            ret['resources'] = {}
+            for name, st in self.resources.items():
+                # The first response of a window was already counted in its used quota
+                consumed = sum(w[1] - w[0] + 1 for w in st['windows'].values())
+                ret['consumed'] += consumed
+                ret['resources'][name] = {'limit': st['limit'], 'remaining': st['remaining'],
+                    'reset': st['reset'], 'consumed': consumed}
+            return ret
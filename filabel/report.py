@@ -0,0 +1,244 @@
+"""
+Report of a CLI run: where the time went (per repository and pull request, label matching, network),
+how many requests and bytes were transferred and how much of the rate limit quota was consumed.
+The run can also be profiled with cProfile for offline analysis, the profilers are imported only then.
+"""
+
+import contextlib
+import sys
+import threading
+import time
+
+
+class RunReport:
+    """
+    Thread-safe record of the timings of the labeled repositories and pull requests
+    """
+
+    def __init__(self):
+        """
+        Create the report, the wall time of the run starts now
+        """
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.repos = {}
+
+    def get_repo(self, r):
+        """
+        Get the record of the repository, must be called with the lock held
+            :param r: repository name 'author/repo-name'
+            :type r: string
+            :returns: start and end of the listing, flag indicating that it was listed and records of its pull requests
+            :rtype: dictionary
+        """
+        if r not in self.repos:
+            self.repos[r] = {'start': None, 'listed': None, 'ok': False, 'pulls': []}
+        return self.repos[r]
+
+    @contextlib.contextmanager
+    def repo(self, r):
+        """
+        Measure the listing of the repository
+            :param r: repository name 'author/repo-name'
+            :type r: string
+            :returns: context manager giving the record, its 'ok' should be set when all the pull requests were listed
+            :rtype: contextmanager
+        """
+        with self.lock:
+            entry = self.get_repo(r)
+            entry['start'] = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            with self.lock:
+                entry['listed'] = time.perf_counter()
+
+    @contextlib.contextmanager
+    def pull(self, r, pull_num):
+        """
+        Measure the labeling of the pull request
+            :param r: repository name 'author/repo-name'
+            :param pull_num: number of the pull request
+            :type r: string
+            :type pull_num: int
+            :returns: context manager giving the record, its 'ok', 'files' and 'match_seconds' should be set
+            :rtype: contextmanager
+        """
+        entry = {'number': pull_num, 'ok': False, 'files': None, 'match_seconds': 0.0}
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['end'] = time.perf_counter()
+            entry['seconds'] = entry['end'] - start
+            with self.lock:
+                self.get_repo(r)['pulls'].append(entry)
+
+    def build(self, metrics=None, limiter=None, memo=None, cache=None):
+        """
+        Build the report of the run, it ends now
+            :param metrics: metrics of the GitHub requests of the run
+            :param limiter: rate limit scheduler used in the run
+            :param memo: memo of the labels of the paths used in the run
+            :param cache: HTTP cache used in the run, None if there was none
+            :type metrics: filabel.metrics.Metrics
+            :type limiter: filabel.ratelimit.RateLimiter
+            :type memo: filabel.github.LabelMemo
+            :type cache: filabel.cache.HTTPCache
+            :returns: report serializable as JSON, times are in seconds
+            :rtype: dictionary
+        """
+        end = time.perf_counter()
+        repos = []
+        match = 0.0
+        with self.lock:
+            for r, entry in self.repos.items():
+                pulls = sorted(entry['pulls'], key=lambda p: p['number'], reverse=True)
+                match += sum(p['match_seconds'] for p in pulls)
+                start = entry['start'] if entry['start'] != None else self.start
+                # Pull requests are labeled while the listing goes on, the repository is done with the last one
+                done = max([entry['listed'] or start] + [p['end'] for p in pulls])
+                repos.append({
+                    'repo': r,
+                    'ok': entry['ok'],
+                    'seconds': done - start,
+                    'listing_seconds': (entry['listed'] or start) - start,
+                    'pulls': [{k: v for k, v in p.items() if k != 'end'} for p in pulls],
+                })
+        return {
+            'wall_seconds': end - self.start,
+            'match_seconds': match,
+            'repos': repos,
+            'http': metrics.summary() if metrics != None else None,
+            'rate_limit': limiter.stats() if limiter != None else None,
+            'label_memo': memo.stats() if memo != None else None,
+            'cache': cache.stats() if cache != None else None,
+        }
+
+
+def sum_stats(stats, keys):
+    """
+    Sum the statistics of several worker processes
+        :param stats: statistics of the workers, None items are skipped
+        :param keys: keys whose values are summed
+        :type stats: list
+        :type keys: tuple
+        :returns: sums of the values, hit_ratio is computed from the summed hits and misses, None if there are no statistics
+        :rtype: dictionary
+    """
+    stats = [st for st in stats if st != None]
+    if len(stats) == 0:
+        return None
+    ret = {k: sum(st[k] for st in stats) for k in keys}
+    if 'hits' in ret:
+        total = ret['hits'] + ret['misses']
+        ret['hit_ratio'] = ret['hits'] / total if total != 0 else 0.0
+    return ret
+
+
+def merge_reports(runs, reposlugs, start):
+    """
+    Merge the reports of the worker processes into one report of the run
+        :param runs: reports from RunReport.build() of the workers
+        :param reposlugs: names of the repositories in the order of the output
+        :param start: time.perf_counter() of the start of the run
+        :type runs: list
+        :type reposlugs: list
+        :type start: float
+        :returns: report of the whole run in the format of RunReport.build(), with the number of 'workers'
+        :rtype: dictionary
+    """
+    repos = {}
+    for run in runs:
+        for entry in run['repos']:
+            repos[entry['repo']] = entry
+    http = sum_stats([run['http'] for run in runs], ('requests', 'seconds', 'bytes'))
+    if http != None:
+        http['endpoints'] = {}
+        for run in runs:
+            for name, ep in run['http']['endpoints'].items():
+                http['endpoints'][name] = sum_stats([http['endpoints'].get(name), ep], ('requests', 'seconds', 'bytes'))
+    rate_limit = sum_stats([run['rate_limit'] for run in runs],
+        ('requests', 'rate_limited', 'retries', 'waits', 'waited', 'consumed'))
+    if rate_limit != None:
+        # All the workers share the quota of the token, the last known remaining quota is the lowest one
+        rate_limit['resources'] = {}
+        for run in runs:
+            for name, res in run['rate_limit']['resources'].items():
+                merged = rate_limit['resources'].setdefault(name, dict(res, consumed=0))
+                merged['consumed'] += res['consumed']
+                if res['remaining'] != None and (merged['remaining'] == None or res['remaining'] < merged['remaining']):
+                    merged.update(limit=res['limit'], remaining=res['remaining'], reset=res['reset'])
+    cache = sum_stats([run['cache'] for run in runs], ('hits', 'misses'))
+    if cache != None:
+        # The workers share the cache directory
+        for k in ('entries', 'size', 'max_size'):
+            cache[k] = max(run['cache'][k] for run in runs if run['cache'] != None)
+    return {
+        'wall_seconds': time.perf_counter() - start,
+        'match_seconds': sum(run['match_seconds'] for run in runs),
+        'workers': len(runs),
+        'repos': [repos[r] for r in dict.fromkeys(reposlugs) if r in repos],
+        'http': http,
+        'rate_limit': rate_limit,
+        'label_memo': sum_stats([run['label_memo'] for run in runs], ('hits', 'misses', 'entries', 'size')),
+        'cache': cache,
+    }
+
+
+def merge_profiles(filenames, filename):
+    """
+    Merge the cProfile statistics written by the worker processes into one file
+        :param filenames: names of the files with the statistics of the workers
+        :param filename: name of the output file
+        :type filenames: list
+        :type filename: string
+    """
+    import pstats
+    stats = pstats.Stats(*filenames)
+    stats.dump_stats(filename)
+
+
+class Profiler:
+    """
+    cProfile profiler of the main thread and of the worker threads started with start_thread(),
+    one profiler of the whole process since Python 3.12
+    """
+
+    def __init__(self):
+        """
+        Create the profiler and start profiling the calling thread
+        """
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.start_thread()
+
+    def start_thread(self):
+        """
+        Start profiling the calling thread until it ends, usable as the initializer of an executor.
+        Since Python 3.12 the profiler of the main thread profiles all the threads (less precisely when they run
+        at the same time) and no other one can be enabled.
+        """
+        import cProfile
+        profile = cProfile.Profile()
+        with self.lock:
+            if sys.version_info >= (3, 12) and len(self.profiles) != 0:
+                return
+            self.profiles.append(profile)
+        profile.enable()
+
+    def dump(self, filename):
+        """
+        Stop profiling the calling thread and write the statistics of all the threads merged together,
+        they can be read by pstats (``python -m pstats FILENAME``) or other tools
+            :param filename: name of the output file
+            :type filename: string
+        """
+        import pstats
+        with self.lock:
+            profiles = list(self.profiles)
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(filename)
@@ -0,0 +1,560 @@
+"""
+Simulator of the parts of the GitHub API used by filabel, for load testing without touching GitHub.
+Latency, errors, rate limit and page size of the simulated API can be configured.
+Run it with ``python -m filabel.simulator`` and point filabel at it with ``--api-url`` or ``FILABEL_API_URL``.
+"""
+
+import click
+import collections
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling every request in a new thread (http.server.ThreadingHTTPServer is only in Python 3.7+)
+    """
+    daemon_threads = True
+
+
+"""
+Directories, extensions and labels the generated pull requests are made of
+"""
+DIRS = ['src', 'lib', 'docs', 'tests', 'static', 'templates', 'logic', 'api']
+EXTENSIONS = ['py', 'rst', 'md', 'js', 'html', 'css', 'cfg', 'txt']
+LABELS = ['frontend', 'backend', 'docs', 'tests', 'wip']
+
+"""
+Time of the generated pull requests
+"""
+CREATED_AT = '2019-01-01T00:00:00Z'
+
+
+def generate_repos(repos=1, pulls=100, files=20, seed=0):
+    """
+    Generate repositories with pull requests
+        :param repos: number of repositories, they are named 'simulator/repoN'
+        :param pulls: number of pull requests of every repository
+        :param files: number of files of every pull request
+        :param seed: seed of the generator
+        :type repos: int
+        :type pulls: int
+        :type files: int
+        :type seed: int
+        :returns: pull requests by number by repository name
+        :rtype: dictionary
+    """
+    rnd = random.Random(seed)
+    ret = {}
+    for r in range(repos):
+        repo = {}
+        for num in range(1, pulls + 1):
+            paths = [f'{rnd.choice(DIRS)}/{rnd.choice(DIRS)}/file{rnd.randint(0, 10 * files)}.{rnd.choice(EXTENSIONS)}'
+                for i in range(files)]
+            repo[num] = {
+                'files': list(dict.fromkeys(paths)),
+                'labels': rnd.sample(LABELS, rnd.randint(0, 2)),
+                'sha': f'{r:08x}{num:032x}',
+                'state': 'open' if rnd.random() < 0.8 else 'closed',
+                'updated_at': CREATED_AT,
+            }
+        ret[f'simulator/repo{r}'] = repo
+    return ret
+
+
+def load_repos(f):
+    """
+    Load the repositories from a JSON file ({"owner/name": {"1": {"files": [...], "labels": [...]}}})
+        :param f: the JSON file
+        :type f: file
+        :returns: pull requests by number by repository name
+        :rtype: dictionary
+    """
+    ret = {}
+    for name, pulls in json.load(f).items():
+        ret[name] = {}
+        for num, pull in pulls.items():
+            ret[name][int(num)] = {
+                'files': pull.get('files', []),
+                'labels': pull.get('labels', []),
+                'sha': pull.get('sha', f'{int(num):040x}'),
+                'state': pull.get('state', 'open'),
+                'updated_at': pull.get('updated_at', CREATED_AT),
+            }
+    return ret
+
+
+class Simulator:
+    """
+    Simulated GitHub API keeping the repositories in memory, shared by all the threads of the server
+    """
+
+    def __init__(self, repos, latency=0, jitter=0, error_rate=0, page_size=100, rate_limit=None, rate_window=3600,
+            login='filabel-simulator', seed=None, archived=(), forks=()):
+        """
+        Create the simulator
+            :param repos: pull requests by number by repository name, see generate_repos()
+            :param latency: seconds every request takes
+            :param jitter: maximal number of seconds randomly added to the latency
+            :param error_rate: probability of answering a request with 502
+            :param page_size: maximal number of items on one page, regardless of per_page
+            :param rate_limit: number of requests allowed in one rate limit window, None for no limit
+            :param rate_window: length of the rate limit window in seconds
+            :param login: login of the token owner returned by /user
+            :param seed: seed of the random latency and errors
+            :param archived: names of the archived repositories
+            :param forks: names of the repositories that are forks
+            :type repos: dictionary
+            :type latency: float
+            :type jitter: float
+            :type error_rate: float
+            :type page_size: int
+            :type rate_limit: int
+            :type rate_window: float
+            :type login: string
+            :type seed: int
+            :type archived: list
+            :type forks: list
+        """
+        self.repos = repos
+        self.archived = set(archived)
+        self.forks = set(forks)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.login = login
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_reset = 0
+        self.used = 0
+        self.counts = collections.Counter()
+
+    def handle(self, method, url, body=None):
+        """
+        Answer one request
+            :param method: HTTP method
+            :param url: absolute URL of the request, used in the Link header
+            :param body: body of the request
+            :type method: string
+            :type url: string
+            :type body: bytes
+            :returns: status code, headers and JSON of the response
+            :rtype: tuple
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+            error = self.error_rate > 0 and self.random.random() < self.error_rate
+            headers = self.rate_limit_headers()
+        if delay > 0:
+            time.sleep(delay)
+        if headers.get('X-RateLimit-Remaining') == '0' and 'Retry-After' in headers:
+            with self.lock:
+                self.counts['rate_limited'] += 1
+            return 403, headers, {'message': 'API rate limit exceeded'}
+        if error:
+            with self.lock:
+                self.counts['errors'] += 1
+            return 502, headers, {'message': 'Server Error'}
+        status, extra, ret = self.route(method, url, body)
+        headers.update(extra)
+        return status, headers, ret
+
+    def rate_limit_headers(self):
+        """
+        Count the request to the rate limit, must be called with the lock held
+            :returns: X-RateLimit-* headers, with Retry-After if the request is over the limit
+            :rtype: dictionary
+        """
+        if self.rate_limit == None:
+            return {}
+        now = time.time()
+        if now >= self.window_reset:
+            self.window_reset = now + self.rate_window
+            self.used = 0
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Reset': str(int(self.window_reset)),
+            'X-RateLimit-Resource': 'core',
+        }
+        if self.used >= self.rate_limit:
+            headers['X-RateLimit-Remaining'] = '0'
+            headers['X-RateLimit-Used'] = str(self.used)
+            headers['Retry-After'] = str(int(self.window_reset - now) + 1)
+            return headers
+        self.used += 1
+        headers['X-RateLimit-Remaining'] = str(self.rate_limit - self.used)
+        headers['X-RateLimit-Used'] = str(self.used)
+        return headers
+
+    def paginate(self, url, items):
+        """
+        Get one page of the items with the Link header
+            :param url: URL of the request with page and per_page parameters
+            :param items: all the items of the listing
+            :type url: string
+            :type items: list
+            :returns: status code, headers and JSON of the page
+            :rtype: tuple
+        """
+        parsed = urllib.parse.urlparse(url)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        per_page = max(1, min(int(query.get('per_page', 30)), self.page_size))
+        page = max(1, int(query.get('page', 1)))
+        last = max(1, -(-len(items) // per_page))
+
+        def page_url(p):
+            return parsed._replace(query=urllib.parse.urlencode(dict(query, page=p))).geturl()
+
+        links = []
+        if page < last:
+            links += [f'<{page_url(page + 1)}>; rel="next"', f'<{page_url(last)}>; rel="last"']
+        if page > 1:
+            links += [f'<{page_url(page - 1)}>; rel="prev"', f'<{page_url(1)}>; rel="first"']
+        headers = {'Link': ', '.join(links)} if len(links) != 0 else {}
+        return 200, headers, items[(page - 1) * per_page:page * per_page]
+
+    def route(self, method, url, body):
+        """
+        Answer the request according to its endpoint
+            :param method: HTTP method
+            :param url: absolute URL of the request
+            :param body: body of the request
+            :type method: string
+            :type url: string
+            :type body: bytes
+            :returns: status code, headers and JSON of the response
+            :rtype: tuple
+        """
+        not_found = (404, {}, {'message': 'Not Found'})
+        parsed = urllib.parse.urlparse(url)
+        if parsed.path == '/user' and method == 'GET':
+            return 200, {}, {'login': self.login}
+        if parsed.path == '/graphql' and method == 'POST':
+            return self.graphql(body)
+        m = re.match(r'/(orgs|users)/([^/]+)/repos$', parsed.path)
+        if m != None and method == 'GET':
+            # The login of the token owner is a user, everybody else is an organization
+            if (m.group(1) == 'orgs') == (m.group(2) == self.login):
+                return not_found
+            repos = self.list_repos(m.group(2))
+            return self.paginate(url, repos) if len(repos) != 0 else not_found
+        m = re.match(r'/repos/([^/]+/[^/]+)/(pulls|issues)(?:/(\d+))?(?:/(files|labels))?(?:/(.+))?$', parsed.path)
+        if m == None or m.group(1) not in self.repos:
+            return not_found
+        repo = self.repos[m.group(1)]
+        if m.group(2) == 'pulls' and m.group(3) == None and method == 'GET':
+            return self.paginate(url, self.list_pulls(repo, dict(urllib.parse.parse_qsl(parsed.query))))
+        if m.group(3) == None or int(m.group(3)) not in repo:
+            return not_found
+        pull = repo[int(m.group(3))]
+        if m.group(2) == 'pulls' and m.group(4) == 'files' and method == 'GET':
+            return self.paginate(url, [{'filename': f, 'status': 'modified'} for f in pull['files']])
+        if m.group(2) != 'issues' or m.group(4) != 'labels':
+            return not_found
+        if method == 'GET':
+            with self.lock:
+                labels = [{'name': l} for l in pull['labels']]
+            return self.paginate(url, labels)
+        return self.change_labels(pull, method, m.group(5), body)
+
+    def list_repos(self, owner):
+        """
+        Get the repositories of the owner sorted by name
+            :param owner: login of the owner
+            :type owner: string
+            :returns: JSON of the repositories
+            :rtype: list
+        """
+        ret = []
+        with self.lock:
+            for name in sorted(self.repos, key=str.lower):
+                if name.split('/')[0].lower() != owner.lower():
+                    continue
+                ret.append({'name': name.split('/')[1], 'full_name': name, 'owner': {'login': name.split('/')[0]},
+                    'archived': name in self.archived, 'fork': name in self.forks, 'private': False,
+                    'open_issues_count': sum(1 for pull in self.repos[name].values() if pull['state'] == 'open')})
+        return ret
+
+    def list_pulls(self, repo, query):
+        """
+        Get the pull requests of the repository filtered and sorted like GitHub does
+            :param repo: pull requests of the repository by number
+            :param query: query parameters of the request
+            :type repo: dictionary
+            :type query: dictionary
+            :returns: JSON of the pull requests
+            :rtype: list
+        """
+        state = query.get('state', 'open')
+        with self.lock:
+            pulls = [{'number': num, 'state': pull['state'], 'labels': [{'name': l} for l in pull['labels']],
+                'head': {'sha': pull['sha']}, 'updated_at': pull['updated_at']}
+                for num, pull in repo.items() if state == 'all' or pull['state'] == state]
+        key = (lambda p: p['updated_at']) if query.get('sort') == 'updated' else (lambda p: p['number'])
+        pulls.sort(key=key, reverse=query.get('direction', 'desc') == 'desc')
+        return pulls
+
+    def graphql(self, body):
+        """
+        Answer a GraphQL query of filabel (see filabel.graphql): the pull requests of a repository with their labels
+        and files, or the next page of the labels or files of one pull request
+            :param body: JSON body of the request with 'query' and 'variables'
+            :type body: bytes
+            :returns: status code, headers and JSON of the response
+            :rtype: tuple
+        """
+        try:
+            data = json.loads(body)
+            query = data['query']
+            variables = data.get('variables') or {}
+        except (ValueError, KeyError, TypeError):
+            return 400, {}, {'message': 'Problems parsing JSON'}
+        name = f'{variables.get("owner")}/{variables.get("name")}'
+        if name not in self.repos:
+            return 200, {}, {'data': {'repository': None}, 'errors': [{'type': 'NOT_FOUND', 'path': ['repository'],
+                'message': f"Could not resolve to a Repository with the name '{name}'."}]}
+        repo = self.repos[name]
+        if 'pullRequests(' in query:
+            return 200, {}, {'data': {'repository': {'pullRequests': self.graphql_pulls(repo, query, variables)}}}
+        num = variables.get('number')
+        if num not in repo:
+            return 200, {}, {'data': {'repository': {'pullRequest': None}}, 'errors': [{'type': 'NOT_FOUND',
+                'path': ['repository', 'pullRequest'], 'message': f'Could not resolve to a PullRequest with the number of {num}.'}]}
+        conn = 'files' if re.search(r'\bfiles\(', query) != None else 'labels'
+        with self.lock:
+            nodes = [{'path': f} for f in repo[num]['files']] if conn == 'files' else \
+                [{'name': l} for l in repo[num]['labels']]
+        first = self.graphql_first(query, conn)
+        return 200, {}, {'data': {'repository': {'pullRequest': {conn: self.connection(nodes, first, variables.get('cursor'))}}}}
+
+    def graphql_pulls(self, repo, query, variables):
+        """
+        Get a page of the pull requests of the repository filtered and sorted like GitHub does
+            :param repo: pull requests of the repository by number
+            :param query: the GraphQL query
+            :param variables: variables of the query
+            :type repo: dictionary
+            :type query: string
+            :type variables: dictionary
+            :returns: JSON of the pullRequests connection
+            :rtype: dictionary
+        """
+        states = variables.get('states') or ['OPEN', 'CLOSED', 'MERGED']
+        order = variables.get('order') or {}
+        files_first = self.graphql_first(query, 'files')
+        labels_first = self.graphql_first(query, 'labels')
+        with self.lock:
+            pulls = [(num, dict(pull, files=list(pull['files']), labels=list(pull['labels'])))
+                for num, pull in repo.items() if pull['state'].upper() in states]
+        key = (lambda p: p[1]['updated_at']) if order.get('field') == 'UPDATED_AT' else (lambda p: p[0])
+        pulls.sort(key=key, reverse=order.get('direction', 'DESC') == 'DESC')
+        nodes = [{
+            'number': num,
+            'headRefOid': pull['sha'],
+            'updatedAt': pull['updated_at'],
+            'labels': self.connection([{'name': l} for l in pull['labels']], labels_first),
+            'files': self.connection([{'path': f} for f in pull['files']], files_first),
+        } for num, pull in pulls]
+        return self.connection(nodes, variables.get('perPage', 100), variables.get('cursor'))
+
+    def graphql_first(self, query, name):
+        """
+        Get the number of the nodes asked for in a connection of the query
+            :param query: the GraphQL query
+            :param name: name of the connection
+            :type query: string
+            :type name: string
+            :returns: the number, 100 if it is not found
+            :rtype: int
+        """
+        m = re.search(r'\b' + name + r'\(first:\s*(\d+)', query)
+        return int(m.group(1)) if m != None else 100
+
+    def connection(self, nodes, first, cursor=None):
+        """
+        Get one page of a GraphQL connection, at most page_size nodes
+            :param nodes: all the nodes of the connection
+            :param first: number of the nodes asked for
+            :param cursor: end cursor of the previous page, None for the first page
+            :type nodes: list
+            :type first: int
+            :type cursor: string
+            :returns: JSON of the connection with pageInfo and nodes
+            :rtype: dictionary
+        """
+        start = int(cursor) if cursor else 0
+        end = start + max(1, min(first, self.page_size))
+        return {'pageInfo': {'hasNextPage': end < len(nodes), 'endCursor': str(min(end, len(nodes)))},
+            'nodes': nodes[start:end]}
+
+    def change_labels(self, pull, method, name, body):
+        """
+        Change the labels of the pull request
+            :param pull: the pull request
+            :param method: PUT (replace), POST (add) or DELETE (remove one)
+            :param name: quoted name of the removed label
+            :param body: JSON body of the request
+            :type pull: dictionary
+            :type method: string
+            :type name: string
+            :type body: bytes
+            :returns: status code, headers and JSON of the labels
+            :rtype: tuple
+        """
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            return 400, {}, {'message': 'Problems parsing JSON'}
+        with self.lock:
+            if method in ('PUT', 'POST') and name == None:
+                labels = data.get('labels', []) if isinstance(data, dict) else (data or [])
+                if method == 'PUT':
+                    pull['labels'] = list(dict.fromkeys(labels))
+                else:
+                    pull['labels'] = list(dict.fromkeys(pull['labels'] + labels))
+            elif method == 'DELETE' and name != None:
+                name = urllib.parse.unquote(name)
+                if name not in pull['labels']:
+                    return 404, {}, {'message': 'Label does not exist'}
+                pull['labels'].remove(name)
+            else:
+                return 404, {}, {'message': 'Not Found'}
+            # Changing the labels updates the pull request
+            pull['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            return 200, {}, [{'name': l} for l in pull['labels']]
+
+    def stats(self):
+        """
+        Get the numbers of the requests
+            :returns: requests, injected errors and rate limited requests
+            :rtype: dictionary
+        """
+        with self.lock:
+            return {k: self.counts[k] for k in ('requests', 'errors', 'rate_limited')}
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler passing the requests to the simulator of the server
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self):
+        """
+        Answer the request of any method
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length > 0 else None
+        url = f'http://{self.headers.get("Host") or "%s:%d" % self.server.server_address[:2]}{self.path}'
+        status, headers, ret = self.server.simulator.handle(self.command, url, body)
+        data = json.dumps(ret).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = answer
+    do_POST = answer
+    do_PUT = answer
+    do_PATCH = answer
+    do_DELETE = answer
+
+    def log_message(self, format, *args):
+        """
+        Log the requests only if the server is verbose
+        """
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def create_server(simulator, host='127.0.0.1', port=0, verbose=False):
+    """
+    Create the HTTP server of the simulator, it is started by serve_forever()
+        :param simulator: the simulated API
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        :param verbose: flag indicating that the requests should be logged to stderr
+        :type simulator: Simulator
+        :type host: string
+        :type port: int
+        :type verbose: bool
+        :returns: the server, its address is in server_address
+        :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), SimulatorHandler)
+    server.simulator = simulator
+    server.verbose = verbose
+    return server
+
+
+@click.command()
+@click.option('-H', '--host', default='127.0.0.1', help='Address to listen on.  [default: 127.0.0.1]')
+@click.option('-p', '--port', type=click.IntRange(min=0), default=8000, help='Port to listen on.  [default: 8000]')
+@click.option('-d', '--data', metavar='FILENAME', type=click.File('r'),
+    help='JSON file with the repositories, generated if not given.')
+@click.option('--repos', metavar='N', type=click.IntRange(min=1), default=1,
+    help='Number of generated repositories.  [default: 1]')
+@click.option('--pulls', metavar='N', type=click.IntRange(min=0), default=100,
+    help='Number of pull requests of a generated repository.  [default: 100]')
+@click.option('--files', metavar='N', type=click.IntRange(min=1), default=20,
+    help='Number of files of a generated pull request.  [default: 20]')
+@click.option('--latency', metavar='MS', type=click.FloatRange(min=0), default=0,
+    help='Milliseconds every request takes.  [default: 0]')
+@click.option('--jitter', metavar='MS', type=click.FloatRange(min=0), default=0,
+    help='Maximal number of milliseconds randomly added to the latency.  [default: 0]')
+@click.option('--error-rate', metavar='P', type=click.FloatRange(min=0, max=1), default=0,
+    help='Probability of answering a request with 502.  [default: 0]')
+@click.option('--page-size', metavar='N', type=click.IntRange(min=1), default=100,
+    help='Maximal number of items on one page.  [default: 100]')
+@click.option('--rate-limit', metavar='N', type=click.IntRange(min=1),
+    help='Number of requests allowed in one rate limit window.  [default: no limit]')
+@click.option('--rate-window', metavar='SECONDS', type=click.FloatRange(min=1), default=3600,
+    help='Length of the rate limit window.  [default: 3600]')
+@click.option('--archived', metavar='N', type=click.IntRange(min=0), default=0,
+    help='Number of the repositories marked as archived, from the first one.  [default: 0]')
+@click.option('--forks', metavar='N', type=click.IntRange(min=0), default=0,
+    help='Number of the repositories marked as forks, from the one after the archived ones.  [default: 0]')
+@click.option('--seed', type=int, default=0, help='Seed of the generated data, latency and errors.  [default: 0]')
+@click.option('-v', '--verbose', is_flag=True, help='Log the requests to stderr.')
+def main(host, port, data, repos, pulls, files, latency, jitter, error_rate, page_size, rate_limit, rate_window,
+        archived, forks, seed, verbose):
+    """
+    Run the simulator of the GitHub API
+    """
+    if data != None:
+        repo_data = load_repos(data)
+    else:
+        repo_data = generate_repos(repos, pulls, files, seed)
+    names = sorted(repo_data, key=lambda name: (len(name), name))
+    simulator = Simulator(repo_data, latency / 1000, jitter / 1000, error_rate, page_size, rate_limit, rate_window,
+        seed=seed, archived=names[:archived], forks=names[archived:archived + forks])
+    server = create_server(simulator, host, port, verbose)
+    address = server.server_address
+    print(f'Simulating GitHub API at http://{address[0]}:{address[1]} with repositories: '
+        f'{", ".join(sorted(repo_data))}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Requests: {simulator.stats()}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+State of the previous CLI runs used for incremental labeling.
+For every labeled pull request the file records its head SHA, the hash of the labeling rules
+and the labels, so the pull requests that did not change since the last run are skipped.
+"""
+
+import json
+import os
+import threading
+
+
+"""
+Version of the state file format, files with another version are ignored
+"""
+STATE_VERSION = 1
+
+
+class StateFile:
+    """
+    JSON file with the state of the labeled pull requests of all the repositories,
+    shared by all the threads of one run
+    """
+
+    def __init__(self, path):
+        """
+        Load the state, a missing or unreadable file is treated as an empty state
+            :param path: path to the state file
+            :type path: string
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.listed = {}
+        self.failed = set()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                self.repos = data['repos']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get_repo(self, repo):
+        """
+        Get the state of the repository, must be called with the lock held
+            :param repo: repository name 'author/repo-name'
+            :type repo: string
+            :returns: state of the repository
+            :rtype: dictionary
+        """
+        return self.repos.setdefault(repo, {'listing': None, 'pulls': {}})
+
+    def get_pull(self, repo, pull):
+        """
+        Get the recorded state of the pull request
+            :param repo: repository name 'author/repo-name'
+            :param pull: JSON of the pull request
+            :type repo: string
+            :type pull: JSON
+            :returns: head SHA, rules hash, labels and last update, None if not recorded
+            :rtype: dictionary
+        """
+        with self.lock:
+            return self.get_repo(repo)['pulls'].get(str(pull['number']))
+
+    def is_unchanged(self, repo, pull, config):
+        """
+        Check that the pull request has the same head, rules and labels as recorded
+            :param repo: repository name 'author/repo-name'
+            :param pull: JSON of the pull request from the listing
+            :param config: hash of the labeling rules from filabel.github.config_hash()
+            :type repo: string
+            :type pull: JSON
+            :type config: string
+            :returns: True if the pull request does not need to be labeled again
+            :rtype: bool
+        """
+        st = self.get_pull(repo, pull)
+        if st == None:
+            return False
+        labels = {l['name'] for l in pull['labels']}
+        return st['sha'] == pull['head']['sha'] and st['config'] == config and set(st['labels']) == labels
+
+    def is_seen(self, repo, pull, config, listing):
+        """
+        Check that the pull request was not updated since the last complete run with the same listing,
+        the pull requests updated before it were handled by that run as well
+            :param repo: repository name 'author/repo-name'
+            :param pull: JSON of the pull request from the listing sorted by update time
+            :param config: hash of the labeling rules from filabel.github.config_hash()
+            :param listing: parameters of the listing (state, base and rules hash)
+            :type repo: string
+            :type pull: JSON
+            :type config: string
+            :type listing: list
+            :returns: True if the listing can stop at this pull request
+            :rtype: bool
+        """
+        with self.lock:
+            if self.get_repo(repo)['listing'] != listing:
+                return False
+        st = self.get_pull(repo, pull)
+        return st != None and st['updated_at'] == pull['updated_at'] and self.is_unchanged(repo, pull, config)
+
+    def record_pull(self, repo, pull, config, plan):
+        """
+        Record the labels set on the pull request
+            :param repo: repository name 'author/repo-name'
+            :param pull: JSON of the pull request from the listing
+            :param config: hash of the labeling rules from filabel.github.config_hash()
+            :param plan: applied plan from filabel.github.plan_label_changes()
+            :type repo: string
+            :type pull: JSON
+            :type config: string
+            :type plan: dictionary
+        """
+        with self.lock:
+            self.get_repo(repo)['pulls'][str(pull['number'])] = {
+                'sha': pull['head']['sha'],
+                'config': config,
+                'labels': sorted(plan['final']),
+                'updated_at': pull['updated_at'],
+            }
+
+    def record_update(self, repo, pull):
+        """
+        Record the update time of an unchanged pull request, setting the labels in the last run updated it
+            :param repo: repository name 'author/repo-name'
+            :param pull: JSON of the pull request from the listing
+            :type repo: string
+            :type pull: JSON
+        """
+        with self.lock:
+            self.get_repo(repo)['pulls'][str(pull['number'])]['updated_at'] = pull['updated_at']
+
+    def record_listing(self, repo, listing):
+        """
+        Record the listing parameters of the run, they are saved only if no pull request of the repository fails
+            :param repo: repository name 'author/repo-name'
+            :param listing: parameters of the listing (state, base and rules hash)
+            :type repo: string
+            :type listing: list
+        """
+        with self.lock:
+            self.listed[repo] = listing
+
+    def record_failure(self, repo):
+        """
+        Record that a pull request of the repository failed, early stop is only allowed after a complete run
+            :param repo: repository name 'author/repo-name'
+            :type repo: string
+        """
+        with self.lock:
+            self.failed.add(repo)
+
+    def apply_listings(self):
+        """
+        Set the recorded listing parameters of the repositories without failures, must be called with the lock held
+        """
+        for repo, listing in self.listed.items():
+            self.get_repo(repo)['listing'] = listing if repo not in self.failed else None
+
+    def export(self, repos):
+        """
+        Get the state of the repositories labeled by this process, to be merged into the file by another one
+            :param repos: names of the repositories
+            :type repos: list
+            :returns: state of the repositories by name
+            :rtype: dictionary
+        """
+        with self.lock:
+            self.apply_listings()
+            return {r: self.repos[r] for r in repos if r in self.repos}
+
+    def merge(self, repos):
+        """
+        Replace the state of the repositories with the one exported by another process, see export()
+            :param repos: state of the repositories by name
+            :type repos: dictionary
+        """
+        with self.lock:
+            self.repos.update(repos)
+
+    def save(self):
+        """
+        Write the state to the file, the old file is replaced only when the new one is written completely
+        """
+        tmp = f'{self.path}.tmp'
+        with self.lock:
+            self.apply_listings()
+            with open(tmp, 'w') as f:
+                json.dump({'version': STATE_VERSION, 'repos': self.repos}, f, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -5,13 +5,24 @@ The web application module of filabel. Used to deploy on a public website and au
 from flask import Flask
 from flask import render_template
 from flask import request
+from flask import jsonify
+from flask import Response
 import json 
 import hashlib
 import hmac
 import requests
 from filabel.github import *
+from filabel.jobs import JobQueue, DeliveryLog
+from filabel.cache import HTTPCache
+from filabel.ratelimit import RateLimiter
+from filabel.metrics import Metrics, CONTENT_TYPE
 import os
 import sys
+import asyncio
+import signal
+import threading
+import time
+import collections
 
 
 """
@@ -29,7 +40,7 @@ def get_conf_files():
     ret_files = {'cred': '', 'label': ''}
     cvar = os.getenv('FILABEL_CONFIG')
     if cvar == None:
-        False
+        return False
     # Test if there are more conf files
     cvar = cvar.split(':')
     if len(cvar) != 2:
@@ -52,6 +63,293 @@ def get_conf_files():
 
 
 
+"""
+Process-wide cache of the loaded configuration, see get_config()
+"""
+config_cache = {'config': None, 'stale': False}
+config_lock = threading.Lock()
+
+"""
+Seconds between two checks of the modification times of the configuration files
+"""
+CONFIG_CHECK = 5
+
+
+def get_mtimes(filenames):
+    """
+    Get modification times of the configuration files
+        :param filenames: configuration files from get_conf_files()
+        :type filenames: dictionary
+        :returns: modification times, None for a file that cannot be accessed
+        :rtype: tuple
+    """
+    ret = []
+    for fn in (filenames['cred'], filenames['label']):
+        try:
+            ret.append(os.stat(fn).st_mtime_ns)
+        except OSError:
+            ret.append(None)
+    return tuple(ret)
+
+
+def load_config():
+    """
+    Read and parse both of the configuration files
+        :returns: file names, token, secret, labeling rules (parsed, compiled and hashed) and modification times, False if something went wrong
+        :rtype: dictionary, bool
+    """
+    filenames = get_conf_files()
+    if filenames == False:
+        return False
+    config = dict(filenames)
+    config['env'] = os.getenv('FILABEL_CONFIG')
+    config['mtimes'] = get_mtimes(filenames)
+    config['checked'] = time.monotonic()
+    with open(filenames['cred']) as f:
+        config['token'] = get_auth(f)
+    with open(filenames['cred']) as f:
+        config['secret'] = read_secret(f)
+    with open(filenames['label']) as f:
+        config['patterns'] = get_label_patterns(f)
+    if config['patterns'] != False:
+        config['matcher'] = compile_label_patterns(config['patterns'])
+        config['hash'] = config_hash(config['patterns'])
+    return config
+
+
+def get_config():
+    """
+    Get the configuration, the files are only read again when they were modified (checked at most
+    every CONFIG_CHECK seconds), FILABEL_CONFIG changed or the process got SIGHUP
+        :returns: configuration from load_config(), False if something went wrong
+        :rtype: dictionary, bool
+    """
+    config = config_cache['config']
+    if config != None and config_is_fresh(config):
+        return config
+    with config_lock:
+        config = config_cache['config']
+        if config != None and config_is_fresh(config):
+            return config
+        config_cache['stale'] = False
+        config = load_config()
+        config_cache['config'] = config if config != False else None
+        return config
+
+
+def config_is_fresh(config):
+    """
+    Check whether the cached configuration can still be used
+        :param config: configuration from load_config()
+        :type config: dictionary
+        :returns: True if the cached configuration is up to date
+        :rtype: bool
+    """
+    if config_cache['stale']:
+        return False
+    if config['env'] != os.getenv('FILABEL_CONFIG'):
+        return False
+    now = time.monotonic()
+    if now - config['checked'] < CONFIG_CHECK:
+        return True
+    if get_mtimes(config) != config['mtimes']:
+        return False
+    config['checked'] = now
+    return True
+
+
+def reload_config(signum=None, frame=None):
+    """
+    Make the next get_config() read the configuration files again, used as SIGHUP handler
+    """
+    config_cache['stale'] = True
+
+
+"""
+Whether the SIGHUP handler is installed, see install_reload_signal()
+"""
+signal_state = {'installed': False}
+
+
+def install_reload_signal():
+    """
+    Make SIGHUP reload the configuration. Only the main thread can install signal handlers,
+    so it is done the first time the app serves a request in the main thread (e.g. in a sync worker of gunicorn).
+    Servers answering the requests in other threads can call it from the main thread at startup.
+    Importing the module does not change the signal handlers of the process.
+        :returns: True if the handler is installed, False if it cannot be installed from this thread
+        :rtype: bool
+    """
+    if signal_state['installed']:
+        return True
+    if not hasattr(signal, 'SIGHUP') or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGHUP, reload_config)
+    signal_state['installed'] = True
+    return True
+
+
+@app.before_request
+def prepare_request():
+    """
+    Install the SIGHUP handler before serving the first request, if possible
+    """
+    install_reload_signal()
+
+
+"""
+Sessions to GitHub shared by all the requests, see get_session_pool()
+"""
+pool_cache = {'token': None, 'pool': None}
+pool_lock = threading.Lock()
+
+
+def get_session_pool(token):
+    """
+    Get the pool of open sessions for the token, a new pool is created when the token changes.
+    Size of the pool is read from FILABEL_POOL_SIZE (idle sessions kept, default 10)
+    and FILABEL_POOL_CONNECTIONS (connections per session, default 4).
+        :param token: GitHub token
+        :type token: string
+        :returns: pool of sessions
+        :rtype: filabel.github.SessionPool
+    """
+    with pool_lock:
+        if pool_cache['pool'] == None or pool_cache['token'] != token:
+            if pool_cache['pool'] != None:
+                pool_cache['pool'].close()
+            size = int(os.getenv('FILABEL_POOL_SIZE', '10'))
+            connections = int(os.getenv('FILABEL_POOL_CONNECTIONS', '4'))
+            pool_cache['pool'] = SessionPool(token, size, connections, get_http_cache(), rate_limiter, metrics)
+            pool_cache['token'] = token
+        return pool_cache['pool']
+
+
+"""
+Event loop of the asynchronous engine running in a background thread of the process,
+with the aiohttp session shared by all the webhooks, see get_async_loop() and get_async_session()
+"""
+async_cache = {'loop': None, 'pid': None, 'session': None, 'token': None}
+async_lock = threading.Lock()
+
+"""
+Seconds the webhooks still using the session of an old token have before it is closed
+"""
+SESSION_CLOSE_DELAY = 60
+
+"""
+Flag indicating that the asynchronous engine was requested on a Python without its support, see use_async_engine()
+"""
+engine_state = {'warned': False}
+
+
+def use_async_engine():
+    """
+    Find out whether the webhooks are labeled by the asynchronous engine (FILABEL_ENGINE=async),
+    on Python older than 3.7 the thread pool engine is used instead
+        :returns: True if the asynchronous engine should be used
+        :rtype: bool
+    """
+    if os.getenv('FILABEL_ENGINE') != 'async':
+        return False
+    if sys.version_info < (3, 7):
+        if not engine_state['warned']:
+            engine_state['warned'] = True
+            print('Async engine needs Python 3.7 or newer, using the sync one', file=sys.stderr)
+        return False
+    return True
+
+
+def get_async_loop():
+    """
+    Get the event loop of the asynchronous engine, it is started in a background thread on the first use
+    (again in a forked worker process, the thread of the parent does not run there)
+        :returns: the running event loop
+        :rtype: asyncio.AbstractEventLoop
+    """
+    with async_lock:
+        if async_cache['loop'] == None or async_cache['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='filabel-async', daemon=True).start()
+            async_cache.update(loop=loop, pid=os.getpid(), session=None, token=None)
+        return async_cache['loop']
+
+
+async def get_async_session(token):
+    """
+    Get the aiohttp session for the token, its connections are kept alive across the webhooks.
+    A new session is created when the token changes. Only the event loop thread uses the session, so no lock is needed.
+        :param token: GitHub token
+        :type token: string
+        :returns: open asynchronous session
+        :rtype: aiohttp.ClientSession()
+    """
+    from filabel.aiogithub import create_async_session
+    if async_cache['session'] == None or async_cache['token'] != token:
+        old = async_cache['session']
+        if old != None:
+            asyncio.get_event_loop().call_later(SESSION_CLOSE_DELAY, lambda: asyncio.ensure_future(old.close()))
+        async_cache['session'] = create_async_session(None, t=token, limiter=rate_limiter, metrics=metrics,
+            cache=get_http_cache())
+        async_cache['token'] = token
+    return async_cache['session']
+
+
+"""
+Default maximal number of seconds a request waits for the rate limit, see FILABEL_MAX_WAIT
+"""
+MAX_WAIT = 30
+
+"""
+Rate limit budget shared by all the requests of the app. A request that would wait longer than FILABEL_MAX_WAIT
+seconds fails instead, so the workers are not blocked until the quota is reset and the delivery can be redelivered.
+"""
+rate_limiter = RateLimiter(max_wait=float(os.getenv('FILABEL_MAX_WAIT', str(MAX_WAIT))))
+
+"""
+Metrics of the stages of handling the webhooks and of the GitHub requests, see show_metrics()
+"""
+metrics = Metrics()
+
+"""
+HTTP cache of the GitHub responses, see get_http_cache()
+"""
+http_cache = {'cache': None}
+
+
+def get_http_cache():
+    """
+    Get the HTTP cache, it is used if FILABEL_CACHE_DIR is set.
+    Its maximal size in megabytes is read from FILABEL_CACHE_SIZE (default 100).
+        :returns: the cache, None if it should not be used
+        :rtype: filabel.cache.HTTPCache
+    """
+    cache_dir = os.getenv('FILABEL_CACHE_DIR')
+    if cache_dir == None:
+        return None
+    if http_cache['cache'] == None:
+        size = int(os.getenv('FILABEL_CACHE_SIZE', '100'))
+        http_cache['cache'] = HTTPCache(cache_dir, size * 1024 * 1024)
+    return http_cache['cache']
+
+
+"""
+Memo of the labels of the paths shared by all the webhook requests, see get_label_memo()
+"""
+label_memo = {'memo': None}
+
+
+def get_label_memo():
+    """
+    Get the memo of the labels of the paths, the maximal number of paths is read from FILABEL_MEMO_SIZE (default 10000)
+        :returns: the memo
+        :rtype: filabel.github.LabelMemo
+    """
+    if label_memo['memo'] == None:
+        label_memo['memo'] = LabelMemo(int(os.getenv('FILABEL_MEMO_SIZE', str(LABEL_MEMO_SIZE))))
+    return label_memo['memo']
+
+
 @app.route('/', methods=['GET'])
 def show_main_page(s=None):
     """
@@ -59,43 +357,115 @@ def show_main_page(s=None):
         :returns: Rendered HTML template
         :rtype: HTML
     """
-    filenames = get_conf_files()
-    if filenames == False:
+    config = get_config()
+    if config == False:
         return '', 500
-    r = ''
-    with open(filenames['label']) as f:
-        r = get_label_patterns(f)
-        if r == False:
-            r = {'X': 'No label configuration supplied!'}
-    username = get_username(filenames['cred'], s)
+    r = config['patterns']
+    if r == False:
+        r = {'X': 'No label configuration supplied!'}
+    username = get_username(config['token'], s)
     if username == False:
         username = 'Unable to get'
     return render_template('main.html', name=username, rules = r)
 
 
-def get_username(conf, s=None):
+def get_username(token, s=None):
     """
     Get username of the token's owner.
-        :param conf: credentials configuration file
+        :param token: GitHub token
+        :param s: debug param, session used instead of the pooled one
+        :type token: string
         :returns: username of the repository owner, False if something went wrong
         :rtype: string, bool
     """
-    sesison = requests.Session()
-    with open(conf) as f:
-        session = create_session(f, s)
-    if session == False:
+    if token == False:
         return False
-    u = session.get('https://api.github.com/user')
+    if s != None:
+        return get_login(create_session(None, s, token))
+    with get_session_pool(token).session() as session:
+        return get_login(session)
+
+
+def get_login(session):
+    """
+    Get username of the session's owner.
+        :param session: open GitHub session
+        :type session: requests.Session
+        :returns: username, False if something went wrong
+        :rtype: string, bool
+    """
+    u = session.get(f'{get_api_url(session)}/user')
     u_json = u.json()
     if 'login' not in u_json:
         return False
     return u_json['login']
 
 
+@app.route('/stats', methods=['GET'])
+def show_stats():
+    """
+    Show usage statistics of the app as JSON
+        :returns: JSON with statistics of the session pool, the job queue, ignored events, the HTTP cache, the rate limit,
+                  the label memo and the cache of the pull request files
+        :rtype: JSON
+    """
+    pool = pool_cache['pool']
+    jobs = queue_cache['queue']
+    return jsonify({
+        'session_pool': pool.stats() if pool != None else None,
+        'job_queue': jobs.stats() if jobs != None else None,
+        'ignored_actions': dict(ignored_actions),
+        'http_cache': http_cache['cache'].stats() if http_cache['cache'] != None else None,
+        'rate_limit': rate_limiter.stats(),
+        'label_memo': label_memo['memo'].stats() if label_memo['memo'] != None else None,
+        'pull_files': pull_files_cache['cache'].stats() if pull_files_cache['cache'] != None else None,
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def show_metrics():
+    """
+    Show metrics of the app in the Prometheus text format: durations and failures of the stages of handling
+    the webhooks, GitHub requests by endpoint and status, pages and files per pull request and changed labels
+        :returns: the metrics
+        :rtype: text
+    """
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+"""
+Queue of the pull requests waiting to be labeled, see get_job_queue()
+"""
+queue_cache = {'queue': None}
+queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Get the queue of background jobs. Number of the worker threads is read from
+    FILABEL_WORKERS (default 4, 0 means the pull requests are labeled before answering)
+    and the maximal number of waiting jobs from FILABEL_QUEUE_SIZE (default 100).
+    Events of one pull request arriving within FILABEL_COALESCE_WINDOW seconds (default 2)
+    are labeled once.
+        :returns: queue of the jobs, None if the jobs should not run in background
+        :rtype: filabel.jobs.JobQueue
+    """
+    workers = int(os.getenv('FILABEL_WORKERS', '4'))
+    if workers == 0:
+        return None
+    with queue_lock:
+        if queue_cache['queue'] == None:
+            size = int(os.getenv('FILABEL_QUEUE_SIZE', '100'))
+            window = float(os.getenv('FILABEL_COALESCE_WINDOW', '2'))
+            queue_cache['queue'] = JobQueue(workers, size, window=window)
+        return queue_cache['queue']
+
+
 @app.route('/', methods=['POST'])
 def react_to_post():
     """
-    React to POST method - find if it came from GitHub and if it was sent by the corrent event
+    React to POST method - find if it came from GitHub and if it was sent by the corrent event.
+    Pull requests are labeled in background after answering with 202.
         :returns: Status code depending on the success
         :rtype: int
     """
@@ -109,13 +479,145 @@ def react_to_post():
             return '', 404
         return '', 200
     elif payload_headers['X-GitHub-Event'] == 'pull_request':
-        if handle_pull_request(payload_headers, payload_json['pull_request']) == False:
+        with metrics.timer('signature') as t:
+            t['ok'] = check_signature(payload_headers)
+        if t['ok'] == False:
             return '', 501
-        return '', 200
+        jobs = get_job_queue()
+        if should_label(payload_json, jobs) == False:
+            return '', 200
+        if jobs == None:
+            delivery = payload_headers.get('X-GitHub-Delivery')
+            if delivery != None and not delivery_log.add(delivery):
+                return '', 200
+            if handle_pull_request(payload_headers, payload_json['pull_request'], payload_json.get('action')) == False:
+                if delivery != None:
+                    # GitHub may deliver it again
+                    delivery_log.discard(delivery)
+                return '', 501
+            return '', 200
+        pj = payload_json['pull_request']
+        ret = jobs.submit(handle_pull_request, dict(payload_headers), pj, payload_json.get('action'),
+            delivery=payload_headers.get('X-GitHub-Delivery'), key=get_pull_key(pj))
+        if ret == 'rejected':
+            print('Job queue is full', file=sys.stderr)
+            return '', 503
+        return '', 202
     else:
         return '', 500
 
 
+"""
+Pull request actions that are labeled by default, the others cannot change the files
+"""
+DEFAULT_ACTIONS = 'opened,reopened,synchronize,edited'
+
+"""
+Number of ignored events per action
+"""
+ignored_actions = collections.Counter()
+
+"""
+Deliveries already labeled when the pull requests are labeled before answering, see react_to_post()
+"""
+delivery_log = DeliveryLog()
+
+"""
+Login of the token owner (False if it could not be found out) and the time it was looked up per token,
+see get_own_login()
+"""
+login_cache = {}
+login_lock = threading.Lock()
+
+"""
+Seconds a failed lookup of the login is not repeated for
+"""
+LOGIN_RETRY = 60
+
+
+def get_allowed_actions():
+    """
+    Get the pull request actions that should be labeled from FILABEL_ACTIONS
+        :returns: set of actions
+        :rtype: set
+    """
+    actions = os.getenv('FILABEL_ACTIONS', DEFAULT_ACTIONS)
+    return {a.strip() for a in actions.split(',') if a.strip() != ''}
+
+
+def should_label(payload, jobs=None):
+    """
+    Decide whether the pull request event can change the labels and should be labeled.
+    GitHub is not asked for the login of the token owner, when it is not known yet,
+    it is looked up by a background job and the event is labeled (with no changes if it was our own).
+        :param payload: JSON of the webhook
+        :param jobs: queue of the background jobs, None to look the login up right away
+        :type payload: JSON
+        :type jobs: filabel.jobs.JobQueue
+        :returns: True if the pull request should be labeled
+        :rtype: bool
+    """
+    action = payload.get('action')
+    if action == None:
+        return True
+    ret = action in get_allowed_actions()
+    if ret and action == 'edited':
+        # Only a new base branch changes the files, not the title or description
+        ret = 'base' in payload.get('changes', {})
+    if ret and action in ('labeled', 'unlabeled'):
+        # Ignore the events caused by our own label changes
+        sender = payload.get('sender', {}).get('login')
+        login = get_own_login(lookup=jobs == None)
+        if login == None:
+            jobs.submit(get_own_login, key='login')
+        ret = sender == None or sender != login
+    if not ret:
+        ignored_actions[action] += 1
+    return ret
+
+
+def get_own_login(lookup=True):
+    """
+    Get username of the token's owner, it is only asked for once per token, a failure is remembered for LOGIN_RETRY seconds
+        :param lookup: flag indicating that GitHub can be asked, otherwise only a known login is returned
+        :type lookup: bool
+        :returns: username, False if it cannot be found out, None if it is not known and should not be looked up
+        :rtype: string, bool
+    """
+    config = get_config()
+    if config == False or config['token'] == False:
+        return False
+    token = config['token']
+    with login_lock:
+        entry = login_cache.get(token)
+    if entry != None and (entry[0] != False or time.time() - entry[1] < LOGIN_RETRY):
+        return entry[0]
+    if not lookup:
+        return None
+    try:
+        login = get_username(token)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f'Login of the token owner could not be found out: {e}', file=sys.stderr)
+        login = False
+    with login_lock:
+        login_cache[token] = (login, time.time())
+    return login
+
+
+def get_pull_key(pj):
+    """
+    Get the key identifying the pull request, used to coalesce its events
+        :param pj: json of the pull request
+        :type pj: JSON
+        :returns: repository name and number of the pull request, None if they are missing
+        :rtype: tuple
+    """
+    repo_name = get_repo_name(pj)
+    if repo_name == False or 'number' not in pj:
+        return None
+    return (repo_name, pj['number'])
+
+
 def handle_ping(headers):
     """
     Answer to the ping request
@@ -128,57 +630,241 @@ def handle_ping(headers):
     return True
 
 
-def handle_pull_request(headers, pj):
+"""
+Files of the recently labeled pull requests, see get_pull_files_cache()
+"""
+pull_files_cache = {'cache': None}
+
+
+def get_pull_files_cache():
+    """
+    Get the cache of the files of the labeled pull requests,
+    the maximal number of pull requests is read from FILABEL_PULL_CACHE_SIZE (default 1000)
+        :returns: the cache
+        :rtype: filabel.github.PullFilesCache
+    """
+    if pull_files_cache['cache'] == None:
+        size = int(os.getenv('FILABEL_PULL_CACHE_SIZE', str(PULL_FILES_CACHE_SIZE)))
+        pull_files_cache['cache'] = PullFilesCache(size)
+    return pull_files_cache['cache']
+
+
+def get_cached_files(repo_name, pj, action):
+    """
+    Get the files of the pull request from its last labeling, only the delta since then has to be fetched
+        :param repo_name: name of the repository
+        :param pj: json of the pull request
+        :param action: action of the webhook
+        :type repo_name: string
+        :type pj: JSON
+        :type action: string
+        :returns: SHA of the head the files belong to, set of the paths and the base,
+                  None if all the files have to be listed
+        :rtype: tuple
+    """
+    if action != 'synchronize':
+        return None
+    cache = get_pull_files_cache()
+    entry = cache.get((repo_name, pj['number']))
+    if entry == None or 'sha' not in pj.get('head', {}):
+        cache.count('cold')
+        return None
+    # The files of the PR are relative to the base, e.g. after the base was edited in an event coalesced before
+    if entry[2] != get_base(pj):
+        cache.count('ambiguous')
+        return None
+    return entry
+
+
+def get_base(pj):
+    """
+    Get the base branch of the pull request the files are listed against
+        :param pj: json of the pull request
+        :type pj: JSON
+        :returns: ref and SHA of the base branch
+        :rtype: tuple
+    """
+    base = pj.get('base', {})
+    return base.get('ref'), base.get('sha')
+
+
+def add_delta(entry, delta):
+    """
+    Add the paths changed since the last labeling to the files of the pull request
+        :param entry: files from get_cached_files()
+        :param delta: added paths, None if the delta is ambiguous
+        :type entry: tuple
+        :type delta: list
+        :returns: paths of all the files of the pull request, None if all the files have to be listed
+        :rtype: set
+    """
+    cache = get_pull_files_cache()
+    # A path of the PR added again was removed by the PR before, it may be back to its content on the base
+    if delta == None or not entry[1].isdisjoint(delta):
+        cache.count('ambiguous')
+        return None
+    cache.count('delta')
+    return set(entry[1]) | set(delta)
+
+
+def remember_files(repo_name, pj, paths, full):
+    """
+    Remember the files of the pull request for the next synchronize event
+        :param repo_name: name of the repository
+        :param pj: json of the pull request
+        :param paths: paths of all the files of the pull request
+        :param full: flag indicating that the files were listed, not added from the delta
+        :type repo_name: string
+        :type pj: JSON
+        :type paths: list, set
+        :type full: bool
+    """
+    cache = get_pull_files_cache()
+    if full:
+        cache.count('full')
+    sha = pj.get('head', {}).get('sha')
+    if sha != None:
+        cache.put((repo_name, pj['number']), sha, paths, get_base(pj))
+
+
+def handle_pull_request(headers, pj, action=None):
     """
-    Answer to the pull request request and change the labels
+    Change the labels of the pull request, the signature must have been checked before.
+    The duration of the whole handling is recorded to the metrics, see label_pull_request().
         :param headers: request headers
         :param pj: json file from GitHub
+        :param action: action of the webhook, None if unknown
         :type headers: request.headers
         :type pj: JSON
+        :type action: string
         :returns: True if pull request was handled correctly, False otherwise
         :rtype: bool
     """
-    if check_signature(headers) == False:
-        return False
-    filenames = get_conf_files()
-    if filenames == False:
+    with metrics.timer('pull_request') as t:
+        t['ok'] = label_pull_request(headers, pj, action)
+    return t['ok']
+
+
+def label_pull_request(headers, pj, action=None):
+    """
+    Change the labels of the pull request.
+    On synchronize, only the files changed since the last labeling are fetched when possible.
+        :param headers: request headers
+        :param pj: json file from GitHub
+        :param action: action of the webhook, None if unknown
+        :type headers: request.headers
+        :type pj: JSON
+        :type action: string
+        :returns: True if pull request was handled correctly, False otherwise
+        :rtype: bool
+    """
+    with metrics.timer('config') as t:
+        config = get_config()
+        t['ok'] = config != False
+    if config == False:
         print('Unable to get config files', file=sys.stderr)
         return False
-    session = requests.Session()
-    with open(filenames['cred']) as f:
-        s = create_session(f)
-        if s == False:
-            print('Unable to open session', file=sys.stderr)
-            return False
-        session = s
     repo_name = get_repo_name(pj)
     if repo_name == False:
         return False
     pull_num = pj['number']
     labels_current = get_current_labels(pj['labels'])
-    pull_filenames = get_pr_files(repo_name, session, pull_num)
+    fpatterns = config['patterns']
+    if fpatterns == False:
+        print('Unable to get list of patterns', file=sys.stderr)
+        return False
+    if config['token'] == False:
+        print('Unable to open session', file=sys.stderr)
+        return False
+    if use_async_engine():
+        # The webhook waits for its labeling on the event loop shared by the whole process
+        future = asyncio.run_coroutine_threadsafe(
+            label_pull_request_async(config, repo_name, pj, labels_current, action), get_async_loop())
+        return future.result()
+
+    with get_session_pool(config['token']).session() as session:
+        with metrics.timer('files') as t, metrics.scope() as calls:
+            entry = get_cached_files(repo_name, pj, action)
+            pull_filenames = None
+            if entry != None:
+                pull_filenames = add_delta(entry, get_pr_delta(repo_name, session, entry[0], pj['head']['sha']))
+            full = pull_filenames == None
+            if full:
+                pull_filenames = get_pr_files(repo_name, session, pull_num)
+            t['ok'] = pull_filenames != False
+        if pull_filenames == False:
+            print(f'Unable to get the list of filenames of repo: {repo_name}, pull number: {pull_num}', file=sys.stderr)
+            return False
+        remember_files(repo_name, pj, pull_filenames, full)
+        with metrics.timer('match'):
+            labels_new = get_all_labels(pull_filenames, config['matcher'], get_label_memo(), config['hash'])
+            plan = plan_label_changes(labels_new, labels_current, fpatterns)
+        with metrics.timer('labels') as t:
+            fl = apply_label_plan(repo_name, pull_num, plan, session, is_strict())
+            t['ok'] = fl != False
+    metrics.record_pull(sum(calls.values()), len(pull_filenames), plan if fl != False else None)
+    if fl == False:
+        print('Unable to add labels', file=sys.stderr)
+        return False
+    return True
+
+
+async def label_pull_request_async(config, repo_name, pj, labels_current, action=None):
+    """
+    Change the labels of the pull request using the asynchronous engine
+        :param config: configuration from get_config()
+        :param repo_name: name of the repository
+        :param pj: json of the pull request
+        :param labels_current: labels the pull request has now
+        :param action: action of the webhook, None if unknown
+        :type config: dictionary
+        :type repo_name: string
+        :type pj: JSON
+        :type labels_current: list
+        :type action: string
+        :returns: True if pull request was handled correctly, False otherwise
+        :rtype: bool
+    """
+    from filabel.aiogithub import get_pr_files_async, get_pr_delta_async, apply_label_plan_async
+    fpatterns = config['patterns']
+    pull_num = pj['number']
+    session = await get_async_session(config['token'])
+    with metrics.timer('files') as t, metrics.scope() as calls:
+        entry = get_cached_files(repo_name, pj, action)
+        pull_filenames = None
+        if entry != None:
+            pull_filenames = add_delta(entry,
+                await get_pr_delta_async(repo_name, session, entry[0], pj['head']['sha']))
+        full = pull_filenames == None
+        if full:
+            pull_filenames = await get_pr_files_async(repo_name, session, pull_num)
+        t['ok'] = pull_filenames != False
     if pull_filenames == False:
         print(f'Unable to get the list of filenames of repo: {repo_name}, pull number: {pull_num}', file=sys.stderr)
         return False
-    fpatterns = {}
-    with open(filenames['label']) as f:
-        fpatterns = get_label_patterns(f)
-        if fpatterns == False:
-            print('Unable to get list of patterns', file=sys.stderr)
-            return False
-    labels_new = get_all_labels(pull_filenames, fpatterns) 
-    u_labels_to_keep = get_unknown_labels_to_keep(labels_current, fpatterns)
-    labels_to_add = labels_new
-    labels_to_add += u_labels_to_keep
-    labels_to_add = list(set(labels_to_add))
-    fl = add_labels(repo_name, pull_num, labels_to_add, session)     
+    remember_files(repo_name, pj, pull_filenames, full)
+    with metrics.timer('match'):
+        labels_new = get_all_labels(pull_filenames, config['matcher'], get_label_memo(), config['hash'])
+        plan = plan_label_changes(labels_new, labels_current, fpatterns)
+    with metrics.timer('labels') as t:
+        fl = await apply_label_plan_async(repo_name, pull_num, plan, session, is_strict())
+        t['ok'] = fl != False
+    metrics.record_pull(sum(calls.values()), len(pull_filenames), plan if fl != False else None)
     if fl == False:
         print('Unable to add labels', file=sys.stderr)
         return False
     return True
 
 
-    
+def is_strict():
+    """
+    Find out from the environment whether the labels should be checked with another request
+        :returns: True if FILABEL_STRICT is set to 1, False otherwise
+        :rtype: bool
+    """
+    return os.getenv('FILABEL_STRICT') == '1'
+
+
 def get_repo_name(p_json):
     """
     Get name of the current repository
@@ -231,22 +917,31 @@ def check_signature(headers, d=None):
 
 def get_secret():
     """
-    Read the webhook secret from configuration file
-        :returns: GitHub webhook secret
-        :rtype: string
+    Get the webhook secret from the cached configuration
+        :returns: GitHub webhook secret, False if something went wrong
+        :rtype: string, bool
     """
-    conf_files = get_conf_files()
-    if conf_files == False:
+    config = get_config()
+    if config == False:
         return False
+    return config['secret']
+
+
+def read_secret(f):
+    """
+    Read the webhook secret from configuration file
+        :param f: configuration file with credentials
+        :type f: file
+        :returns: GitHub webhook secret, False if there is none
+        :rtype: string, bool
+    """
     config = configparser.ConfigParser()
     ret = False
-    with open(conf_files['cred']) as f:
-        config.read_file(f)
-        if config.has_section('github') == False:
-            return False
-        opts = config.options('github')
-        for o in opts:
-            if o == 'secret':
-                ret = config.get('github', o)
+    config.read_file(f)
+    if config.has_section('github') == False:
+        return False
+    opts = config.options('github')
+    for o in opts:
+        if o == 'secret':
+            ret = config.get('github', o)
     return ret
-
@@ -14,7 +14,7 @@ setup(
     author_email='soucevi1@fit.cvut.cz',
     license='Public Domain',
     url='https://github.com/soucevi1/PYT-01',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     package_data={'filabel': ['templates/*.html']},
     entry_points={
     	'console_scripts': [
@@ -36,6 +36,8 @@ setup(
         'Environment :: Web Environment',
         ],
     zip_safe=False,
+    python_requires='>=3.6',
     install_requires=[ 'wheel', 'Flask', 'click', 'colorama', 'requests'],
+    extras_require={'async': ['aiohttp']},
     keywords='label,github,file,web,cli'
 )
\ No newline at end of file